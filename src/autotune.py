@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+
+import checks
+import exam_scanner
+
+from aux.filehandler import FileHandler
+from aux.data_classes import InterpreterOptions
+from aux import log
+
+logger = log.get_new_logger('autotune')
+
+
+def get_candidates(max_threads : int) -> list[dict]:
+    # few processes x many threads ... many processes x one thread
+    candidates = []
+    threads = 1
+    while threads <= max_threads:
+        for use_xnnpack in (True, False):
+            candidates.append({
+                'workers': max(1, max_threads // threads),
+                'num_threads': threads,
+                'use_xnnpack': use_xnnpack,
+            })
+        threads *= 2
+    return candidates
+
+
+def benchmark(candidate : dict, scan_args : tuple, sample_paths : list[str], sample_size : int) -> dict:
+    options = InterpreterOptions(
+        num_threads=candidate['num_threads'], use_xnnpack=candidate['use_xnnpack']
+    )
+    exam_scanner.INTERPRETER_OPTIONS_1ST_STAGE = options
+    exam_scanner.INTERPRETER_OPTIONS_2ND_STAGE = options
+    # the first sheet of each worker waits for the fork and the model loading, only the
+    # sheets after them are timed: at least 4 per worker and a multiple of the workers,
+    # the sample is repeated when it is shorter
+    workers = candidate['workers']
+    timed = max(-(-sample_size // workers), 4) * workers
+    FileHandler.INPUT_PATHS = list(itertools.islice(itertools.cycle(sample_paths), workers + timed))
+
+    start = time.perf_counter()
+    warm = start
+    for count, _ in enumerate(exam_scanner.scan_results(scan_args, workers=workers), start=1):
+        if count == workers:
+            warm = time.perf_counter()
+    end = time.perf_counter()
+    return {
+        'sheets_per_second': timed / (end - warm),
+        'load_seconds': warm - start,
+        'timed_sheets': timed,
+    }
+
+
+def autotune(scan_args, sample_paths, sample_size, max_threads, output) -> dict:
+    results = []
+    for candidate in get_candidates(max_threads):
+        logger.info(f'benchmarking {candidate}...')
+        measures = benchmark(candidate, scan_args, sample_paths, sample_size)
+        logger.info(
+            f'{candidate} : {measures["sheets_per_second"]:.2f} sheets/s, '
+            f'{measures["load_seconds"]:.2f} s to load'
+        )
+        results.append(dict(candidate, **measures))
+
+    # steady state throughput, the load time only matters once per run
+    best = max(results, key=lambda result: result['sheets_per_second'])
+    options = InterpreterOptions(num_threads=best['num_threads'], use_xnnpack=best['use_xnnpack'])
+    config = {
+        'workers': best['workers'],
+        '1st_stage': options.to_dict(),
+        '2nd_stage': options.to_dict(),
+        'sheets_per_second': best['sheets_per_second'],
+        'load_seconds': best['load_seconds'],
+        'benchmarks': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(config, f, indent=4)
+    logger.error(f'best config: {best}, saved to {output}')
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark interpreter threads/processes on sample sheets and save the best config'
+    )
+    parser.add_argument("-mf", "--model_name_1st_stage", type=str, default="1st_stage_v0_0_0")
+    parser.add_argument("-ms", "--model_name_2nd_stage", type=str, default="2nd_stage_v0_0_1")
+    parser.add_argument("-stf", "--score_threshold_1st_stage", type=float, default=0.5)
+    parser.add_argument("-sts", "--score_threshold_2nd_stage", type=float, default=0.5)
+    parser.add_argument("-i", "--input_directory", type=str, required=True)
+    parser.add_argument(
+        "-p", "--prova", type=str, default="PS", choices=['PS', 'SIMUENEM', 'SIMUFSC'],
+    )
+    parser.add_argument(
+        "-n", "--sample_size", type=int, default=16,
+        help="sheets timed in each benchmark after the warm up, rounded up to a multiple of the workers and at least 4 per worker",
+    )
+    parser.add_argument(
+        "--max_threads", type=int, default=os.cpu_count(),
+        help="cores available to the scanner",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default="interpreter_config.json",
+        help="file loaded by exam_scanner.py --interpreter_config",
+    )
+    args = parser.parse_args()
+
+    log.remove_filehandler()
+    # the failed sheets are part of the workload, they must not stop the benchmark
+    checks.FILTER_DETECTIONS = False
+    checks.CONTINUE_ON_FAIL = True
+    checks.load_checker(args.prova)
+
+    FileHandler.set_path("MODELS_PATH", './models')
+    FileHandler.set_path("INPUT_DIR", args.input_directory)
+    FileHandler.get_input_paths_checker(recursive=True)
+    sample_paths = list(itertools.islice(FileHandler.INPUT_PATHS, args.sample_size))
+    if not sample_paths:
+        raise ValueError(f'no images found in {args.input_directory}')
+
+    scan_args = (
+        args.model_name_1st_stage,
+        args.model_name_2nd_stage,
+        None,
+        None,
+        args.score_threshold_1st_stage,
+        args.score_threshold_2nd_stage,
+    )
+    with tempfile.TemporaryDirectory() as output_dir:
+        FileHandler.make_and_set_dir("OUTPUT_DIR", output_dir)
+        autotune(scan_args, sample_paths, args.sample_size, args.max_threads, args.output)
+
+
+if __name__ == "__main__":
+    main()
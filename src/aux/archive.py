@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import os
+import tarfile
+import time
+import zipfile
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator
+
+from aux import log
+
+logger = log.get_new_logger('archive')
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+def is_archive(path) -> bool:
+    path = Path(path)
+    return path.is_file() and path.name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+@dataclass
+class ArchiveMember():
+    # a file inside an input archive, passed around in place of its path
+    archive: Path = field(default=None)
+    name: str = field(default='')       # path inside the archive
+    data: bytes = field(default=None)   # tar members are read while the archive is walked
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        return _open_zip(self.archive).read(self.name)
+
+
+# zip files opened by this process, a forked worker must not share the parent's file offset
+_zip_files : dict[Path, tuple[int, zipfile.ZipFile]] = {}
+
+def _open_zip(path : Path) -> zipfile.ZipFile:
+    pid, zip_file = _zip_files.get(path, (None, None))
+    if pid != os.getpid():
+        zip_file = zipfile.ZipFile(path)
+        _zip_files[path] = (os.getpid(), zip_file)
+    return zip_file
+
+
+def iter_members(path : Path, extensions : tuple[str], keep=None) -> Iterator[ArchiveMember]:
+    '''
+    Yields the files of a zip or tar archive ending with one of the extensions (any case),
+    without extracting them. keep(member name) filters the members, e.g. by shard.
+    Zip members come sorted by name, tar members in the archive order: a compressed tar
+    is read once from start to end, each member right before it is yielded.
+    '''
+    path = Path(path)
+    def wanted(name : str) -> bool:
+        return name.lower().endswith(extensions) and (keep is None or keep(name))
+
+    if path.name.lower().endswith('.zip'):
+        names = sorted(info.filename for info in _open_zip(path).infolist() if not info.is_dir())
+        for name in names:
+            if wanted(name):
+                logger.debug(f'Adding member: {path}:{name}')
+                yield ArchiveMember(path, name)
+        return
+
+    with tarfile.open(path, mode='r|*') as tar:
+        for member in tar:
+            if member.isfile() and wanted(member.name):
+                logger.debug(f'Adding member: {path}:{member.name}')
+                yield ArchiveMember(path, member.name, tar.extractfile(member).read())
+
+
+class ArchiveWriter():
+    '''
+    Zip files with the per-sheet outputs (json and debug images), written by a single
+    process. A zip can only be read once closed, so every flush() closes the current
+    file and the next sheets go to a new one, the on_written callbacks run then.
+    '''
+
+    logger = log.get_new_logger('ArchiveWriter')
+
+    def __init__(self, directory : Path, max_sheets : int = None, prefix : str = 'sheets') -> None:
+        self.directory : Path = Path(directory)
+        self.max_sheets : int = max_sheets
+        # files of a run sort after the ones of previous runs
+        self.prefix : str = f"{prefix}_{time.strftime('%Y%m%d%H%M%S')}"
+        self.paths : list[Path] = []
+        self._file : zipfile.ZipFile = None
+        self._count : int = 0
+        self._callbacks : list[Callable] = []
+
+    def add(self, files : dict[str, bytes], on_written : Callable = None) -> None:
+        # files: path inside the archive -> content
+        if self._file is None:
+            self._path = self._next_path()
+            self._file = zipfile.ZipFile(self._path.with_name(f'.{self._path.name}.tmp'), 'w')
+        for name, data in files.items():
+            # jpg/png are already compressed
+            compression = zipfile.ZIP_DEFLATED if name.endswith('.json') else zipfile.ZIP_STORED
+            self._file.writestr(name, data, compress_type=compression)
+        if on_written is not None:
+            self._callbacks.append(on_written)
+        self._count += 1
+        if self.max_sheets is not None and self._count >= self.max_sheets:
+            self.flush()
+
+    def _next_path(self) -> Path:
+        # two runs started in the same second must not overwrite each other
+        number = len(self.paths)
+        while (self.directory / f'{self.prefix}_{number:04}.zip').exists():
+            number += 1
+        return self.directory / f'{self.prefix}_{number:04}.zip'
+
+    def flush(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        Path(self._file.filename).replace(self._path)
+        self.paths.append(self._path)
+        self.logger.info(f'{self._count} sheets : {self._path}')
+
+        callbacks = self._callbacks
+        self._file = None
+        self._count = 0
+        self._callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def index_archives(directory : Path, prefix : str = 'sheets') -> dict[str, Path]:
+    # path inside the archives -> zip with its latest version (a resumed run writes new files)
+    index = {}
+    for path in sorted(Path(directory).glob(f'{prefix}_*.zip')):
+        for name in _open_zip(path).namelist():
+            index[name] = path
+    return index
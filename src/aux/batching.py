@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable
+
+from aux import log
+
+_STOP = object()
+
+
+class MicroBatcher():
+    '''
+    Groups items submitted from many threads into batches for process_batch,
+    which runs on a single thread and must return one result per item.
+    A batch is sent when it reaches max_batch_size or when its first item
+    has waited max_wait seconds.
+    '''
+
+    def __init__(
+            self, process_batch : Callable[[list], list], max_batch_size : int = 8,
+            max_wait : float = 0.01, name : str = 'MicroBatcher',
+        ) -> None:
+        self.process_batch = process_batch
+        self.max_batch_size : int = max_batch_size
+        self.max_wait : float = max_wait
+        self.logger = log.get_new_logger(name)
+        # counters
+        self.batches : int = 0
+        self.items : int = 0
+
+        self._queue : queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit_many(self, items : list) -> list[Future]:
+        return [self.submit(item) for item in items]
+
+    def close(self) -> None:
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def average_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._process(batch)
+
+    def _process(self, batch : list[tuple]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = self.process_batch([item for item, _ in batch])
+        except Exception as e:
+            self.logger.exception(e)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
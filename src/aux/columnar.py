@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import json
+import struct
+import time
+
+import numpy as np
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+from aux import log
+
+# Columnar detections file (.detcol), one per batch of sheets:
+#
+#     magic (8 bytes) | header size (uint64) | header json | arrays, each aligned to 64 bytes
+#
+# boxes float32 [N, 4] (xmin, ymin, xmax, ymax), scores float32 [N], classes uint8 [N]
+# (index in header['class_names']) and crop_offsets int64 [C + 1], the detections of
+# crop c are the rows crop_offsets[c]:crop_offsets[c + 1]. Each sheet in header['sheets']
+# lists its crops, which are stored one after the other from its first_crop.
+MAGIC = b'DETCOL01'
+EXTENSION = '.detcol'
+ALIGNMENT = 64
+
+
+@dataclass
+class CropDetections():
+    # detections of one crop as arrays, the columnar version of Image.to_json
+    boxes: np.ndarray = field(default=None)       # float32 [N, 4]
+    scores: np.ndarray = field(default=None)      # float32 [N]
+    classes: np.ndarray = field(default=None)     # int [N], index in class_names
+    class_names: list[str] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def class_mask(self, class_name : str) -> np.ndarray:
+        if class_name not in self.class_names:
+            return np.zeros(len(self), dtype=bool)
+        return self.classes == self.class_names.index(class_name)
+
+    def to_json(self) -> list[dict]:
+        return [
+            {
+                "class_id": self.class_names[class_id],
+                "score": score,
+                "bounding_box": box,
+            }
+            for box, score, class_id in zip(
+                self.boxes.tolist(), self.scores.tolist(), self.classes.tolist()
+            )
+        ]
+
+
+class ColumnarWriter():
+    '''
+    Collects the detections of the sheets and writes them to a new .detcol file
+    every max_sheets sheets. on_written callbacks run once their sheet is on disk.
+    '''
+
+    logger = log.get_new_logger('ColumnarWriter')
+
+    def __init__(self, directory : Path, max_sheets : int = 256, prefix : str = 'detections') -> None:
+        self.directory : Path = Path(directory)
+        self.max_sheets : int = max_sheets
+        # files of a run sort after the ones of previous runs
+        self.prefix : str = f"{prefix}_{time.strftime('%Y%m%d%H%M%S')}"
+        self.paths : list[Path] = []
+        self._reset()
+
+    def _reset(self) -> None:
+        self._class_names : list[str] = []
+        self._sheets : list[dict] = []
+        self._crops : list[CropDetections] = []
+        self._callbacks : list[Callable] = []
+
+    def add_sheet(
+            self, name : str, status : str, crops : dict[str, CropDetections],
+            on_written : Callable = None,
+        ) -> None:
+        self._sheets.append({
+            'name': name,
+            'status': status,
+            'first_crop': len(self._crops),
+            'crops': list(crops),
+        })
+        self._crops.extend(crops.values())
+        if on_written is not None:
+            self._callbacks.append(on_written)
+        if len(self._sheets) >= self.max_sheets:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._sheets:
+            return
+        arrays = self._arrays()
+        header = {
+            'version': 1,
+            'count': len(arrays['scores']),
+            'class_names': self._class_names,
+            'sheets': self._sheets,
+            'arrays': {},
+        }
+        # the header holds the array offsets, which depend on the header size
+        offset = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = {
+                'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape),
+            }
+            offset = _aligned(offset + array.nbytes)
+        header_bytes = json.dumps(header).encode()
+        data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+        path, f = self._next_file()
+        with f:
+            f.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+            for name, array in arrays.items():
+                f.seek(data_start + header['arrays'][name]['offset'])
+                f.write(array.tobytes())
+            f.truncate(data_start + offset)
+        Path(f.name).replace(path)
+        self.paths.append(path)
+        self.logger.info(f'{len(self._sheets)} sheets, {header["count"]} detections : {path}')
+
+        callbacks = self._callbacks
+        self._reset()
+        for callback in callbacks:
+            callback()
+
+    def _next_file(self) -> tuple[Path, BinaryIO]:
+        # two runs started in the same second must not overwrite each other: the temporary
+        # file of a number is created exclusively and the number is skipped if taken
+        number = len(self.paths)
+        while True:
+            path = self.directory / f'{self.prefix}_{number:04}{EXTENSION}'
+            if not path.exists():
+                try:
+                    f = open(path.with_name(f'.{path.name}.tmp'), 'xb')
+                except FileExistsError:
+                    pass
+                else:
+                    if not path.exists():
+                        return path, f
+                    f.close()
+                    Path(f.name).unlink()
+            number += 1
+
+    def close(self) -> None:
+        self.flush()
+
+    def _arrays(self) -> dict[str, np.ndarray]:
+        crop_offsets = np.zeros(len(self._crops) + 1, dtype=np.int64)
+        crop_offsets[1:] = np.cumsum([len(crop) for crop in self._crops])
+        count = int(crop_offsets[-1])
+        boxes = np.zeros((count, 4), dtype=np.float32)
+        scores = np.zeros(count, dtype=np.float32)
+        classes = np.zeros(count, dtype=np.uint8)
+        for crop, start, end in zip(self._crops, crop_offsets[:-1], crop_offsets[1:]):
+            boxes[start:end] = crop.boxes
+            scores[start:end] = crop.scores
+            if len(crop):
+                # from the crop's label map to the file's class table
+                lookup = np.array([self._class_id(name) for name in crop.class_names], dtype=np.uint8)
+                classes[start:end] = lookup[crop.classes]
+        return {'boxes': boxes, 'scores': scores, 'classes': classes, 'crop_offsets': crop_offsets}
+
+    def _class_id(self, class_name : str) -> int:
+        if class_name not in self._class_names:
+            if len(self._class_names) == 256:
+                raise ValueError('a columnar file holds up to 256 classes')
+            self._class_names.append(class_name)
+        return self._class_names.index(class_name)
+
+
+class ColumnarReader():
+    '''
+    Memory maps a .detcol file, the arrays of each crop are views on the file.
+    '''
+
+    def __init__(self, path : Path) -> None:
+        self.path : Path = Path(path)
+        with open(self.path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'not a columnar detections file: {self.path}')
+            header_size, = struct.unpack('<Q', f.read(8))
+            self.header : dict = json.loads(f.read(header_size))
+        data_start = _aligned(len(MAGIC) + 8 + header_size)
+        self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+        arrays = {}
+        for name, spec in self.header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            size = int(np.prod(spec['shape'])) * dtype.itemsize
+            arrays[name] = self._map[start:start + size].view(dtype).reshape(spec['shape'])
+        self.boxes : np.ndarray = arrays['boxes']
+        self.scores : np.ndarray = arrays['scores']
+        self.classes : np.ndarray = arrays['classes']
+        self.crop_offsets : np.ndarray = arrays['crop_offsets']
+        self.class_names : list[str] = self.header['class_names']
+        self._sheets : dict[str, dict] = {sheet['name']: sheet for sheet in self.header['sheets']}
+
+    def __len__(self) -> int:
+        return len(self._sheets)
+
+    def __contains__(self, name : str) -> bool:
+        return name in self._sheets
+
+    def names(self) -> list[str]:
+        return list(self._sheets)
+
+    def status(self, name : str) -> str:
+        return self._sheets[name]['status']
+
+    def sheet(self, name : str) -> dict[str, CropDetections]:
+        # same keys as the per-sheet json, crop name -> detections
+        sheet = self._sheets[name]
+        crops = {}
+        for i, crop_name in enumerate(sheet['crops'], start=sheet['first_crop']):
+            start, end = int(self.crop_offsets[i]), int(self.crop_offsets[i + 1])
+            crops[crop_name] = CropDetections(
+                self.boxes[start:end], self.scores[start:end], self.classes[start:end], self.class_names
+            )
+        return crops
+
+    def to_json(self, name : str) -> dict[str, list]:
+        return {crop_name: crop.to_json() for crop_name, crop in self.sheet(name).items()}
+
+
+def index_files(directory : Path) -> dict[str, Path]:
+    # sheet name -> file with its latest detections (a resumed run writes new files)
+    index = {}
+    for path in sorted(Path(directory).glob(f'*{EXTENSION}')):
+        for name in ColumnarReader(path).names():
+            index[name] = path
+    return index
+
+
+def _aligned(offset : int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
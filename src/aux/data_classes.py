@@ -25,4 +25,15 @@ class FloatBoundingBox():
         return iter((*self.ponto_min, *self.ponto_max))
 
 
+@dataclass
+class InterpreterOptions():
+    num_threads: int = field(default=None)    # None keeps the runtime default
+    use_xnnpack: bool = field(default=True)   # XNNPACK is the default CPU delegate
+    delegate: str = field(default=None)       # path to an external delegate library
+
+    @classmethod
+    def from_dict(cls, data : dict):
+        return cls(**{key: data[key] for key in ('num_threads', 'use_xnnpack', 'delegate') if key in data})
 
+    def to_dict(self) -> dict:
+        return {'num_threads': self.num_threads, 'use_xnnpack': self.use_xnnpack, 'delegate': self.delegate}
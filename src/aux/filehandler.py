@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 import json
+import os
+import zlib
 
-from aux import log
+from aux import archive, log
+from aux.archive import ArchiveMember
 from pathlib import Path
+from typing import Iterator
 
 class FileHandler():
 
@@ -13,12 +17,18 @@ class FileHandler():
     OUTPUT_DIR : Path = None
     CROPPED_OUTPUT_DIR : Path = None
 
-    INPUT_PATHS = None
+    INPUT_PATHS : Iterator[str] = None
+    # (i, N), this run only scans the i-th of N parts of the input dir
+    SHARD : tuple[int, int] = None
     ACCEPTED_IMAGE_EXTENTIONS = (".jpg", ".jpeg", ".png")
 
     MODELS_PATH = None
 
     SAVE_IMAGES = False
+    # per-sheet detections json, read back by build_report.py
+    SAVE_JSON = True
+    # the per-sheet files are returned for the zip archives instead of written to a folder per sheet
+    SAVE_TO_ARCHIVE = False
 
 
     @classmethod
@@ -41,31 +51,50 @@ class FileHandler():
 
     @classmethod
     def get_input_paths_checker(cls, recursive=False):
-        try:
-            if not cls.INPUT_DIR.is_dir():
-                path = str(cls.INPUT_DIR.resolve())
-                if path.endswith(cls.ACCEPTED_IMAGE_EXTENTIONS):
-                    cls.logger.info(f"Adding path: {path}")
-                    cls.INPUT_PATHS = [path]
-                return
-            
-            cls.INPUT_PATHS = [] 
-            for extention in cls.ACCEPTED_IMAGE_EXTENTIONS:
-                if recursive:
-                    for p in cls.INPUT_DIR.rglob(f"*{extention}"):
-                        cls.logger.info(f"Adding path: {p}")
-                        cls.INPUT_PATHS.append(str(p))
-                else:
-                    for p in cls.INPUT_DIR.glob(f"*{extention}"):
-                        cls.logger.info(f"Adding path: {p}")
-                        cls.INPUT_PATHS.append(str(p))          
-        except Exception as e:
-            raise e
-    
+        # INPUT_PATHS is a generator, the directory is walked while the images are scanned
+        if archive.is_archive(cls.INPUT_DIR):
+            # './a.jpg' in a tar made from the folder is in the same shard as the folder's 'a.jpg'
+            keep = None if cls.SHARD is None else lambda name: in_shard(os.path.normpath(name), *cls.SHARD)
+            cls.INPUT_PATHS = archive.iter_members(cls.INPUT_DIR, cls.ACCEPTED_IMAGE_EXTENTIONS, keep)
+            return
+        if not cls.INPUT_DIR.is_dir():
+            path = str(cls.INPUT_DIR.resolve())
+            cls.INPUT_PATHS = iter([path] if path.lower().endswith(cls.ACCEPTED_IMAGE_EXTENTIONS) else [])
+            return
+        cls.INPUT_PATHS = cls.iter_input_paths(cls.INPUT_DIR, recursive, cls.SHARD)
+
+    @classmethod
+    def iter_input_paths(cls, directory : Path, recursive=False, shard : tuple[int, int] = None) -> Iterator[str]:
+        '''
+        Yields the images in directory, sorted by name inside each folder and folders
+        walked depth first, so every run (and every machine) sees the same order.
+        With shard=(i, N) only the paths whose crc32 of the relative path is i mod N.
+        '''
+        root = str(directory)
+        stack = [root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                cls.logger.warning(f'skipping {e.filename}: {e.strerror}')
+                continue
+            folders = []
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive:
+                        folders.append(entry.path)
+                elif entry.name.lower().endswith(cls.ACCEPTED_IMAGE_EXTENTIONS):
+                    if shard is not None and not in_shard(os.path.relpath(entry.path, root), *shard):
+                        continue
+                    cls.logger.debug(f"Adding path: {entry.path}")
+                    yield entry.path
+            # the first folder is walked next
+            stack.extend(reversed(folders))
+
     @classmethod
     def get_input_paths_builder(cls) -> list[Path]:
-        status = FileHandler.text_in(FileHandler.INPUT_DIR  / 'report.txt').strip('\n')
-        success, falied = [text.split('\n')[1:] for text in status.split('\n\n\n')]
+        success, falied = cls.parse_report(FileHandler.text_in(FileHandler.INPUT_DIR  / 'report.txt'))
         
         success_paths = [FileHandler.INPUT_DIR / f'{name}' / f'{name}.json' for name in success] 
         falied_paths = [FileHandler.INPUT_DIR / f'{name}' / f'{name}.json' for name in falied]
@@ -77,10 +106,38 @@ class FileHandler():
         
         return {'success': success_paths, 'falied': falied_paths}
 
+    @staticmethod
+    def parse_report(text : str) -> tuple[list[str], list[str]]:
+        # inverse of the report.txt written by exam_scanner.py
+        status = text.strip('\n')
+        success, falied = [text.split('\n')[1:] for text in status.split('\n\n\n')]
+        return success, falied
+
+    @staticmethod
+    def make_report(success : list[str], falied : list[str]) -> str:
+        success_imgs = ''.join(f'{name}\n' for name in success)
+        falied_imgs = ''.join(f'{name}\n' for name in falied)
+        return f'success:\n{success_imgs}\n\nfalied:\n{falied_imgs}'
+
+    @classmethod
+    def read_bytes(cls, filepath) -> bytes:
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    @classmethod
+    def read_input(cls, input_path : str | ArchiveMember) -> tuple[str, bytes]:
+        # file name and content of an item of INPUT_PATHS
+        if isinstance(input_path, ArchiveMember):
+            return input_path.name.split('/')[-1], input_path.read()
+        return str(input_path).split('/')[-1], cls.read_bytes(input_path)
+
     @classmethod
     def txt_out(cls, text, filename):
-        with open(cls.OUTPUT_DIR / filename, "w") as f:
+        # written aside and renamed, readers never see a half written file
+        tmp_path = cls.OUTPUT_DIR / f'.{filename}.tmp'
+        with open(tmp_path, "w") as f:
             f.write(text)
+        os.replace(tmp_path, cls.OUTPUT_DIR / filename)
     
     @classmethod
     def text_in(cls, filepath):
@@ -88,36 +145,70 @@ class FileHandler():
             return f.read()
     
     @classmethod
-    def save(cls, main_img=None, cropped_imgs=None):
-        
+    def detection_data(cls, cropped_imgs) -> dict[str, list]:
+        # crop name -> ball detections, the content of the per-sheet json
+        return {crop_img.name: crop_img.to_json() for crop_img in cropped_imgs}
+
+    @classmethod
+    def save(cls, main_img=None, cropped_imgs=None, detection_data=None) -> dict[str, bytes]:
+        # with SAVE_TO_ARCHIVE nothing is written, the files are returned for the archive
+        # (written by the main process), path inside the archive -> content
         if not main_img or not cropped_imgs:
             raise Exception(f"main_img and cropped_imgs must be set, not: {main_img}, {cropped_imgs}")
+        if not cls.SAVE_JSON and not cls.SAVE_IMAGES:
+            return {}
 
-        out_path = cls.OUTPUT_DIR / main_img.name[:-4]
-        out_path.mkdir(parents=True, exist_ok=True)
-        cls.logger.info(f"saving {main_img.name} json data : {out_path}")
-
-        detection_data = {}
-        for crop_img in cropped_imgs:
-            detection_data.update({crop_img.name: crop_img.to_json()})
-        with open(str(out_path) + f'/{main_img.name[:-4]}.json', 'w') as f:
-            json.dump(detection_data, f, indent=4)
+        sheet_name = main_img.name[:-4]
+        files = {}
+        if cls.SAVE_JSON:
+            cls.logger.info(f"saving {main_img.name} json data : {sheet_name}")
+            if detection_data is None:
+                detection_data = cls.detection_data(cropped_imgs)
+            files[f'{sheet_name}/{sheet_name}.json'] = json.dumps(detection_data, indent=4).encode()
 
         if cls.SAVE_IMAGES:
-            cls.logger.info(f"saving {main_img.name} images : {out_path}")
-            main_img.draw_bounding_boxes()
-            main_img.save(str(out_path / main_img.name))
-
-            for crop_img in cropped_imgs:
-                cls.logger.debug(f"saving {crop_img.name} : {out_path}")
-                crop_img.draw_bounding_boxes()
-                crop_img.save(str(out_path / crop_img.name))
+            cls.logger.info(f"saving {main_img.name} images : {sheet_name}")
+            for img in [main_img, *cropped_imgs]:
+                cls.logger.debug(f"saving {img.name} : {sheet_name}")
+                img.draw_bounding_boxes()
+                files[f'{sheet_name}/{img.name}'] = img.encode()
+
+        if cls.SAVE_TO_ARCHIVE:
+            return files
+        (cls.OUTPUT_DIR / sheet_name).mkdir(parents=True, exist_ok=True)
+        for name, data in files.items():
+            with open(cls.OUTPUT_DIR / name, 'wb') as f:
+                f.write(data)
+        return {}
     
     @classmethod
     def save_report(cls, report):
         cls.logger.info(f"saving report: {(cls.OUTPUT_DIR / 'final_report.json').resolve()}	")
-        with open(cls.OUTPUT_DIR / 'final_report.json', 'w') as f:
+        # written aside and renamed, like txt_out
+        tmp_path = cls.OUTPUT_DIR / '.final_report.json.tmp'
+        with open(tmp_path, 'w') as f:
             json.dump(report, f)
+        os.replace(tmp_path, cls.OUTPUT_DIR / 'final_report.json')
 
-
-
+    @classmethod
+    def load_report(cls) -> dict:
+        report_path = cls.OUTPUT_DIR / 'final_report.json'
+        if not report_path.exists():
+            return {}
+        with open(report_path) as f:
+            return json.load(f)
+
+
+def parse_shard(value : str) -> tuple[int, int]:
+    # 'i/N' -> (i, N), i from 0 to N - 1
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f'invalid shard {value}, expected i/N with 0 <= i < N')
+    return index, count
+
+
+def in_shard(relative_path : str, index : int, count : int) -> bool:
+    # same split on every machine, whatever the mount point of the input dir
+    key = relative_path.replace(os.sep, '/')
+    return zlib.crc32(key.encode()) % count == index
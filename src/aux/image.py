@@ -4,7 +4,22 @@ from __future__ import annotations
 import cv2
 import numpy as np
 
-from aux.object_detection import Detection, detect_objects_on_Image_object
+from aux.columnar import CropDetections
+from aux.object_detection import (
+    Detection, DetectionSet, detect_objects_on_Image_object, detect_objects_on_Image_batch
+)
+
+
+# cv2.imread flags of the reduced decodes, by reduction factor
+_REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+_REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+REDUCTIONS = tuple(_REDUCED_COLOR)
 
 
 class Image():
@@ -16,68 +31,168 @@ class Image():
         detections : list[Detection] | None = None
         return cls(name, raw, detections)
 
+    @classmethod
+    def from_bytes(cls, name : str, data : bytes, reduction : int = 1, grayscale : bool = False):
+        # same decoder as cv2.imread, from an encoded image already in memory
+        if reduction == 1 and not grayscale:
+            return cls(name, cls._decode(name, data, cv2.IMREAD_COLOR), None)
+        # the models see a reduced (jpeg: decoded at 1/2, 1/4 or 1/8 scale) and/or grayscale
+        # version, the full resolution is only decoded if the sheet gets to be cropped
+        flags = _REDUCED_GRAYSCALE if grayscale else _REDUCED_COLOR
+        img = cls(name, cls._decode(name, data, flags[reduction]), None)
+        img.preview, img.raw, img._encoded = img.raw, None, data
+        return img
+
+    @staticmethod
+    def _decode(name : str, data : bytes, flags : int) -> np.ndarray:
+        raw : np.ndarray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        if raw is None:
+            raise ValueError(f"could not decode image {name}")
+        return raw
+
     colors = [(255,0,0), (0,255,0), (0,0,255), (255,255,0), (0,255,255), (255,0,255), (0,0,0)]
 
     def __init__(self, name, raw, detections, cropped_by = None) -> None:
         self.raw : np.ndarray = raw
+        # reduced decode used by the models, see from_bytes
+        self.preview : np.ndarray | None = None
+        self._encoded : bytes | None = None
         self.name : str = name
+        self.detection_set : DetectionSet | None = None
         self.detections : list[Detection] = detections
         self.height : int = raw.shape[0]
         self.width : int = raw.shape[1]
         self.cropped_by : str | None = cropped_by
+        # (checker, check, message) of the checks it failed, set by checks.perform
+        self.failed_checks : list[tuple[str, str, str]] = []
+        # (checker, check, seconds, failed) of the check rules run, for checks/planner.py
+        self.check_timings : list[tuple[str, str, float, bool]] = []
         self.BOUNDING_BOXES_DRAWN = False
 
+
+    # the full resolution pixels of a reduced decode are decoded on first use
+    @property
+    def raw(self) -> np.ndarray:
+        if self._raw is None and self._encoded is not None:
+            self._raw = self._decode(self.name, self._encoded, cv2.IMREAD_COLOR)
+            self._encoded = None
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw : np.ndarray | None) -> None:
+        self._raw = raw
+
+    @property
+    def model_input(self) -> np.ndarray:
+        return self.preview if self.preview is not None else self.raw
+
+    # the Detection objects are only built when someone asks for them
+    @property
+    def detections(self) -> list[Detection] | None:
+        if self._detections is None and self.detection_set is not None:
+            self._detections = self.detection_set.to_list()
+        return self._detections
+
+    @detections.setter
+    def detections(self, detections : list[Detection] | None) -> None:
+        self._detections = detections
     
+    def _kept_index(self) -> np.ndarray:
+        # rows of the detection set still kept, all of them until the Detection objects are built
+        if self._detections is None:
+            return np.arange(len(self.detection_set))
+        return np.array([detection.set_index for detection in self._detections], dtype=np.int64)
+
+    def _class_names(self, index : np.ndarray) -> list[str]:
+        label_map = self.detection_set.label_map
+        return [label_map[class_id] for class_id in self.detection_set.classes[index].tolist()]
+
     def _has_detections(func):
         def wrapper(self, *args, **kwargs):
-            if self.detections is None:
+            # checked without building the Detection objects
+            if self._detections is None and self.detection_set is None:
                 raise Exception("Image detections not set")
             else:
                 return func(self, *args, **kwargs)
         return wrapper
     
     
+    @classmethod
+    def make_detections_in_batch(cls, imgs : list[Image], model, score_threshold) -> None:
+        batch_detections = detect_objects_on_Image_batch(model, [img.model_input for img in imgs])
+        for img, detections in zip(imgs, batch_detections):
+            img._set_detections(detections, score_threshold)
+
     def make_detections_with_model(self, model, score_threshold) -> None:
-        detections = detect_objects_on_Image_object(model, self.raw)
-        self.detections = [d for d in detections if d.score > score_threshold]
+        detections = detect_objects_on_Image_object(model, self.model_input)
+        self._set_detections(detections, score_threshold)
+
+    def _set_detections(self, detection_set : DetectionSet, score_threshold) -> None:
         # sort and mark detections from top left to bottom right    
-        self.detections.sort()
-        for i, detection in enumerate(self.detections):
-            detection.order = i
+        self.detection_set = detection_set.filter_by_score(score_threshold).in_reading_order()
+        self.detections = None
         self.BOUNDING_BOXES_DRAWN = False
     
     @_has_detections
     def get_cropped(self) -> list[Image]:
         cropped = []
-        # the detections are sorted by top left to bottom right
-        cont = 0
-        current_class = self.detections[0].class_id
-        for detection in self.detections:
-            if detection.class_id != current_class:
-                cont = 0
-                current_class = detection.class_id
-            xmin, ymin, xmax, ymax = detection.to_pixels()
+        # the detections are in reading order, each class is numbered on its own
+        cont = {}
+        if self.detection_set is not None:
+            class_names = self._class_names(self._kept_index())
+        else:
+            class_names = [detection.class_name for detection in self.detections]
+        for class_name, pixels in zip(class_names, self._pixel_boxes()):
+            class_cont = cont.get(class_name, 0)
+            xmin, ymin, xmax, ymax = pixels.tolist()
             cropped.append(
                 Image(
-                    f"{self.name[:-4]}_{detection.class_name}_{cont:02}.jpg",
+                    f"{self.name[:-4]}_{class_name}_{class_cont:02}.jpg",
                     self.raw[ymin:ymax, xmin:xmax],
                     None,
-                    cropped_by=detection.class_name
+                    cropped_by=class_name
                 )
             )
-            cont += 1
+            cont[class_name] = class_cont + 1
         return cropped
             
     @_has_detections
     def draw_bounding_boxes(self) -> None:
         if self.BOUNDING_BOXES_DRAWN: return
-        for detection in self.detections:
-            xmin, ymin, xmax, ymax = detection.to_pixels()
+        for detection, pixels in zip(self.detections, self._pixel_boxes()):
+            xmin, ymin, xmax, ymax = pixels.tolist()
             cv2.rectangle(self.raw, (xmin, ymin), (xmax, ymax), self.colors[detection.class_id], 3)
 
+    def _pixel_boxes(self) -> np.ndarray:
+        if self.detection_set is not None:
+            # detections may have been removed by the checks, convert only the ones left,
+            # to the full resolution when the model saw a reduced decode
+            height, width = self.raw.shape[:2]
+            return self.detection_set.to_pixels(self._kept_index(), width, height)
+        return np.array([d.to_pixels() for d in self.detections], dtype=np.int64).reshape(-1, 4)
+
     def save(self, path : str) -> None:      
         cv2.imwrite(path, self.raw)
+
+    def encode(self) -> bytes:
+        # what save() would write, in the format of the image name's extension
+        ok, data = cv2.imencode('.' + self.name.split('.')[-1], self.raw)
+        if not ok:
+            raise ValueError(f"could not encode image {self.name}")
+        return data.tobytes()
     
+    def to_columns(self, only_ball_detections=True) -> CropDetections:
+        # same detections as to_json, as arrays taken from the detection set
+        index = self._kept_index()
+        if only_ball_detections:
+            index = index[['ball' in class_name for class_name in self._class_names(index)]]
+        return CropDetections(
+            self.detection_set.boxes[index],
+            self.detection_set.scores[index],
+            self.detection_set.classes[index],
+            list(self.detection_set.label_map),
+        )
+
     def to_json(self, only_ball_detections=True) -> list:
         if only_ball_detections:
             json_data = []
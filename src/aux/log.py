@@ -33,11 +33,14 @@ checks_logger.addHandler(file_handler)
 def remove_filehandler():
     global LOGFILE
     for logger in logging.Logger.manager.loggerDict.values():
+        # dotted names (e.g. concurrent.futures) leave placeholders in the dict
+        if not isinstance(logger, logging.Logger): continue
         logger.removeHandler(file_handler)
     LOGFILE = False
 
 def set_log_level(level):
     for logger in logging.Logger.manager.loggerDict.values():
+        if not isinstance(logger, logging.Logger): continue
         if len(logger.handlers) < 2: continue
         try:
             var = eval(f'logging.{level[0]}')
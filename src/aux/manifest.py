@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+
+from aux import log
+from pathlib import Path
+
+
+class Manifest():
+    '''
+    Append-only record (JSON lines) of the sheets already scanned, keyed by the
+    hash of the image content and by the hash of the scan settings.
+    '''
+
+    logger = log.get_new_logger('Manifest')
+
+    FILENAME = 'manifest.jsonl'
+
+    def __init__(self, directory : Path, settings : dict) -> None:
+        self.path : Path = Path(directory) / self.FILENAME
+        self.settings : dict = settings
+        self.settings_key : str = hashlib.sha1(
+            json.dumps(settings, sort_keys=True).encode()
+        ).hexdigest()[:16]
+        self.entries : dict[str, dict] = {}
+        # a crash can leave the last line without its newline
+        self._broken_tail = False
+        self._load()
+
+    @staticmethod
+    def hash_bytes(data : bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def is_done(self, content_hash : str) -> bool:
+        # only successful scans made with the same settings are skipped
+        entry = self.entries.get(content_hash)
+        return (
+            entry is not None
+            and entry['settings'] == self.settings_key
+            and entry['status'] == 'success'
+        )
+
+    def record(self, content_hash : str, name : str, status : str) -> None:
+        entry = {
+            'hash': content_hash,
+            'name': name,
+            'status': status,
+            'settings': self.settings_key,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self.entries[content_hash] = entry
+        # one line per sheet, flushed right away so a crash keeps everything done so far
+        with open(self.path, 'a') as f:
+            if self._broken_tail:
+                f.write('\n')
+                self._broken_tail = False
+            f.write(json.dumps(entry) + '\n')
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        with open(self.path) as f:
+            for line in f:
+                self._broken_tail = not line.endswith('\n')
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line cut by a crash
+                    self.logger.warning(f'ignoring broken manifest line: {line!r}')
+                    continue
+                self.entries[entry['hash']] = entry
+        self.logger.info(f'{len(self.entries)} sheets in {self.path}')
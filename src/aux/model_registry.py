@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import re
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from aux import log
+from aux.data_classes import InterpreterOptions
+from aux.filehandler import FileHandler
+from aux.object_detection import Model
+
+
+@dataclass
+class ModelSpec():
+    name: str = field(default='')           # e.g. 2nd_stage
+    version: str = field(default='')        # e.g. 0.0.1
+    path: Path = field(default=None)        # models/<name>_v<version>
+    label_map: list[str] = field(default_factory=list)
+    num_classes: int = field(default=None)
+    input_height: int = field(default=None)
+    input_width: int = field(default=None)
+
+    @property
+    def model_name(self) -> str:
+        return self.path.name
+
+
+class ModelRegistry():
+    '''
+    Reads models/*/annotations/label_map.pbtxt and pipeline.config and keeps one
+    loaded Model per name, version, interpreter setup and label map in each process.
+    '''
+
+    logger = log.get_new_logger('ModelRegistry')
+
+    _specs : dict[str, ModelSpec] = {}
+    _models : dict[tuple, Model] = {}
+
+    @classmethod
+    def get_spec(cls, model_name : str) -> ModelSpec:
+        if model_name not in cls._specs:
+            cls._specs[model_name] = cls._read_spec(FileHandler.MODELS_PATH / model_name)
+        return cls._specs[model_name]
+
+    @classmethod
+    def list_specs(cls) -> list[ModelSpec]:
+        return [
+            cls.get_spec(path.name) for path in sorted(FileHandler.MODELS_PATH.iterdir())
+            if (path / 'annotations' / 'label_map.pbtxt').exists()
+        ]
+
+    @classmethod
+    def get_model(
+            cls, model_name : str, max_batch_size : int = 1,
+            options : InterpreterOptions = None, label_map : list[str] = None,
+        ) -> Model:
+        spec = cls.get_spec(model_name)
+        options = options if options is not None else InterpreterOptions()
+        # a label map given by hand overrides the one from label_map.pbtxt, for its own model
+        label_map = None if label_map is None else tuple(label_map)
+        key = (spec.name, spec.version, max_batch_size, tuple(options.to_dict().values()), label_map)
+        if key not in cls._models:
+            cls.logger.info(f'loading {spec.name} v{spec.version} : {spec.path}')
+            model = Model(model_name, max_batch_size=max_batch_size, options=options)
+            if spec.input_height is not None and (model.input_height, model.input_width) != (spec.input_height, spec.input_width):
+                cls.logger.warning(
+                    f'{model_name}: model input {model.input_height}x{model.input_width} does not match '
+                    f'pipeline.config {spec.input_height}x{spec.input_width}'
+                )
+            model.spec = spec
+            model.label_map = spec.label_map if label_map is None else list(label_map)
+            cls._models[key] = model
+        return cls._models[key]
+
+    @classmethod
+    def clear(cls) -> None:
+        cls._models.clear()
+        cls._specs.clear()
+
+    # parsers
+    @classmethod
+    def _read_spec(cls, path : Path) -> ModelSpec:
+        match = re.fullmatch(r'(.+)_v(\d+(?:_\d+)*)', path.name)
+        name, version = (match.group(1), match.group(2).replace('_', '.')) if match else (path.name, '')
+        spec = ModelSpec(name=name, version=version, path=path)
+
+        label_map_path = path / 'annotations' / 'label_map.pbtxt'
+        if label_map_path.exists():
+            spec.label_map = cls.parse_label_map(FileHandler.text_in(label_map_path))
+        else:
+            cls.logger.warning(f'label map not found: {label_map_path}')
+
+        config_path = path / 'pipeline.config'
+        if config_path.exists():
+            config = FileHandler.text_in(config_path)
+            num_classes = re.search(r'num_classes:\s*(\d+)', config)
+            if num_classes:
+                spec.num_classes = int(num_classes.group(1))
+            resizer = re.search(
+                r'fixed_shape_resizer\s*{\s*height:\s*(\d+)\s*width:\s*(\d+)', config
+            )
+            if resizer:
+                spec.input_height, spec.input_width = int(resizer.group(1)), int(resizer.group(2))
+
+        if spec.num_classes is not None and spec.num_classes != len(spec.label_map):
+            cls.logger.warning(
+                f'{path.name}: num_classes is {spec.num_classes} but the label map has {len(spec.label_map)} names'
+            )
+        return spec
+
+    @staticmethod
+    def parse_label_map(text : str) -> list[str]:
+        # the ids start at 1, the model outputs id - 1
+        items = {}
+        for item in re.findall(r'item\s*{([^}]*)}', text):
+            name = re.search(r'''name\s*:\s*['"]([^'"]*)['"]''', item)
+            id = re.search(r'id\s*:\s*(\d+)', item)
+            if name and id:
+                items[int(id.group(1))] = name.group(1)
+        if not items:
+            return []
+        return [items.get(i, '') for i in range(1, max(items) + 1)]
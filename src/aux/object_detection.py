@@ -5,46 +5,121 @@ import numpy as np
 import tflite_runtime.interpreter as tflite
 
 from aux.filehandler import FileHandler
-from aux.data_classes import FloatBoundingBox, FloatPoint
+from aux import log
+from aux.data_classes import FloatBoundingBox, FloatPoint, InterpreterOptions
+from aux.reading_order import reading_order
+
+logger = log.get_new_logger('object detection')
 
 # CLASSES
 class Model:
-    def __init__(self, model_name):
-        self.interpreter = tflite.Interpreter(
-            str(FileHandler.MODELS_PATH / model_name / "saved_model" / "model.tflite")
-        )
+    def __init__(
+            self, model_name, max_batch_size=1, options : InterpreterOptions = None, label_map=None,
+        ):
+        self.name = model_name
+        # class names of the outputs, None falls back to Detection.label_map
+        self.label_map : list[str] | None = label_map
+        # set by the ModelRegistry
+        self.spec = None
+        self.options = options if options is not None else InterpreterOptions()
+        self.path = str(FileHandler.MODELS_PATH / model_name / "saved_model" / "model.tflite")
+        self.interpreter = tflite.Interpreter(self.path, **self._interpreter_kwargs(self.options))
         self.interpreter.allocate_tensors()
-        input_details = self.interpreter.get_input_details()[0]["shape"]
-        self.input_height = input_details[1]
-        self.input_width = input_details[2]
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details["index"]
+        self.input_height = input_details["shape"][1]
+        self.input_width = input_details["shape"][2]
+        self.input_channels = input_details["shape"][3]
+        # quantized models take uint8/int8 inputs, (scale, zero_point) maps them to floats
+        self.input_dtype = np.dtype(input_details["dtype"])
+        self.input_quantization : tuple[float, int] = tuple(input_details["quantization"])
+        # images sent in a single invoke, batches are padded to one of batch_sizes and
+        # each size keeps its own interpreter, so the tensors are only allocated once per size
+        self.max_batch_size = max_batch_size
+        self.batch_sizes : list[int] = self._batch_sizes(max_batch_size)
+        self.batch_size = 1
+        self.supports_batch = max_batch_size > 1
+        self._interpreters = {1: self.interpreter}
+
+    @staticmethod
+    def _interpreter_kwargs(options : InterpreterOptions) -> dict:
+        kwargs = {}
+        if options.num_threads:
+            kwargs['num_threads'] = options.num_threads
+        if options.delegate:
+            kwargs['experimental_delegates'] = [tflite.load_delegate(options.delegate)]
+        if not options.use_xnnpack:
+            kwargs['experimental_op_resolver_type'] = (
+                tflite.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+            )
+        return kwargs
+
+    @staticmethod
+    def _batch_sizes(max_batch_size):
+        # powers of two up to max_batch_size, and max_batch_size itself
+        sizes = [1]
+        while sizes[-1] * 2 < max_batch_size:
+            sizes.append(sizes[-1] * 2)
+        if max_batch_size > 1:
+            sizes.append(max_batch_size)
+        return sizes
+
+    def padded_batch_size(self, count):
+        # smallest batch size that holds count images
+        return next(size for size in self.batch_sizes if size >= count)
+
+    def resize_batch(self, batch_size):
+        if batch_size == self.batch_size:
+            return
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = tflite.Interpreter(self.path, **self._interpreter_kwargs(self.options))
+            interpreter.resize_tensor_input(
+                self.input_index,
+                [batch_size, self.input_height, self.input_width, self.input_channels],
+            )
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+        self.interpreter = interpreter
+        self.batch_size = batch_size
 
 
 class Detection:
 
     label_map = []
 
-    def __init__(self, bounding_box, class_id, score, img_width, img_height):
+    def __init__(
+            self, bounding_box, class_id, score, img_width, img_height,
+            label_map=None, middle_point=None, aspect_ratio=None,
+        ):
+        if label_map is not None:
+            self.label_map = label_map
         self.bounding_box : FloatBoundingBox = bounding_box
         self.class_id : int = int(class_id)
         self.class_name : str = self.label_map[self.class_id]
         self.score : float = float(score)
         self.img_width : int =  img_width
         self.img_height : int = img_height
+        # position in the DetectionSet it was built from
+        self.set_index : int | None = None
+        # reading order (top left to bottom right), set by DetectionSet.in_reading_order
+        self.order : int | None = None
+        self.row : int | None = None
+        self.column : int | None = None
     
-                            #       ( x, y )
-        self.middle_point : FloatPoint = FloatPoint(
-            x = (self.bounding_box.ponto_min.x + self.bounding_box.ponto_max.x) / 2, 
-            y = (self.bounding_box.ponto_min.y + self.bounding_box.ponto_max.y) / 2,
-        )
-        self.aspect_ratio : float = (
-            (self.bounding_box.ponto_max.y - self.bounding_box.ponto_min.y) /
-            (self.bounding_box.ponto_max.x - self.bounding_box.ponto_min.x)  
-        ) * (img_height / img_width)
-
-    # Public Setters
-    @classmethod
-    def set_label_map(cls, label_map):
-        cls.label_map = label_map
+        if middle_point is None:
+                                #       ( x, y )
+            middle_point = FloatPoint(
+                x = (self.bounding_box.ponto_min.x + self.bounding_box.ponto_max.x) / 2, 
+                y = (self.bounding_box.ponto_min.y + self.bounding_box.ponto_max.y) / 2,
+            )
+        self.middle_point : FloatPoint = middle_point
+        if aspect_ratio is None:
+            aspect_ratio = (
+                (self.bounding_box.ponto_max.y - self.bounding_box.ponto_min.y) /
+                (self.bounding_box.ponto_max.x - self.bounding_box.ponto_min.x)  
+            ) * (img_height / img_width)
+        self.aspect_ratio : float = aspect_ratio
 
     # Public functions
     def to_pixels(self) -> tuple[int]:
@@ -60,53 +135,157 @@ class Detection:
     def to_json(self) -> dict:
         xmin, ymin, xmax, ymax = self.bounding_box
         return {
-            "class_id": self.label_map[self.class_id],
+            "class_id": self.class_name,
             "score": self.score,
             "bounding_box": [xmin, ymin, xmax, ymax],
         }
         
         
-    # sorted from top right to bottom left
+    # sorted from top left to bottom right, rows and columns come from the reading order engine
     def __lt__(self, other):
-        # check if below entirely from the other
-        vert_dist_from_other = self.middle_point.y - other.middle_point.y
-        self_height = self.bounding_box.ponto_max.y - self.bounding_box.ponto_min.y
-        # magic number 0.9 is the coeficient to allow an minor sobreposition of detections
-        # and still be considered below 
-        if abs(vert_dist_from_other) > self_height * 0.9:
-            if vert_dist_from_other < 0:
-                return True
-            else:
-                return False
-        
-        # check if right entirely from the other
-        hor_dist_from_other = self.middle_point.x - other.middle_point.x
-        self_width = self.bounding_box.ponto_max.x - self.bounding_box.ponto_min.x
-        # same magic number as above
-        if abs(hor_dist_from_other) > self_width * 0.9:
-            if hor_dist_from_other < 0:
-                return True
-            else:
-                return False
-
-        if vert_dist_from_other >= hor_dist_from_other:
-            return self.middle_point.y < other.middle_point.y
-        else:
-            return self.middle_point.x < other.middle_point.x
+        return (self.row, self.column) < (other.row, other.column)
     
     def __repr__(self) -> str:
         return "{}_{:.2f}-{:.2f}-{:.2f}-{:.2f}".format(self.class_name, *[x for x in self.bounding_box])
 
 
 
-def normalize_image(img_raw, detection_model_input_height, detection_model_input_width):
-    image_resized = (
-        cv2.resize(img_raw, (detection_model_input_height, detection_model_input_width))
-        / 255
-    )
-    img_np = np.expand_dims(image_resized, axis=0).astype(np.float32)
+class DetectionSet:
+    '''
+    Detections of one image stored as arrays (struct of arrays).
+    Boxes are normalized (xmin, ymin, xmax, ymax), Detection objects are only built on access.
+    '''
+
+    def __init__(self, boxes, scores, classes, img_width, img_height, label_map=None):
+        self.boxes : np.ndarray = boxes         # float32 [N, 4]
+        self.scores : np.ndarray = scores       # float32 [N]
+        self.classes : np.ndarray = classes     # int [N]
+        self.img_width : int = img_width
+        self.img_height : int = img_height
+        self.label_map : list[str] = Detection.label_map if label_map is None else label_map
+
+        # float64 keeps the values identical to the ones computed by Detection
+        boxes_64 = boxes.astype(np.float64)
+        self.centers : np.ndarray = (boxes_64[:, :2] + boxes_64[:, 2:]) / 2
+        self.aspect_ratios : np.ndarray = (
+            (boxes_64[:, 3] - boxes_64[:, 1]) / (boxes_64[:, 2] - boxes_64[:, 0])
+        ) * (img_height / img_width)
+        self._detections : list[Detection | None] = [None] * len(scores)
+        # row and column of each detection, see in_reading_order
+        self.rows : np.ndarray | None = None
+        self.columns : np.ndarray | None = None
+
+    @classmethod
+    def from_output(cls, scores, boxes, count, classes, img_width, img_height, label_map=None):
+        label_map = Detection.label_map if label_map is None else label_map
+        boxes = np.asarray(boxes[:count], dtype=np.float32)[:, [1, 0, 3, 2]]
+        scores = np.asarray(scores[:count], dtype=np.float32)
+        classes = np.asarray(classes[:count]).astype(np.int64)
+        # same rows Detection would reject: unknown classes and boxes without width
+        valid = (classes >= 0) & (classes < len(label_map)) & (boxes[:, 2] != boxes[:, 0])
+        if not valid.all():
+            logger.warning(f'ignoring {np.count_nonzero(~valid)} invalid detections')
+        return cls(boxes[valid], scores[valid], classes[valid], img_width, img_height, label_map)
+
+    @classmethod
+    def empty(cls, img_width, img_height, label_map=None):
+        return cls(
+            np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64),
+            img_width, img_height, label_map,
+        )
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def __getitem__(self, index : int) -> Detection:
+        detection = self._detections[index]
+        if detection is None:
+            xmin, ymin, xmax, ymax = self.boxes[index].tolist()
+            x, y = self.centers[index].tolist()
+            detection = Detection(
+                FloatBoundingBox.from_floats(xmin, ymin, xmax, ymax),
+                self.classes[index],
+                self.scores[index],
+                self.img_width,
+                self.img_height,
+                label_map=self.label_map,
+                middle_point=FloatPoint(x, y),
+                aspect_ratio=float(self.aspect_ratios[index]),
+            )
+            detection.set_index = index
+            if self.rows is not None:
+                detection.order = index
+                detection.row = int(self.rows[index])
+                detection.column = int(self.columns[index])
+            self._detections[index] = detection
+        return detection
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def subset(self, index) -> DetectionSet:
+        subset = DetectionSet.__new__(DetectionSet)
+        subset.boxes = self.boxes[index]
+        subset.scores = self.scores[index]
+        subset.classes = self.classes[index]
+        subset.img_width = self.img_width
+        subset.img_height = self.img_height
+        subset.label_map = self.label_map
+        subset.centers = self.centers[index]
+        subset.aspect_ratios = self.aspect_ratios[index]
+        subset._detections = [None] * len(subset.scores)
+        subset.rows = None if self.rows is None else self.rows[index]
+        subset.columns = None if self.columns is None else self.columns[index]
+        return subset
+
+    def in_reading_order(self) -> DetectionSet:
+        # sorted from top left to bottom right, a detection's index becomes its order
+        rows, columns, order = reading_order(self.centers, self.boxes[:, 3] - self.boxes[:, 1])
+        ordered = self.subset(order)
+        ordered.rows = rows[order]
+        ordered.columns = columns[order]
+        return ordered
 
-    return img_np
+    def filter_by_score(self, score_threshold : float) -> DetectionSet:
+        return self.subset(np.flatnonzero(self.scores > score_threshold))
+
+    def to_pixels(self, index=None, img_width=None, img_height=None) -> np.ndarray:
+        # img_width/img_height map the boxes to another resolution of the same image
+        boxes = self.boxes if index is None else self.boxes[index]
+        width = self.img_width if img_width is None else img_width
+        height = self.img_height if img_height is None else img_height
+        scale = np.array([width, height, width, height], dtype=np.float64)
+        # truncation, like int() in Detection.to_pixels
+        return (boxes.astype(np.float64) * scale).astype(np.int64)
+
+    def to_list(self) -> list[Detection]:
+        return list(self)
+
+
+def normalize_image(
+        img_raw, detection_model_input_height, detection_model_input_width,
+        input_dtype=np.float32, input_quantization=(0.0, 0),
+    ):
+    resized = cv2.resize(img_raw, (detection_model_input_height, detection_model_input_width))
+    if resized.ndim == 2:
+        # grayscale decode, the models take 3 channels
+        resized = cv2.cvtColor(resized, cv2.COLOR_GRAY2BGR)
+    if np.dtype(input_dtype).kind == 'f':
+        image_resized = resized / 255
+        img_np = np.expand_dims(image_resized, axis=0).astype(np.float32)
+
+        return img_np
+
+    # integer model: quantize the [0, 1] pixels in one step with a lookup table
+    scale, zero_point = input_quantization
+    if input_dtype == np.uint8 and zero_point == 0 and (scale == 0 or abs(scale * 255 - 1) < 1e-6):
+        # the model already expects raw 0-255 pixels
+        return np.expand_dims(resized, axis=0)
+    limits = np.iinfo(input_dtype)
+    lookup = np.clip(
+        np.round(np.arange(256) / (255 * scale) + zero_point), limits.min, limits.max
+    ).astype(input_dtype)
+    return np.expand_dims(lookup[resized], axis=0)
 
 
 # FUNCTIONS
@@ -116,13 +295,37 @@ def set_input_tensor(interpreter, image):
     input_tensor[:, :] = image
 
 
+def dequantize(tensor, output_details):
+    if np.issubdtype(tensor.dtype, np.floating):
+        return tensor
+    scale, zero_point = output_details["quantization"]
+    if scale == 0:
+        return tensor.astype(np.float32)
+    return (tensor.astype(np.float32) - zero_point) * scale
+
+
 def get_output_tensor(interpreter, index):
     output_details = interpreter.get_output_details()[index]
     tensor = np.squeeze(interpreter.get_tensor(output_details["index"]))
-    return tensor
+    return dequantize(tensor, output_details)
 
 
-def detect_objects(interpreter, normalized_image, raw_image):
+def get_output_tensors(interpreter):
+    # scores, boxes, count, classes with the batch dimension kept
+    output_details = interpreter.get_output_details()
+    return [
+        dequantize(interpreter.get_tensor(output_details[i]["index"]), output_details[i])
+        for i in range(4)
+    ]
+
+
+def decode_detections(scores, boxes, count, classes, raw_image, label_map=None) -> DetectionSet:
+    return DetectionSet.from_output(
+        scores, boxes, count, classes, raw_image.shape[1], raw_image.shape[0], label_map
+    )
+
+
+def detect_objects(interpreter, normalized_image, raw_image, label_map=None):
     set_input_tensor(interpreter, normalized_image)
     interpreter.invoke()
 
@@ -131,30 +334,66 @@ def detect_objects(interpreter, normalized_image, raw_image):
     count = int(get_output_tensor(interpreter, 2))
     classes = get_output_tensor(interpreter, 3)
 
-    detections = []
-    for i in range(count):
-        try:
-            ymin, xmin, ymax, xmax = boxes[i].tolist()
-            box = FloatBoundingBox.from_floats(xmin, ymin, xmax, ymax)
-            detections.append(
-                Detection(
-                    box,
-                    classes[i],
-                    scores[i],
-                    raw_image.shape[1],
-                    raw_image.shape[0],
-                )
-            )
-        except Exception as e:
-            print(e)
-    return detections
+    return decode_detections(scores, boxes, count, classes, raw_image, label_map)
+
+
+def detect_objects_in_batch(detection_model, normalized_images, raw_images):
+    # normalized_images has one of the model's batch sizes, the rows past raw_images are padding
+    detection_model.resize_batch(len(normalized_images))
+    interpreter = detection_model.interpreter
+    interpreter.set_tensor(detection_model.input_index, normalized_images)
+    interpreter.invoke()
+
+    scores, boxes, counts, classes = get_output_tensors(interpreter)
+    if scores.shape[0] != len(normalized_images):
+        raise ValueError(f'expected a batch of {len(normalized_images)} outputs, got {scores.shape[0]}')
+
+    return [
+        decode_detections(
+            scores[i], boxes[i], int(counts[i]), classes[i], raw_image, detection_model.label_map
+        )
+        for i, raw_image in enumerate(raw_images)
+    ]
 
 
-def detect_objects_on_Image_object(detection_model, img_raw) -> list[Detection]:
+def detect_objects_on_Image_object(detection_model, img_raw) -> DetectionSet:
     normalized_img = normalize_image(
-        img_raw, detection_model.input_height, detection_model.input_width
+        img_raw, detection_model.input_height, detection_model.input_width,
+        detection_model.input_dtype, detection_model.input_quantization,
+    )
+    detection_model.resize_batch(1)
+    detections = detect_objects(
+        detection_model.interpreter, normalized_img, img_raw, detection_model.label_map
     )
-    detections = detect_objects(detection_model.interpreter, normalized_img, img_raw)
 
     return detections
 
+
+def detect_objects_on_Image_batch(detection_model, imgs_raw) -> list[DetectionSet]:
+    if not detection_model.supports_batch:
+        return [detect_objects_on_Image_object(detection_model, img_raw) for img_raw in imgs_raw]
+
+    detections = []
+    step = detection_model.max_batch_size
+    for start in range(0, len(imgs_raw), step):
+        chunk = imgs_raw[start:start + step]
+        # padded with blank images up to a fixed batch size, their outputs are dropped
+        normalized_imgs = np.zeros(
+            (detection_model.padded_batch_size(len(chunk)), detection_model.input_height,
+             detection_model.input_width, detection_model.input_channels),
+            dtype=detection_model.input_dtype,
+        )
+        for i, img_raw in enumerate(chunk):
+            normalized_imgs[i] = normalize_image(
+                img_raw, detection_model.input_height, detection_model.input_width,
+                detection_model.input_dtype, detection_model.input_quantization,
+            )[0]
+        try:
+            detections.extend(detect_objects_in_batch(detection_model, normalized_imgs, chunk))
+        except (RuntimeError, ValueError) as e:
+            # some ops (e.g. the detection postprocess of older runtimes) only run with batch 1
+            logger.warning(f'{detection_model.name}: batched inference not supported, using batch 1: {e}')
+            detection_model.supports_batch = False
+            detection_model.resize_batch(1)
+            return detections + detect_objects_on_Image_batch(detection_model, imgs_raw[len(detections):])
+    return detections
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+
+from aux import log
+from typing import Callable, Iterable, Iterator
+
+# marks the end of the stream in the queues
+_DONE = object()
+
+
+class Stage():
+
+    def __init__(self, name : str, func : Callable) -> None:
+        self.name : str = name
+        self.func : Callable = func
+        # counters, in seconds
+        self.busy : float = 0.0     # running func
+        self.idle : float = 0.0     # waiting for an input
+        self.blocked : float = 0.0  # waiting for room in the output queue
+        self.processed : int = 0
+
+    def utilization(self) -> float:
+        total = self.busy + self.idle + self.blocked
+        return self.busy / total if total else 0.0
+
+
+class Pipeline():
+    '''
+    Runs each stage in its own thread, connected by bounded queues.
+    Every stage handles one item at a time, so the output keeps the input order.
+    '''
+
+    logger = log.get_new_logger('Pipeline')
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, stages : list[tuple[str, Callable]], queue_size : int = 8) -> None:
+        self.stages : list[Stage] = [Stage(name, func) for name, func in stages]
+        self.queue_size : int = queue_size
+        self._stop = threading.Event()
+        self._error : Exception | None = None
+
+    def run(self, items : Iterable) -> Iterator:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for stage, in_queue, out_queue in zip(self.stages, queues, queues[1:]):
+            threads.append(threading.Thread(
+                target=self._work, args=(stage, in_queue, out_queue), name=stage.name, daemon=True
+            ))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def stats(self) -> str:
+        lines = [f'{"stage":<10} {"items":>7} {"busy(s)":>9} {"idle(s)":>9} {"blocked(s)":>11} {"busy%":>6}']
+        for stage in self.stages:
+            lines.append(
+                f'{stage.name:<10} {stage.processed:>7} {stage.busy:>9.2f} {stage.idle:>9.2f} '
+                f'{stage.blocked:>11.2f} {stage.utilization() * 100:>6.1f}'
+            )
+        return '\n'.join(lines)
+
+    # threads
+    def _feed(self, items, out_queue) -> None:
+        try:
+            for item in items:
+                if not self._put(out_queue, item):
+                    return
+        except Exception as e:
+            self._fail(e)
+            return
+        self._put(out_queue, _DONE)
+
+    def _work(self, stage : Stage, in_queue, out_queue) -> None:
+        while True:
+            start = time.perf_counter()
+            item = self._get(in_queue)
+            stage.idle += time.perf_counter() - start
+            if item is _DONE:
+                self._put(out_queue, _DONE)
+                return
+
+            start = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                self.logger.error(f'stage {stage.name} failed: {e}')
+                self._fail(e)
+                return
+            stage.busy += time.perf_counter() - start
+            stage.processed += 1
+
+            start = time.perf_counter()
+            put = self._put(out_queue, result)
+            stage.blocked += time.perf_counter() - start
+            if not put:
+                return
+
+    # aux functions
+    def _fail(self, error : Exception) -> None:
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _get(self, q : queue.Queue):
+        while True:
+            try:
+                return q.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _DONE
+
+    def _put(self, q : queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import numpy as np
+
+# a new line starts when the vertical gap between two consecutive centers is bigger
+# than this fraction of the median detection height (the old pairwise sort used 0.9)
+GAP_COEFFICIENT = 0.9
+
+
+def gap_clusters(values : np.ndarray, threshold : float) -> np.ndarray:
+    # 1-D clustering: sort the values and break wherever the gap is above the threshold
+    # returns the cluster index of each value, numbered in ascending order
+    labels = np.empty(len(values), dtype=np.int64)
+    if len(values) == 0:
+        return labels
+    order = np.argsort(values, kind='stable')
+    breaks = np.diff(values[order]) > threshold
+    labels[order] = np.concatenate(([0], np.cumsum(breaks)))
+    return labels
+
+
+def rank_in_groups(groups : np.ndarray, order : np.ndarray) -> np.ndarray:
+    # position of each element inside its group, following the given order
+    # order must list the elements sorted by group
+    ranks = np.empty(len(groups), dtype=np.int64)
+    sorted_groups = groups[order]
+    starts = np.searchsorted(sorted_groups, sorted_groups, side='left')
+    ranks[order] = np.arange(len(groups)) - starts
+    return ranks
+
+
+def reading_order(
+        centers : np.ndarray, heights : np.ndarray, gap_coefficient : float = GAP_COEFFICIENT
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Sorts detections from top left to bottom right.
+    centers is [N, 2] (x, y) and heights is [N], both in the same units.
+    Returns the row and column of each detection and the indices that sort them.
+    '''
+    if len(centers) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    threshold = gap_coefficient * float(np.median(heights))
+    rows = gap_clusters(centers[:, 1], threshold)
+    # rows first, then left to right inside each row
+    order = np.lexsort((centers[:, 0], rows))
+    columns = rank_in_groups(rows, order)
+    return rows, columns, order
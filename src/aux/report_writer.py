@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import json
+
+from aux import log
+from pathlib import Path
+
+
+class ReportWriter():
+    '''
+    Writes the final report one sheet at a time, so nothing is kept in memory
+    and the sheets already built survive a crash.
+    json  : a single object {name: report}, closed when the writer is closed
+    jsonl : one {"name": name, "report": report} object per line, with append the lines
+            go after the ones of the previous runs and the last line of a sheet wins
+    '''
+
+    logger = log.get_new_logger('ReportWriter')
+
+    FORMATS = ('json', 'jsonl')
+
+    def __init__(self, path : Path, output_format : str = 'json', append : bool = False) -> None:
+        if output_format not in self.FORMATS:
+            raise ValueError(f'invalid report format: {output_format}')
+        if append and output_format != 'jsonl':
+            raise ValueError('only a jsonl report can be appended to')
+        self.path : Path = Path(path)
+        self.output_format : str = output_format
+        self.append : bool = append
+        self.count : int = 0
+        self._file = None
+
+    def __enter__(self) -> ReportWriter:
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def open(self) -> None:
+        self.logger.info(f'writing report: {self.path.resolve()}')
+        self._file = open(self.path, 'a' if self.append else 'w')
+        if self.append and self._file.tell() and not _ends_with_newline(self.path):
+            # the last line of a previous run cut by a crash
+            self._file.write('\n')
+        if self.output_format == 'json':
+            self._file.write('{')
+
+    def write(self, name : str, report) -> None:
+        if self.output_format == 'json':
+            separator = ',\n' if self.count else '\n'
+            self._file.write(f'{separator}{json.dumps(name)}: {json.dumps(report)}')
+        else:
+            self._file.write(json.dumps({'name': name, 'report': report}) + '\n')
+        self._file.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if self.output_format == 'json':
+            self._file.write('\n}\n')
+        self._file.close()
+        self._file = None
+        self.logger.info(f'{self.count} sheets in {self.path}')
+
+
+def read_report(path : Path) -> dict:
+    # final_report.json or final_report.jsonl as {name: report}
+    path = Path(path)
+    with open(path) as f:
+        if path.suffix != '.jsonl':
+            return json.load(f)
+        reports = {}
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                sheet = json.loads(line)
+            except json.JSONDecodeError:
+                # last line cut by a crash
+                ReportWriter.logger.warning(f'ignoring broken report line: {line!r}')
+                continue
+            reports[sheet['name']] = sheet['report']
+        # a null report removes the answers of an earlier line of the sheet
+        return {name: report for name, report in reports.items() if report is not None}
+
+
+def _ends_with_newline(path : Path) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(-1, 2)
+        return f.read(1) == b'\n'
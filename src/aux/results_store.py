@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Iterator
+
+from aux import log
+from aux.columnar import CropDetections
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sheets (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    status TEXT,
+    content_hash TEXT,
+    cpf TEXT,
+    ec TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS crops (
+    id INTEGER PRIMARY KEY,
+    sheet_id INTEGER NOT NULL REFERENCES sheets(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS detections (
+    crop_id INTEGER NOT NULL REFERENCES crops(id) ON DELETE CASCADE,
+    class_name TEXT NOT NULL,
+    score REAL NOT NULL,
+    xmin REAL NOT NULL,
+    ymin REAL NOT NULL,
+    xmax REAL NOT NULL,
+    ymax REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS check_results (
+    sheet_id INTEGER NOT NULL REFERENCES sheets(id) ON DELETE CASCADE,
+    crop TEXT,
+    stage INTEGER NOT NULL,
+    checker TEXT NOT NULL,
+    check_name TEXT NOT NULL,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS answers (
+    sheet_id INTEGER NOT NULL REFERENCES sheets(id) ON DELETE CASCADE,
+    question INTEGER NOT NULL,
+    answer TEXT,
+    PRIMARY KEY (sheet_id, question)
+);
+CREATE INDEX IF NOT EXISTS sheets_cpf ON sheets(cpf);
+CREATE INDEX IF NOT EXISTS sheets_status ON sheets(status);
+CREATE INDEX IF NOT EXISTS crops_sheet ON crops(sheet_id);
+CREATE INDEX IF NOT EXISTS detections_crop ON detections(crop_id);
+CREATE INDEX IF NOT EXISTS check_results_checker ON check_results(checker, check_name);
+CREATE INDEX IF NOT EXISTS check_results_sheet ON check_results(sheet_id);
+'''
+
+
+class ResultsStore():
+    '''
+    SQLite database (WAL mode) with the sheets, their crops and detections, the checks
+    they failed and the built answers. The writes are grouped in transactions of
+    batch_size sheets, call close() to commit the last one.
+    '''
+
+    logger = log.get_new_logger('ResultsStore')
+
+    def __init__(self, path : Path, batch_size : int = 256) -> None:
+        self.path : Path = Path(path)
+        self.batch_size : int = batch_size
+        # transactions are opened and committed by hand
+        self.connection = sqlite3.connect(str(self.path), isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(SCHEMA)
+        self._pending : int = 0
+
+    # writers
+    def add_sheet(
+            self, name : str, status : str, content_hash : str = None,
+            crops : dict[str, list[dict] | CropDetections] = None,
+            failed_checks : list[tuple] = (), answers : dict = None,
+        ) -> None:
+        # failed_checks are (crop name or None, stage, checker, check, message)
+        self._begin()
+        # a sheet scanned again replaces everything stored about it
+        self.connection.execute('DELETE FROM sheets WHERE name = ?', (name,))
+        sheet_id = self.connection.execute(
+            'INSERT INTO sheets (name, status, content_hash, updated_at) VALUES (?, ?, ?, ?)',
+            (name, status, content_hash, _now()),
+        ).lastrowid
+
+        for position, (crop_name, detections) in enumerate((crops or {}).items()):
+            crop_id = self.connection.execute(
+                'INSERT INTO crops (sheet_id, name, position) VALUES (?, ?, ?)',
+                (sheet_id, crop_name, position),
+            ).lastrowid
+            if isinstance(detections, CropDetections):
+                detections = detections.to_json()
+            self.connection.executemany(
+                'INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(crop_id, d['class_id'], d['score'], *d['bounding_box']) for d in detections],
+            )
+
+        self.connection.executemany(
+            'INSERT INTO check_results VALUES (?, ?, ?, ?, ?, ?)',
+            [(sheet_id, *failed_check) for failed_check in failed_checks],
+        )
+        if answers is not None:
+            self._insert_answers(sheet_id, answers)
+        self._done()
+
+    def add_answers(self, name : str, answers : dict | str) -> None:
+        # answers built by build_report.py for a sheet already stored (or not)
+        self._begin()
+        self.connection.execute(
+            'INSERT OR IGNORE INTO sheets (name, updated_at) VALUES (?, ?)', (name, _now())
+        )
+        sheet_id, = self.connection.execute(
+            'SELECT id FROM sheets WHERE name = ?', (name,)
+        ).fetchone()
+        self.connection.execute('DELETE FROM answers WHERE sheet_id = ?', (sheet_id,))
+        self._insert_answers(sheet_id, answers)
+        self._done()
+
+    def _insert_answers(self, sheet_id : int, answers : dict | str) -> None:
+        if not isinstance(answers, dict):
+            # 'FILE NOT FOUND'
+            return
+        ec = answers.get('ec')
+        self.connection.execute(
+            'UPDATE sheets SET cpf = ?, ec = ? WHERE id = ?',
+            (answers.get('cpf'), json.dumps(ec) if ec else None, sheet_id),
+        )
+        self.connection.executemany(
+            'INSERT INTO answers VALUES (?, ?, ?)',
+            [
+                (sheet_id, int(question), answer) for question, answer in answers.items()
+                if question not in ('cpf', 'ec')
+            ],
+        )
+
+    def _begin(self) -> None:
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN')
+
+    def _done(self) -> None:
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def commit(self) -> None:
+        if self.connection.in_transaction:
+            self.connection.execute('COMMIT')
+        self._pending = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+    # readers
+    def find_by_cpf(self, cpf : str) -> list[str]:
+        return [name for name, in self.connection.execute(
+            'SELECT name FROM sheets WHERE cpf = ? ORDER BY name', (cpf,)
+        )]
+
+    def failing(self, checker : str, check_name : str = None) -> list[str]:
+        # sheets with at least one failed check of the checker
+        query = 'SELECT DISTINCT s.name FROM check_results c JOIN sheets s ON s.id = c.sheet_id WHERE c.checker = ?'
+        params = [checker]
+        if check_name is not None:
+            query += ' AND c.check_name = ?'
+            params.append(check_name)
+        return [name for name, in self.connection.execute(query + ' ORDER BY s.name', params)]
+
+    def statuses(self) -> dict[str, str]:
+        return dict(self.connection.execute(
+            'SELECT name, status FROM sheets WHERE status IS NOT NULL ORDER BY id'
+        ))
+
+    def detections(self, name : str) -> dict[str, list[dict]]:
+        # same layout as the per-sheet json
+        crops = {}
+        rows = self.connection.execute(
+            'SELECT c.name, d.class_name, d.score, d.xmin, d.ymin, d.xmax, d.ymax '
+            'FROM sheets s JOIN crops c ON c.sheet_id = s.id LEFT JOIN detections d ON d.crop_id = c.id '
+            'WHERE s.name = ? ORDER BY c.position, d.rowid', (name,)
+        )
+        for crop_name, class_name, score, *box in rows:
+            crop = crops.setdefault(crop_name, [])
+            if class_name is not None:
+                crop.append({'class_id': class_name, 'score': score, 'bounding_box': box})
+        return crops
+
+    def answers(self) -> Iterator[tuple[str, dict]]:
+        # same layout as final_report.json
+        for sheet_id, name, cpf, ec in self.connection.execute(
+            'SELECT id, name, cpf, ec FROM sheets WHERE cpf IS NOT NULL ORDER BY id'
+        ).fetchall():
+            report = {'cpf': cpf}
+            report.update(self.connection.execute(
+                'SELECT question, answer FROM answers WHERE sheet_id = ? ORDER BY question', (sheet_id,)
+            ))
+            if ec:
+                report['ec'] = json.loads(ec)
+            yield name, report
+
+
+def _now() -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
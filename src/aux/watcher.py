@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import os
+import time
+
+from aux import log
+from aux.filehandler import FileHandler, in_shard
+
+
+class InputWatcher():
+    '''
+    Finds the images of a folder that are new or changed since they were handed out,
+    once they stayed the same (size and mtime) for settle_time seconds.
+
+    A poll stats each folder and only lists the ones whose mtime changed, then stats the
+    files it has not handed out yet. A file rewritten in place does not change the mtime
+    of its folder, so every full_scan_interval seconds all the files are stat'ed again.
+    '''
+
+    logger = log.get_new_logger('InputWatcher')
+
+    def __init__(
+            self, directory, recursive : bool = True, shard : tuple[int, int] = None,
+            settle_time : float = 2.0, full_scan_interval : float = 60.0,
+        ) -> None:
+        self.root : str = str(directory)
+        self.recursive : bool = recursive
+        self.shard : tuple[int, int] | None = shard
+        self.settle_time : float = settle_time
+        self.full_scan_interval : float = full_scan_interval
+        # folder -> (mtime_ns, images, subfolders) when it was last listed
+        self._folders : dict[str, tuple[int, list[str], list[str]]] = {}
+        # image -> (size, mtime_ns) when it was handed out
+        self._done : dict[str, tuple[int, int]] = {}
+        # image -> (size, mtime_ns, time since it stopped changing)
+        self._pending : dict[str, tuple[int, int, float]] = {}
+        self._last_full_scan : float = time.monotonic()
+
+    def poll(self) -> list[str]:
+        # the images ready to be scanned, sorted by path
+        now = time.monotonic()
+        full_scan = now - self._last_full_scan >= self.full_scan_interval
+        if full_scan:
+            self._last_full_scan = now
+
+        new_images = self._walk()
+        if full_scan:
+            images = [image for _, listed, _ in self._folders.values() for image in listed]
+            # files deleted since they were scanned are forgotten
+            listed = set(images)
+            self._done = {image: stat for image, stat in self._done.items() if image in listed}
+        else:
+            images = new_images + list(self._pending)
+
+        ready = []
+        for image in set(images):
+            if self._is_ready(image, now):
+                ready.append(image)
+        return sorted(ready)
+
+    def _walk(self) -> list[str]:
+        # images of the folders listed again in this poll that were not handed out yet
+        new_images = []
+        seen = set()
+        stack = [self.root]
+        while stack:
+            folder = stack.pop()
+            seen.add(folder)
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                continue
+            cached = self._folders.get(folder)
+            if cached is None or cached[0] != mtime:
+                cached = self._list(folder, mtime)
+                new_images.extend(image for image in cached[1] if image not in self._done)
+            stack.extend(cached[2])
+        # folders removed since the last poll
+        for folder in set(self._folders) - seen:
+            del self._folders[folder]
+        return new_images
+
+    def _list(self, folder : str, mtime : int) -> tuple[int, list[str], list[str]]:
+        images, subfolders = [], []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if self.recursive:
+                            subfolders.append(entry.path)
+                    elif entry.name.lower().endswith(FileHandler.ACCEPTED_IMAGE_EXTENTIONS):
+                        if self.shard is None or in_shard(os.path.relpath(entry.path, self.root), *self.shard):
+                            images.append(entry.path)
+        except OSError as e:
+            self.logger.warning(f'skipping {e.filename}: {e.strerror}')
+        self._folders[folder] = (mtime, images, subfolders)
+        return self._folders[folder]
+
+    def _is_ready(self, image : str, now : float) -> bool:
+        # half written files keep changing size/mtime, wait until they settle
+        try:
+            stat = os.stat(image)
+        except FileNotFoundError:
+            self._pending.pop(image, None)
+            return False
+        current = (stat.st_size, stat.st_mtime_ns)
+        if self._done.get(image) == current:
+            return False
+        size, mtime, since = self._pending.get(image, (None, None, now))
+        if (size, mtime) != current:
+            self._pending[image] = (*current, now)
+            return False
+        if now - since < self.settle_time:
+            return False
+        # a sheet dropped again under the same name is a new version of it
+        del self._pending[image]
+        self._done[image] = current
+        return True
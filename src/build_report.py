@@ -1,39 +1,99 @@
+from __future__ import annotations
+
 import argparse
+import multiprocessing
 import builder
 
+from aux import archive, columnar
+from aux.archive import ArchiveMember
 from aux.filehandler import FileHandler
+from aux.report_writer import ReportWriter
+from aux.results_store import ResultsStore
 from pathlib import Path
 
 from aux import log
 
 logger = log.get_new_logger('build report')
 
-def build_report(falied, ec):
+def get_jobs(falied, ec, input_format='json'):
     
     logger.debug('getting paths...')
     dir_paths : dict[str, list[Path]] = FileHandler.get_input_paths_builder()
-    
-    report = {}
-    
+    # sheet name -> .detcol file with its detections
+    index = columnar.index_files(FileHandler.INPUT_DIR) if input_format == 'columnar' else {}
+    # path of the sheet json inside the zip files -> zip with it
+    archives = archive.index_archives(FileHandler.INPUT_DIR) if input_format == 'archive' else {}
+
+    def source(path):
+        name = path.name.split('.')[0]
+        member = f'{name}/{path.name}'
+        if member in archives:
+            return name, ArchiveMember(archives[member], member)
+        return name, index.get(name, path)
+
     logger.debug('building success reports...')
     for path in dir_paths['success']:
-        logger.error(f'buiding report for {path.name}')
-        name = path.name.split('.')[0]
-        report.update({name : builder.build(path, status='success', ec=False)})
-        logger.warning(f'{path.name} added to report')
+        yield (*source(path), 'success', [])
 
     logger.debug('building falied reports...') 
     if falied:
         for path in dir_paths['falied']:
-            logger.error(f'buiding report for {path.name}')
-            name = path.name.split('.')[0]
-            report.update({name : builder.build(path, status='falied', ec=ec)})
-            if ec:
-                report[name]['ec'] = ec
-            logger.warning(f'{path.name} added to report')
+            yield (*source(path), 'falied', ec)
+
+
+# readers of the .detcol files already opened by this process
+_readers : dict[Path, columnar.ColumnarReader] = {}
+
+def build_sheet(job) -> tuple[str, dict]:
+    name, path, status, ec = job
+    logger.error(f'buiding report for {name}')
+    if isinstance(path, ArchiveMember):
+        report = builder.build_archive(path, name, status=status, ec=ec)
+    elif path.suffix == columnar.EXTENSION:
+        if path not in _readers:
+            _readers[path] = columnar.ColumnarReader(path)
+        report = builder.build_columnar(_readers[path], name, status=status, ec=ec)
+    else:
+        report = builder.build(path, status=status, ec=ec)
+    if ec and isinstance(report, dict):
+        report['ec'] = ec
+    return name, report
+
+
+def _init_worker(prova, continue_on_fail):
+    # the builder config is set again in case the pool does not fork
+    builder.PROVA = prova
+    builder.CONTINUE_ON_FAIL = continue_on_fail
+    builder.load_builder()
+
+
+def build_report(falied, ec, workers=1, output_format='json', input_format='json', store=None):
 
+    jobs = get_jobs(falied, ec, input_format)
+    output_path = FileHandler.OUTPUT_DIR / f'final_report.{output_format}'
 
-    FileHandler.save_report(report)
+    def add(name, report):
+        writer.write(name, report)
+        if store is not None:
+            store.add_answers(name, report)
+        logger.warning(f'{name} added to report')
+
+    # each sheet is written as soon as it is built
+    with ReportWriter(output_path, output_format) as writer:
+        if workers > 1:
+            logger.info(f'building with {workers} worker processes')
+            context = multiprocessing.get_context('fork')
+            with context.Pool(
+                workers, initializer=_init_worker,
+                initargs=(builder.PROVA, builder.CONTINUE_ON_FAIL),
+            ) as pool:
+                # sheets come out in the order they finish
+                results = pool.imap_unordered(build_sheet, jobs, chunksize=8)
+                for name, report in results:
+                    add(name, report)
+        else:
+            for job in jobs:
+                add(*build_sheet(job))
 
 
 def main():
@@ -64,6 +124,23 @@ def main():
     help="log file generation with the specified level defined",
     )
 
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='number of processes building the sheets, the report is then in completion order'
+    )
+    parser.add_argument(
+        '--input_format', default='json', choices=['json', 'columnar', 'archive'],
+        help='read the detections from the per-sheet json files, the .detcol files or the sheets_*.zip files (exam_scanner.py --output_archive)'
+    )
+    parser.add_argument(
+        '--sqlite', default=None,
+        help='also save the answers in this sqlite database (see exam_scanner.py --sqlite)'
+    )
+    parser.add_argument(
+        '--output_format', default='json', choices=ReportWriter.FORMATS,
+        help='final_report.json (a single object) or final_report.jsonl (one sheet per line)'
+    )
+
     args = parser.parse_args()
 
     if args.error_correction is None:
@@ -86,7 +163,15 @@ def main():
     builder.PROVA = args.prova
     builder.CONTINUE_ON_FAIL = args.continue_on_fail
     builder.load_builder()
-    build_report(args.falied_to, args.error_correction)
+    store = ResultsStore(args.sqlite) if args.sqlite is not None else None
+    try:
+        build_report(
+            args.falied_to, args.error_correction, args.workers,
+            args.output_format, args.input_format, store,
+        )
+    finally:
+        if store is not None:
+            store.close()
 
 if __name__ == '__main__':
     main()
@@ -2,7 +2,13 @@ from __future__ import annotations
 
 import json
 
+import numpy as np
+
+from builder.ball_grid import BallGrid
 from builder.dataclasses import Block, BuilderContext
+from aux.archive import ArchiveMember
+from aux.columnar import ColumnarReader
+from aux.reading_order import gap_clusters
 from aux import log
 
 
@@ -27,7 +33,6 @@ def load_builder():
 # main function
 def build(path, status, ec) -> dict:
 
-    context = BuilderContext()
     #loading file
     try:
         with open(path) as f:
@@ -37,6 +42,29 @@ def build(path, status, ec) -> dict:
         if not CONTINUE_ON_FAIL:
             raise e
         return 'FILE NOT FOUND'
+
+    return build_from_data(data, path.name, status=status, ec=ec)
+
+# same as build, from a memory mapped columnar detections file
+def build_columnar(reader : ColumnarReader, sheet_name : str, status, ec) -> dict:
+
+    if sheet_name not in reader:
+        logger.error(f'Sheet not found! : {sheet_name} in {reader.path.resolve()}')
+        if not CONTINUE_ON_FAIL:
+            raise KeyError(sheet_name)
+        return 'FILE NOT FOUND'
+
+    return build_from_data(reader.sheet(sheet_name), sheet_name, status=status, ec=ec)
+
+# same as build, from the json of the sheet in a zip written by exam_scanner.py --output_archive
+def build_archive(member : ArchiveMember, sheet_name : str, status, ec) -> dict:
+    return build_from_data(json.loads(member.read()), sheet_name, status=status, ec=ec)
+
+# same as build, from the detections already in memory ({crop name: detections})
+def build_from_data(data : dict, sheet_name : str, status, ec) -> dict:
+
+    context = BuilderContext(name=sheet_name)
+    data = dict(data)
     #getting cpf block in the context
     logger.info('getting cpf block...')
     for name in data:
@@ -47,9 +75,9 @@ def build(path, status, ec) -> dict:
             logger.debug(f'cpf block found: {cpf_nome}')
             break
     else:
-        logger.error(f'cpf block not found for {path.name}')
+        logger.error(f'cpf block not found for {context.name}')
         if not CONTINUE_ON_FAIL:
-            raise Exception(f'cpf block not found for {path.name}')
+            raise Exception(f'cpf block not found for {context.name}')
     #getting questions blocks in the context
     logger.info('getting questions blocks...')
     for i, block in enumerate(data):
@@ -62,30 +90,19 @@ def build(path, status, ec) -> dict:
 class Builder():
 
     @classmethod
-    def set_cpf_ec_pipeline(cls, context):
-        cls.build_cpf = cls.build_cpf_ec
-
+    def get_grid(cls, block : Block) -> BallGrid:
+        # built once per block, shared by the cpf and questions readers
+        if block.grid is None:
+            block.grid = BallGrid.from_detections(block.detections)
+        return block.grid
 
     @classmethod
     def build_cpf(cls, cpf_block : Block) -> str:
         logger.debug(f'build_cpf : {cpf_block.name}')
-        cpf = ''
-        ball_columns = cls.get_ball_columns(0.02, cpf_block.detections)
-
-        cont = 0
-        while cont < 11:
-            try:
-                answer_index = cls._get_selected_ball_position('columns', 10, ball_columns[cont])
-            except IndexError:
-                break
-            if answer_index is not None:
-                cpf += str(answer_index)
-            else:
-                cpf += 'X'
-            cont += 1
-        if cont < 11:
-            cpf += 'X' * (11 - cont)
-        return cpf
+        # digit of each column, the first 11 columns of 10 balls
+        answers = cls.get_grid(cpf_block).read_columns(10)[:11]
+        cpf = ''.join(str(answer) if answer >= 0 else 'X' for answer in answers.tolist())
+        return cpf + 'X' * (11 - len(answers))
 
     @classmethod
     def get_ball_lines(cls, distance_threshold, detections : list[dict]):
@@ -99,92 +116,26 @@ class Builder():
     @classmethod
     def build_cpf_ec(cls, cpf_block : Block):
         logger.debug(f'build_cpf_ec : {cpf_block.name}')
-        max_values = cls._get_cpf_lines_max_y_value(cpf_block)
-        if max_values is None:
-            return "XXXXXXXXXXX"
-        columns = cls.get_ball_columns(0.02, cpf_block.detections)
-        if len(columns) != 11:
+        grid = cls.get_grid(cpf_block)
+        if grid.num_lines != 10 or grid.num_columns != 11:
             return "XXXXXXXXXXX"
-        cpf = ''
-
-        for i, column in enumerate(columns):
-            selected_ball = cls._have_unique_selected_ball(column)
-            if selected_ball is None:
-                cpf += 'X'
-                continue
-
-            for i, val in enumerate(max_values):
-                if selected_ball['bounding_box'][3] <= val:
-                    cpf += str(i)
-                    break
-        
-        return cpf
+
+        # the digit is the first line that ends below the only selected ball of the column
+        balls = grid.unique_selected_in_columns()
+        digits = np.searchsorted(grid.line_bottoms(), grid.ymax[balls], side='left')
+        return ''.join(
+            str(digit) if ball >= 0 else 'X' for ball, digit in zip(balls.tolist(), digits.tolist())
+        )
         
 
     # aux functions
     @classmethod
     def _get_balls(cls, axis, distance_threshold, detections : list[dict]) -> list[list[dict]]:
-        sorted_detections = cls._sort_axis(axis, detections)
         index = 3 if axis == 'y' else 2
-        ball_lines = []
-
-        ball_line = [sorted_detections.pop(0)]
-        while len(sorted_detections) > 0:
-            if abs(
-                sorted_detections[0]['bounding_box'][index] - ball_line[-1]['bounding_box'][index]
-            ) > distance_threshold:
-                ball_lines.append(ball_line)
-                ball_line = [sorted_detections.pop(0)] 
-            else:
-                ball_line.append(sorted_detections.pop(0))
-        ball_lines.append(ball_line)
+        values = np.array([d['bounding_box'][index] for d in detections], dtype=np.float64)
+        groups = gap_clusters(values, distance_threshold)
 
+        ball_lines = [[] for _ in range(int(groups.max()) + 1 if len(groups) else 0)]
+        for i in np.argsort(values, kind='stable').tolist():
+            ball_lines[groups[i]].append(detections[i])
         return ball_lines
-
-    @classmethod
-    def _sort_axis(cls, axis : str, data : list[dict]) -> list[dict]:
-            if axis.lower() == 'y':
-                return sorted(data, key=lambda d: d['bounding_box'][3])
-            elif axis.lower() == 'x':
-                return sorted(data, key=lambda d: d['bounding_box'][2])
-    
-    @classmethod
-    def _get_selected_ball_position(cls, type, num_elements, detections : list[dict]) -> list[dict]:
-        logger.debug(f'getting selected ball position in {type}...')
-        logger.debug(f'detections: {detections}')
-        if len(detections) != num_elements:
-            return None
-        axis = 'y' if type == 'columns' else 'x'
-        sorted_detections = cls._sort_axis(axis, detections)
-        cont = 0
-        while True:
-            try:
-                if sorted_detections[cont]['class_id'] == 'selected_ball':
-                    break
-            except IndexError:
-                return None
-            else:
-                cont += 1
-        return cont
-    
-    @classmethod
-    def _get_cpf_lines_max_y_value(cls, cpf_block : Block) -> list[tuple[float, float]]:
-        max = []
-        lines = cls.get_ball_lines(0.05, cpf_block.detections)
-        if len(lines) != 10:
-            return None        
-        for line in lines:
-            max.append(line[-1]['bounding_box'][3])
-        return max
-
-    @classmethod
-    def _have_unique_selected_ball(cls, detections : list[dict]) -> dict:
-        cont = 0
-        detection = None
-        for d in detections:
-            if d['class_id'] == 'selected_ball':
-                cont += 1
-                detection = d
-        if cont == 1:
-            return detection
-        return None
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import numpy as np
+
+from aux.columnar import CropDetections
+from aux.reading_order import gap_clusters, rank_in_groups
+
+# normalized gaps that split the balls of a block in lines (bottom edges) and columns (right edges)
+LINE_THRESHOLD = 0.05
+COLUMN_THRESHOLD = 0.02
+
+_NONE = np.iinfo(np.int64).max
+
+
+class BallGrid():
+    '''
+    Balls of a block as arrays, with the line and the column of every ball found
+    in a single gap clustering pass per axis.
+    Lines are numbered from top to bottom and columns from left to right.
+    '''
+
+    def __init__(
+            self, boxes : np.ndarray, selected : np.ndarray,
+            line_threshold : float = LINE_THRESHOLD, column_threshold : float = COLUMN_THRESHOLD,
+        ) -> None:
+        # float32 like the model outputs, the boxes of a columnar file are used without a copy
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.xmax : np.ndarray = boxes[:, 2]
+        self.ymax : np.ndarray = boxes[:, 3]
+        self.selected : np.ndarray = np.asarray(selected, dtype=bool)
+
+        self.lines : np.ndarray = gap_clusters(self.ymax, line_threshold)
+        self.columns : np.ndarray = gap_clusters(self.xmax, column_threshold)
+        self.num_lines : int = int(self.lines.max()) + 1 if len(boxes) else 0
+        self.num_columns : int = int(self.columns.max()) + 1 if len(boxes) else 0
+        # position of each ball inside its line (left to right) and its column (top to bottom)
+        self.line_positions : np.ndarray = self._positions(self.lines, self.xmax, self.ymax)
+        self.column_positions : np.ndarray = self._positions(self.columns, self.ymax, self.xmax)
+
+    @classmethod
+    def from_detections(cls, detections : list[dict] | CropDetections) -> BallGrid:
+        # the dicts of the detections json or the arrays of a columnar file
+        if isinstance(detections, CropDetections):
+            return cls(detections.boxes, detections.class_mask('selected_ball'))
+        return cls(
+            [d['bounding_box'] for d in detections],
+            [d['class_id'] == 'selected_ball' for d in detections],
+        )
+
+    @staticmethod
+    def _positions(groups : np.ndarray, values : np.ndarray, group_values : np.ndarray) -> np.ndarray:
+        # ties keep the order along the grouping axis, like a stable sort of each group
+        tie_rank = np.empty(len(groups), dtype=np.int64)
+        tie_rank[np.argsort(group_values, kind='stable')] = np.arange(len(groups))
+        order = np.lexsort((tie_rank, values, groups))
+        return rank_in_groups(groups, order)
+
+    def read_lines(self, size : int) -> np.ndarray:
+        # position of the first selected ball of each line, -1 if the line does not have size balls
+        return self._read(self.lines, self.line_positions, self.num_lines, size)
+
+    def read_columns(self, size : int) -> np.ndarray:
+        return self._read(self.columns, self.column_positions, self.num_columns, size)
+
+    def _read(self, groups : np.ndarray, positions : np.ndarray, num_groups : int, size : int) -> np.ndarray:
+        first = np.full(num_groups, _NONE, dtype=np.int64)
+        np.minimum.at(first, groups[self.selected], positions[self.selected])
+        complete = np.bincount(groups, minlength=num_groups) == size
+        return np.where(complete & (first != _NONE), first, -1)
+
+    def unique_selected_in_columns(self) -> np.ndarray:
+        # index of the only selected ball of each column, -1 if there are none or many
+        counts = np.bincount(self.columns[self.selected], minlength=self.num_columns)
+        balls = np.full(self.num_columns, -1, dtype=np.int64)
+        selected = np.flatnonzero(self.selected)
+        balls[self.columns[selected]] = selected
+        return np.where(counts == 1, balls, -1)
+
+    def line_bottoms(self) -> np.ndarray:
+        # lowest edge of each line, increasing from top to bottom
+        bottoms = np.full(self.num_lines, -np.inf, dtype=self.ymax.dtype)
+        np.maximum.at(bottoms, self.lines, self.ymax)
+        return bottoms
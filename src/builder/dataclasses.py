@@ -2,11 +2,14 @@ from __future__ import annotations
 
 from dataclasses import dataclass,field
 
+from builder.ball_grid import BallGrid
+
 @dataclass
 class Block():
     name: str = field(default='')
     order: int = field(default=None)
     detections: list[dict] = field(default_factory=list)
+    grid: BallGrid = field(default=None, repr=False)
 
 @dataclass
 class BuilderContext:
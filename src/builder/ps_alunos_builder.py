@@ -14,11 +14,12 @@ def build(context : BuilderContext, status, ec) -> None:
     report = {}
 
 
-    if 'cpf' in ec: PSAlunosBuilder.set_cpf_ec_pipeline(context)
+    # chosen per sheet, success and falied sheets can be built in any order
+    build_cpf = PSAlunosBuilder.build_cpf_ec if 'cpf' in ec else PSAlunosBuilder.build_cpf
 
     if context.cpf_block is not None:
         logger.debug('building cpf from cpf_block...')
-        report['cpf'] = PSAlunosBuilder.build_cpf(context.cpf_block)
+        report['cpf'] = build_cpf(context.cpf_block)
     else:
         report['cpf'] = 'XXXXXXXXXXX'
 
@@ -38,26 +39,13 @@ class PSAlunosBuilder(Builder):
         logger.debug(f'building block: {block.name}')
         block_number = (block.order * 10) + 1
 
+        # letter of each line, the first 10 lines of 5 balls
+        answers = cls.get_grid(block).read_lines(5).tolist()
         block_report = {}
-
-        line_balls = cls.get_ball_lines(0.05, block.detections)
-        cont = 0
-        while cont < 10:
-            try:
-                answer_index = cls._get_selected_ball_position('x', 5, line_balls[cont])
-            except IndexError:
-                for i in range(cont, 10):
-                    block_report[block_number + i] = 'NAO DETECTADO'
-                break
-
-            if answer_index is not None:
-                answer = cls.LETTER_MAP[answer_index]
+        for i in range(10):
+            if i < len(answers) and answers[i] >= 0:
+                block_report[block_number + i] = cls.LETTER_MAP[answers[i]]
             else:
-                answer = 'NAO DETECTADO'
-
-            block_report[block_number + cont] = answer
-            cont += 1
-
-
+                block_report[block_number + i] = 'NAO DETECTADO'
 
         return block_report
@@ -1,100 +1,185 @@
 from __future__ import annotations
 
+import time
+
+import numpy as np
 import aux.log as log
+import checks.layout as layout
+import checks.vectorized as vectorized
 
 from aux.object_detection import Detection
 from math import sqrt
 from aux.image import Image
 from aux.data_classes import FloatPoint, FloatBoundingBox
 from typing import Callable
+from dataclasses import dataclass, field
 
 
-#File configs
+#File configs, the defaults of the check runs set once by the scripts
 FILTER_DETECTIONS = None
 FILTER_ONLY = None
 CONTINUE_ON_FAIL = None
+# the first failed check fails the image, the checks run in the order of RULE_RANKS
+FAST_REJECT = None
+# 'Checker.check' -> rank from the stats of previous runs (see checks/planner.py)
+RULE_RANKS : dict[str, float] = {}
+# check that the balls and numbers of the question blocks are inside their question lines
+CLUSTER_CHECK = None
 
 logger = log.checks_logger
 
 
 def load_checker(flag_prova : str):
-    global _checker
+    '''
+    Loads the layout plan of the exam (checks/layouts/<prova>.json) and the module with
+    its checks: ps_alunos_checks for PS, which adds its own checks to the layout ones.
+    '''
+    global _checker, _plan
+    if flag_prova not in ('PS', 'SIMUFSC', 'SIMUENEM'):
+        raise ValueError(f'Prova inavlida: {flag_prova}')
+    try:
+        _plan = layout.load_plan(flag_prova)
+    except FileNotFoundError:
+        raise NotImplementedError(f'{flag_prova} has no layout spec in {layout.LAYOUTS_DIR}')
+
+    import checks.layout_checks as layout_checks
+    layout_checks.register(_plan)
     if flag_prova == 'PS':
         import checks.ps_alunos_checks as _checker
-    elif flag_prova == 'SIMUFSC':
-        raise NotImplementedError
-    elif flag_prova == 'SIMUENEM':
-        raise NotImplementedError
     else:
-        raise ValueError(f'Prova inavlida: {flag_prova}')
+        _checker = layout_checks
 
 # MAIN FUNCTION
-def perform(img : Image, stage : int):
+def perform(
+        img : Image, stage : int, filter_detections : bool = None, continue_on_fail : bool = None,
+        fast_reject : bool = None,
+    ):
+    '''
+    Checks the detections of one image. All the state of the run is in its CheckContext,
+    so many images can be checked at once from different threads.
+    '''
+    context = CheckContext(
+        img, stage,
+        FILTER_DETECTIONS if filter_detections is None else filter_detections,
+        CONTINUE_ON_FAIL if continue_on_fail is None else continue_on_fail,
+        bool(FAST_REJECT) if fast_reject is None else fast_reject,
+        bool(CLUSTER_CHECK),
+        _plan,
+        RULE_RANKS,
+    )
 
     logger.error(f' ---- Performing checks on {img.name} ---- ')
 
-    Checker.IMG_INSTANCE = img
-    
     try:
-        _checker.setup_detections(img.detections, FILTER_DETECTIONS, stage)
-        _checker.perform_checks(stage)
+        _checker.setup_detections(context)
+        _checker.perform_checks(context)
     except AssertionError:
         logger.error(f' --------- {img.name} FAILED --------- ')
-        if not CONTINUE_ON_FAIL:
+        if not (context.continue_on_fail or context.fast_reject):
             raise
         return 'failed'
+    finally:
+        img.failed_checks = list(context.failures)
+        img.check_timings = list(context.timings)
 
     logger.error(f' --------- {img.name} PASSED --------- ')
     return 'success'
 
 
-'''
-Sorry for this meta mess i didant find a cleaner way to do this 
-The metaclass below is to ensure every Check child class gets
-his own copy of the detections list and checks list
-'''
+@dataclass
+class CheckContext():
+    # a check run on one image: its settings, results and checker instances
+    img : Image = field(default=None)
+    stage : int = field(default=None)
+    filter_detections : bool = field(default=False)
+    continue_on_fail : bool = field(default=False)
+    fast_reject : bool = field(default=False)
+    cluster_check : bool = field(default=False)
+    plan : layout.CheckPlan = field(default=None)
+    ranks : dict[str, float] = field(default_factory=dict)
+    # checks failed by the image: (checker, check, message)
+    failures : list[tuple[str, str, str]] = field(default_factory=list)
+    # (checker, check, seconds, failed) of the check rules run
+    timings : list[tuple[str, str, float, bool]] = field(default_factory=list)
+    checkers : dict[type, Checker] = field(default_factory=dict)
+
+    def checker(self, checker_class : type) -> Checker:
+        # the instance of checker_class for this image, created on first use
+        if checker_class not in self.checkers:
+            self.checkers[checker_class] = checker_class(self)
+        return self.checkers[checker_class]
+
+    @property
+    def stop_on_fail(self) -> bool:
+        return self.fast_reject or not self.continue_on_fail
+
+
 # CHECKER CLASS
-class Meta(type):
-    def __init__(cls, name, bases, attrs):
-        cls.detections = []
+class Checker():
+    '''
+    Checks the detections of one class in one image. The expected values are class
+    constants, the detections and the results belong to the instance made by the
+    CheckContext of the image.
+    '''
+
+    logger = log.get_new_logger('Checker')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
         cls.logger = log.get_new_logger(cls.__name__)
-        cls.fail = False
-        super().__init__(name, bases, attrs)
-    
 
-class Checker(metaclass=Meta):
-    
-    IMG_INSTANCE : Image = None
+    def __init__(self, context : CheckContext) -> None:
+        self.context : CheckContext = context
+        self.img : Image = context.img
+        self.detections : list[Detection] = []
+        self.to_remove : list[Detection] = []
+        self.fail : bool = False
 
     #public getters
-    @classmethod
-    def get_detections(cls) -> list[Detection]:
-        return cls.detections
+    def get_detections(self) -> list[Detection]:
+        return self.detections
+
+    # rules: the checks of a checker as names, each one run by a _rule_<name> method,
+    # timed on its own and ordered by checks/planner.py
+
+    def rules(self) -> list[str]:
+        return []
+
+    def run_rule(self, rule : str) -> None:
+        failures = len(self.context.failures)
+        start = time.perf_counter()
+        failed = True
+        try:
+            getattr(self, f'_rule_{rule}')()
+            failed = len(self.context.failures) > failures
+        finally:
+            self.context.timings.append((type(self).__name__, rule, time.perf_counter() - start, failed))
     
     # wrapper functions
     def has_detections(func) -> Callable:
-        def wrapper(cls, *args, **kwargs):
-            if len(cls.detections) == 0:
-                cls.logger.warning(f'No detections found!')
+        def wrapper(self, *args, **kwargs):
+            if len(self.detections) == 0:
+                self.logger.warning(f'No detections found!')
                 return []
             else:
-                return func(cls, *args, **kwargs)
+                return func(self, *args, **kwargs)
         return wrapper
     
     def execute(func) -> Callable:
-        def wrapper(cls, *args, **kwargs):
+        def wrapper(self, *args, **kwargs):
             try:
-                func(cls, *args, **kwargs)
-                cls.logger.debug(f'[ PASSED ] {func.__name__} {args} {kwargs}')
+                func(self, *args, **kwargs)
+                self.logger.debug(f'[ PASSED ] {func.__name__} {args} {kwargs}')
             except AssertionError as e:
                 if kwargs.get('filter', False):
-                    cls.logger.info(f'[ REMOVED DETECTION ] {func.__name__}: {e}')
-                    cls.logger.debug(f'Delecting detections: {e.args[1]}')
-                    cls.to_remove.extend(e.args[1])
+                    self.logger.info(f'[ REMOVED DETECTION ] {func.__name__}: {e}')
+                    self.logger.debug(f'Delecting detections: {e.args[1]}')
+                    self.to_remove.extend(e.args[1])
                 else:
-                    cls.logger.error(f'[ FALIED ] {func.__name__}: {e}')
-                    cls.fail = True
-                    if not CONTINUE_ON_FAIL:
+                    self.logger.error(f'[ FALIED ] {func.__name__}: {e}')
+                    self.fail = True
+                    self.context.failures.append((type(self).__name__, func.__name__, str(e.args[0]) if e.args else ''))
+                    if self.context.stop_on_fail:
                         raise e
 
             except Exception as e:
@@ -103,11 +188,10 @@ class Checker(metaclass=Meta):
         return wrapper
 
     # checks
-    @classmethod
     @execute
-    def count(cls, expected_value : int, detections_type : str, **kwargs) -> bool:
+    def count(self, expected_value : int, detections_type : str, **kwargs) -> bool:
         count = 0
-        for detection in cls.detections:
+        for detection in self.detections:
             if detection.class_name == detections_type:
                 count += 1
         
@@ -116,57 +200,45 @@ class Checker(metaclass=Meta):
                 f'count == {expected_value}  ::  {count} == {expected_value}'
             )
 
-    @classmethod
     @execute
     def center_is_near_of(
-            cls, detection : Detection, point : FloatPoint, radius : float=None, **kwargs
+            self, detection : Detection, point : FloatPoint, radius : float=None, **kwargs
         ) -> bool:
         # O raio é sempre em porcentagem da medida da altura da imagem
-        radius = radius * cls.IMG_INSTANCE.height
-        distance = cls._get_distance_between_points(detection.middle_point, point)
+        radius = radius * self.img.height
+        distance = self._get_distance_between_points(detection.middle_point, point)
         if not distance <= radius:
             raise AssertionError(
                 f'distance <= radius  ::  {distance} <= {radius}',
                 [detection]
             )
         
-    @classmethod
     @execute
-    def horizontally_alling(cls, detections : list[Detection], tolerance = None, **kwargs) -> bool:
-        average_y : float = sum([detection.middle_point.y for detection in detections]) / len(detections)
-        result = None
-        bad_detections = []
-        for detection in detections:
-            if abs(detection.middle_point.y - average_y) > tolerance:
-                bad_detections.append(detection)
-        if bad_detections:
-            string = ' '.join([f'{abs(detection.middle_point.y - average_y)} <= {tolerance}' for detection in bad_detections])
+    def horizontally_alling(self, detections : list[Detection], tolerance = None, **kwargs) -> bool:
+        centers, _ = vectorized.detection_arrays(detections)
+        bad, deviations = vectorized.alling(centers[:, 1], tolerance)
+        if bad.any():
+            string = ' '.join([f'{deviation} <= {tolerance}' for deviation in deviations[bad].tolist()])
             raise AssertionError(
                 f'abs(detection.middle_point.y - average_y) <= tolerance  ::  {string}',
-                bad_detections
+                [detections[i] for i in np.flatnonzero(bad)]
             )
 
-    @classmethod
     @execute
-    def vertically_alling(cls, detections : list[Detection], tolerance = None, **kwargs) -> bool:
-        average_x : float = sum([detection.middle_point.x for detection in detections]) / len(detections)
-        result = None
-        bad_detections = []
-        for detection in detections:
-            if abs(detection.middle_point.x - average_x) > tolerance:
-                bad_detections.append(detection)
-        if bad_detections:
-            string = ' '.join([f'{abs(detection.middle_point.x - average_x)} <= {tolerance}' for detection in bad_detections])
+    def vertically_alling(self, detections : list[Detection], tolerance = None, **kwargs) -> bool:
+        centers, _ = vectorized.detection_arrays(detections)
+        bad, deviations = vectorized.alling(centers[:, 0], tolerance)
+        if bad.any():
+            string = ' '.join([f'{deviation} <= {tolerance}' for deviation in deviations[bad].tolist()])
             raise AssertionError(
                 f'abs(detection.middle_point.x - average_x) <= tolerance  ::  {string}',
-                bad_detections
+                [detections[i] for i in np.flatnonzero(bad)]
             )
 
-    @classmethod
     @execute
-    def contains(bigger : Detection, smaller : Detection, **kwargs):
+    def contains(self, bigger : Detection, smaller : Detection, **kwargs):
         middle : FloatPoint = smaller.middle_point
-        ymin, xmin, ymax, xmax = bigger.bounding_box
+        xmin, ymin, xmax, ymax = bigger.bounding_box
         result = ymin <= middle.y <= ymax and xmin <= middle.x <= xmax
         if not result:
             raise AssertionError(
@@ -174,10 +246,9 @@ class Checker(metaclass=Meta):
                 [bigger, smaller]
             )
 
-    @classmethod
     @execute
     def aspect_ratio(
-        cls, detection : Detection, expected_ratio : float, tolerance : float = None, **kwargs
+        self, detection : Detection, expected_ratio : float, tolerance : float = None, **kwargs
         ) -> bool:
         if not abs(detection.aspect_ratio - expected_ratio)/expected_ratio <= tolerance:
             raise AssertionError(
@@ -185,9 +256,8 @@ class Checker(metaclass=Meta):
                 [detection]
             )
 
-    @classmethod
     @execute
-    def inside_box(cls, detection : Detection, bound_box : FloatBoundingBox, **kwargs) -> bool:
+    def inside_box(self, detection : Detection, bound_box : FloatBoundingBox, **kwargs) -> bool:
         point = detection.middle_point
         result = (bound_box.ponto_min.x <= point.x <= bound_box.ponto_max.x 
                   and bound_box.ponto_min.y <= point.y <= bound_box.ponto_max.y)
@@ -198,21 +268,73 @@ class Checker(metaclass=Meta):
             )
 
 
+    # vectorized checks: one mask over all the detections, a failure (or a removed
+    # detection with filter=True) for each bad one, as the per-detection checks in a loop
+    def all_center_is_near_of(
+            self, detections : list[Detection], points : np.ndarray,
+            radius : float = None, filter : bool = False,
+        ) -> None:
+        # points [K, 2]: a single point for all the detections, or one per detection (zipped)
+        if len(points) > 1:
+            detections = detections[:len(points)]
+            points = points[:len(detections)]
+        centers, _ = vectorized.detection_arrays(detections)
+        height = self.img.height
+        bad, distances = vectorized.center_is_near_of(centers, points, radius, self.img.width, height)
+        self._report('center_is_near_of', detections, bad, filter, lambda i: (
+            f'distance <= radius  ::  {distances[i].item()} <= {radius * height}'
+        ))
+
+    def all_aspect_ratio(
+            self, detections : list[Detection], expected_ratio : float,
+            tolerance : float = None, filter : bool = False,
+        ) -> None:
+        _, aspect_ratios = vectorized.detection_arrays(detections)
+        bad, deviations = vectorized.aspect_ratio(aspect_ratios, expected_ratio, tolerance)
+        self._report('aspect_ratio', detections, bad, filter, lambda i: (
+            f'abs(detection.aspect_ratio - expected_ratio) <= tolerance  ::  {deviations[i].item()} <= {tolerance}'
+        ))
+
+    def all_inside_box(
+            self, detections : list[Detection], box : np.ndarray, filter : bool = False
+        ) -> None:
+        # box [4]: x_min, y_min, x_max, y_max
+        centers, _ = vectorized.detection_arrays(detections)
+        x_min, y_min, x_max, y_max = box.tolist()
+        bad = vectorized.inside_box(centers, x_min, y_min, x_max, y_max)
+        self._report('inside_box', detections, bad, filter, lambda i: (
+            f'min.x <= detection.x <= max.x and min.y <= detection.y <= max.y  ::  {x_min} <= {centers[i, 0].item()} <= {x_max} and {y_min} <= {centers[i, 1].item()} <= {y_max}'
+        ))
+
+    def _report(
+            self, check_name : str, detections : list[Detection], bad : np.ndarray,
+            filter : bool, message : Callable[[int], str],
+        ) -> None:
+        # the messages are only formatted for the bad detections
+        for i in np.flatnonzero(bad).tolist():
+            if filter:
+                self.logger.info(f'[ REMOVED DETECTION ] {check_name}: {message(i)}')
+                self.to_remove.append(detections[i])
+                continue
+            self.logger.error(f'[ FALIED ] {check_name}: {message(i)}')
+            self.fail = True
+            self.context.failures.append((type(self).__name__, check_name, message(i)))
+            if self.context.stop_on_fail:
+                raise AssertionError(message(i), [detections[i]])
+
     # Below methods are tools and cannot be used as checks
 
-    @classmethod
     def _get_distance_between_points(
-            cls,
+            self,
             point1 : FloatPoint, point2 : FloatPoint
         ) -> float:
-        point1, point2 = cls._transform([point1, point2])
+        point1, point2 = self._transform([point1, point2])
         return sqrt(
             (point1.x - point2.x) ** 2 + (point1.y - point2.y) ** 2
         )
     # recupera o dominio inicial
-    @classmethod
-    def _transform(cls, points) -> list[FloatPoint]:
-        return [FloatPoint(x * cls.IMG_INSTANCE.width , y * cls.IMG_INSTANCE.height) for x, y in points]
+    def _transform(self, points) -> list[FloatPoint]:
+        return [FloatPoint(x * self.img.width , y * self.img.height) for x, y in points]
     
     @classmethod
     def _sort_vertically(cls, detections : list[Detection]) -> list[Detection]:
@@ -231,16 +353,5 @@ class Checker(metaclass=Meta):
         else:
             raise ValueError("axis must be 'x' or 'y'")
         
-        groups = []
-        while len(sorted_detections) > size:
-            group = []
-            for _ in range(size):
-                group.append(sorted_detections.pop(0))
-
-            groups.append(group)
-            
-        if sorted_detections:
-            groups.append(sorted_detections)
-
-        return groups
+        return [sorted_detections[start:start + size] for start in range(0, len(sorted_detections), size)]
     
\ No newline at end of file
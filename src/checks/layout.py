@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from aux import log
+
+logger = log.get_new_logger('layout')
+
+LAYOUTS_DIR = Path(__file__).parent / 'layouts'
+CACHE_DIR = LAYOUTS_DIR / '.cache'
+# bumped when the compiled plan changes, so old cached plans are not read
+PLAN_VERSION = 1
+
+
+CLASS_KEYS = (
+    'checker', 'count', 'centers', 'radius', 'box', 'aspect_ratio', 'aspect_ratio_tolerance',
+    'horizontal_alignment', 'vertical_alignment', 'grid', 'crops',
+)
+
+
+@dataclass
+class ClassLayout():
+    class_name: str = field(default='')
+    checker: str = field(default='')
+    count: int = field(default=None)
+    centers: np.ndarray = field(default=None)       # [K, 2]
+    radius: float = field(default=None)
+    box: np.ndarray = field(default=None)           # [4] x_min, y_min, x_max, y_max
+    aspect_ratio: float = field(default=None)
+    aspect_ratio_tolerance: float = field(default=None)
+    horizontal_alignment: float = field(default=None)
+    vertical_alignment: float = field(default=None)
+    grid: tuple[int, int] = field(default=None)     # rows, columns
+    grid_alignment: float = field(default=None)
+
+
+@dataclass
+class StageLayout():
+    classes: dict[str, ClassLayout] = field(default_factory=dict)
+    # cropped_by -> class name -> layout with the values of that crop
+    crops: dict[str, dict[str, ClassLayout]] = field(default_factory=dict)
+
+
+@dataclass
+class CheckPlan():
+    name: str = field(default='')
+    spec_hash: str = field(default='')
+    stages: dict[int, StageLayout] = field(default_factory=dict)
+
+    def class_names(self, stage : int) -> list[str]:
+        return list(self.stages[stage].classes)
+
+    def layout(self, stage : int, class_name : str, cropped_by : str = None) -> ClassLayout:
+        stage_layout = self.stages[stage]
+        return stage_layout.crops.get(cropped_by, {}).get(class_name, stage_layout.classes[class_name])
+
+    def checkers(self) -> dict[str, str]:
+        # checker name -> class name
+        return {
+            layout.checker: layout.class_name
+            for stage_layout in self.stages.values() for layout in stage_layout.classes.values()
+        }
+
+
+def compile_spec(spec : dict, spec_hash : str = '') -> CheckPlan:
+    '''
+    Layout specs: checks/layouts/<prova>.json, one entry per stage and detection class
+
+        {"name": "PS", "stages": {"1": {"cpf_block": {"checker": "CpfBlockChecker", "count": 1, ...}}}}
+
+    keys of a class (all optional but checker), positions in % of the image:
+        count                     expected number of detections
+        centers, radius           expected middle points [[x, y], ...], one for all the detections
+                                  or one per detection in grid order, radius in % of the image height
+        box                       [x_min, y_min, x_max, y_max] of the middle points, only filters
+        aspect_ratio, aspect_ratio_tolerance
+        horizontal_alignment      tolerance of the y of the middle points to their average
+        vertical_alignment        same for x
+        grid                      {"rows", "columns", "alignment"}: detections sorted in rows,
+                                  each row and column aligned
+        crops                     {cropped_by: {keys}} values for the crops of a 1st stage class
+    '''
+    name = spec.get('name', '')
+    plan = CheckPlan(name, spec_hash)
+    checkers : dict[str, str] = {}
+    for stage, classes in spec['stages'].items():
+        stage_layout = StageLayout()
+        for class_name, values in classes.items():
+            where = f'{name} stage {stage} {class_name}'
+            layout = _compile_class(ClassLayout(class_name), values, where)
+            if not layout.checker:
+                raise ValueError(f'{where}: missing checker name')
+            if checkers.setdefault(layout.checker, class_name) != class_name:
+                raise ValueError(f'{where}: checker {layout.checker} is already used by {checkers[layout.checker]}')
+            stage_layout.classes[class_name] = layout
+            for cropped_by, crop_values in values.get('crops', {}).items():
+                stage_layout.crops.setdefault(cropped_by, {})[class_name] = _compile_class(
+                    replace(layout), crop_values, f'{where} crops {cropped_by}'
+                )
+        plan.stages[int(stage)] = stage_layout
+    return plan
+
+
+def _compile_class(layout : ClassLayout, values : dict, where : str) -> ClassLayout:
+    unknown = set(values) - set(CLASS_KEYS)
+    if unknown:
+        raise ValueError(f'{where}: unknown keys {sorted(unknown)}')
+    if 'checker' in values:
+        layout.checker = values['checker']
+    if 'count' in values:
+        layout.count = int(values['count'])
+    if 'centers' in values:
+        layout.centers = np.array(values['centers'], dtype=np.float64).reshape(-1, 2)
+    if 'box' in values:
+        layout.box = np.array(values['box'], dtype=np.float64).reshape(4)
+    for key in ('radius', 'aspect_ratio', 'aspect_ratio_tolerance', 'horizontal_alignment', 'vertical_alignment'):
+        if key in values:
+            setattr(layout, key, float(values[key]))
+    if 'grid' in values:
+        layout.grid = (int(values['grid']['rows']), int(values['grid']['columns']))
+        layout.grid_alignment = float(values['grid']['alignment'])
+
+    if layout.centers is not None and layout.radius is None:
+        raise ValueError(f'{where}: centers without radius')
+    if layout.centers is not None and len(layout.centers) > 1:
+        if layout.grid is None or len(layout.centers) != layout.grid[0] * layout.grid[1]:
+            raise ValueError(f'{where}: one center per detection needs a grid with as many cells')
+    if layout.aspect_ratio is not None and layout.aspect_ratio_tolerance is None:
+        raise ValueError(f'{where}: aspect_ratio without aspect_ratio_tolerance')
+    return layout
+
+
+# plans loaded by this process
+_plans : dict[str, CheckPlan] = {}
+
+def load_plan(prova : str) -> CheckPlan:
+    '''
+    Compiled plan of checks/layouts/<prova>.json, kept in CACHE_DIR by the hash of the
+    spec so it is compiled only when the file changes. FileNotFoundError without a spec.
+    '''
+    path = LAYOUTS_DIR / f'{prova.lower()}.json'
+    data = path.read_bytes()
+    spec_hash = hashlib.sha256(data + str(PLAN_VERSION).encode()).hexdigest()[:16]
+    if prova in _plans and _plans[prova].spec_hash == spec_hash:
+        return _plans[prova]
+
+    cache_path = CACHE_DIR / f'{path.stem}_{spec_hash}.pickle'
+    plan = None
+    if cache_path.exists():
+        try:
+            with open(cache_path, 'rb') as f:
+                plan = pickle.load(f)
+        except Exception as e:
+            logger.warning(f'ignoring the cached plan {cache_path}: {e}')
+    if plan is None:
+        logger.info(f'compiling {path}')
+        plan = compile_spec(json.loads(data), spec_hash)
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            tmp_path = cache_path.with_name(f'.{cache_path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(plan, f)
+            tmp_path.replace(cache_path)
+        except OSError as e:
+            logger.warning(f'could not cache the plan of {path}: {e}')
+
+    _plans[prova] = plan
+    return plan
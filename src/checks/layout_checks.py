@@ -0,0 +1,165 @@
+'''
+Checks of any exam from its compiled layout plan (checks/layout.py): one LayoutChecker
+per detection class, named by the checker of the spec (e.g. CpfBlockChecker).
+'''
+from __future__ import annotations
+
+import checks.planner as planner
+
+from checks import Checker, CheckContext, logger
+from checks.layout import CheckPlan, ClassLayout
+
+# checker name -> class, made by register() when the plan is loaded
+_checker_classes : dict[str, type] = {}
+
+
+def register(plan : CheckPlan) -> None:
+    for checker_name, class_name in plan.checkers().items():
+        if checker_name not in _checker_classes:
+            _checker_classes[checker_name] = type(
+                checker_name, (LayoutChecker,), {'CLASS_NAME': class_name, '__module__': __name__}
+            )
+
+
+def get_checker(context : CheckContext, class_name : str) -> LayoutChecker:
+    # the checker of the detections of class_name in the image
+    checker_name = context.plan.layout(context.stage, class_name).checker
+    return context.checker(_checker_classes[checker_name])
+
+
+def setup_detections(context : CheckContext) -> None:
+    logger.debug(f'Setup for detections...')
+    checkers = {class_name: get_checker(context, class_name) for class_name in context.plan.class_names(context.stage)}
+
+    # dispatch detections to their respective checkers
+    if context.img.detections:
+        for detection in context.img.detections:
+            checkers[detection.class_name].detections.append(detection)
+
+    # call auxiliar variables constructor for each class
+    for checker in checkers.values():
+        checker._precheck_setup()
+
+    # clean detections
+    if context.filter_detections:
+        for checker in checkers.values():
+            checker.clean_detections()
+
+
+def perform_checks(context : CheckContext, extra_checkers : list[Checker] = ()) -> None:
+    # extra_checkers: the checkers of an exam module, run after the layout ones
+    checkers = [get_checker(context, class_name) for class_name in context.plan.class_names(context.stage)]
+    checkers.extend(extra_checkers)
+    if not context.fast_reject:
+        for checker in checkers:
+            checker.perform_checks()
+        return
+
+    # the rules of all the checkers by rank, the first failure raises
+    rules = [(checker, rule) for checker in checkers for rule in checker.rules()]
+    names = [(type(checker).__name__, rule) for checker, rule in rules]
+    for index in planner.order(names, context.ranks):
+        checker, rule = rules[index]
+        checker.run_rule(rule)
+
+
+class LayoutChecker(Checker):
+    '''
+    Runs the checks of the ClassLayout of its class (for the crop being checked) over
+    the arrays precomputed by the plan.
+    '''
+
+    CLASS_NAME : str = None
+
+    def __init__(self, context : CheckContext) -> None:
+        super().__init__(context)
+        self.layout : ClassLayout = context.plan.layout(context.stage, self.CLASS_NAME, context.img.cropped_by)
+        self.sorted_detections : list = []
+        self.rows : list[list] = []
+
+    def _precheck_setup(self):
+        # grid order, taken before the cleaning as the checks of the grid use all the detections
+        self.sorted_detections = self.detections
+        if self.layout.grid is None:
+            return
+        rows, columns = self.layout.grid
+        sorted = self._sort_vertically(self.detections)
+        self.rows = [self._sort_horizontally(sorted[row * columns:(row + 1) * columns]) for row in range(rows - 1)]
+        self.rows.append(self._sort_horizontally(sorted[(rows - 1) * columns:]))
+        self.sorted_detections = [detection for row in self.rows for detection in row]
+
+    @Checker.has_detections
+    def clean_detections(self):
+        self.logger.debug(f'Cleaning detections...')
+        self.to_remove = []
+        layout = self.layout
+        # Position
+        if layout.centers is not None:
+            self.all_center_is_near_of(self.sorted_detections, layout.centers, radius=layout.radius, filter=True)
+        if layout.box is not None:
+            self.all_inside_box(self.detections, layout.box, filter=True)
+        # Aspect Ratio
+        if layout.aspect_ratio is not None:
+            self.all_aspect_ratio(self.detections, layout.aspect_ratio, tolerance=layout.aspect_ratio_tolerance, filter=True)
+
+        for detection in self.to_remove:
+            try:
+                self.img.detections.remove(detection)
+                self.detections.remove(detection)
+            except ValueError:
+                continue
+
+    @Checker.has_detections
+    def perform_checks(self):
+        for rule in self.rules():
+            self.run_rule(rule)
+
+        if not self.fail: self.logger.warning(f'[ PASSED ]')
+
+    # rules: the checks of the layout
+
+    def rules(self) -> list[str]:
+        layout = self.layout
+        rules = []
+        if not self.detections:
+            return rules
+        if layout.count is not None:
+            rules.append('count')
+        if layout.grid is not None or layout.horizontal_alignment is not None:
+            rules.append('horizontally_alling')
+        if layout.grid is not None or layout.vertical_alignment is not None:
+            rules.append('vertically_alling')
+        if layout.centers is not None:
+            rules.append('center_is_near_of')
+        if layout.aspect_ratio is not None:
+            rules.append('aspect_ratio')
+        return rules
+
+    def _rule_count(self):
+        self.count(self.layout.count, self.CLASS_NAME)
+
+    def _rule_horizontally_alling(self):
+        layout = self.layout
+        if layout.grid is not None:
+            for row in self.rows:
+                self.horizontally_alling(row, tolerance=layout.grid_alignment)
+        if layout.horizontal_alignment is not None:
+            self.horizontally_alling(self.detections, tolerance=layout.horizontal_alignment)
+
+    def _rule_vertically_alling(self):
+        layout = self.layout
+        if layout.grid is not None:
+            for column in range(layout.grid[1]):
+                try:
+                    detections = [row[column] for row in self.rows]
+                except IndexError:
+                    break
+                self.vertically_alling(detections, tolerance=layout.grid_alignment)
+        if layout.vertical_alignment is not None:
+            self.vertically_alling(self.detections, tolerance=layout.vertical_alignment)
+
+    def _rule_center_is_near_of(self):
+        self.all_center_is_near_of(self.sorted_detections, self.layout.centers, radius=self.layout.radius)
+
+    def _rule_aspect_ratio(self):
+        self.all_aspect_ratio(self.detections, self.layout.aspect_ratio, tolerance=self.layout.aspect_ratio_tolerance)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+import os
+
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+from aux import log
+from checks.layout import CACHE_DIR
+
+logger = log.get_new_logger('planner')
+
+
+def default_stats_path(prova : str) -> Path:
+    return CACHE_DIR / f'{prova.lower()}_check_stats.json'
+
+
+@dataclass
+class RuleStats():
+    runs: int = field(default=0)
+    failures: int = field(default=0)
+    seconds: float = field(default=0.0)
+
+    @property
+    def rank(self) -> float:
+        # expected time spent per rejected image: cheap rules that fail often run first,
+        # the failure rate starts at 1/2 so a rule never seen failing is not ranked last forever
+        failure_rate = (self.failures + 1) / (self.runs + 2)
+        return (self.seconds / self.runs) / failure_rate
+
+
+class CheckStats():
+    '''
+    Runs, failures and time of each check rule ('Checker.check') over the scans, kept in
+    a JSON file. The ranks of a run are taken when it starts, record() only adds to the
+    file of the next runs.
+    '''
+
+    def __init__(self, path : Path) -> None:
+        self.path : Path = Path(path)
+        self.rules : dict[str, RuleStats] = {}
+        if self.path.exists():
+            try:
+                with open(self.path) as f:
+                    self.rules = {rule: RuleStats(**values) for rule, values in json.load(f).items()}
+            except (ValueError, TypeError) as e:
+                logger.warning(f'ignoring the check stats in {self.path}: {e}')
+
+    def ranks(self) -> dict[str, float]:
+        return {rule: stats.rank for rule, stats in self.rules.items() if stats.runs}
+
+    def record(self, timings : list[tuple[str, str, float, bool]]) -> None:
+        # timings: (checker, check, seconds, failed)
+        for checker, check, seconds, failed in timings:
+            stats = self.rules.setdefault(f'{checker}.{check}', RuleStats())
+            stats.runs += 1
+            stats.failures += int(failed)
+            stats.seconds += seconds
+
+    def save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({rule: asdict(stats) for rule, stats in sorted(self.rules.items())}, f, indent=4)
+            tmp_path.replace(self.path)
+        except OSError as e:
+            logger.warning(f'could not save the check stats in {self.path}: {e}')
+
+
+def order(rules : list[tuple[str, str]], ranks : dict[str, float]) -> list[int]:
+    '''
+    Indices of the (checker, check) rules in the order to run them: the rules without
+    stats first, in their order, so they get measured, then by rank.
+    '''
+    def key(index : int):
+        rank = ranks.get('.'.join(rules[index]))
+        return (0, 0.0, index) if rank is None else (1, rank, index)
+    return sorted(range(len(rules)), key=key)
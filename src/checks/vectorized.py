@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import numpy as np
+
+# The checks of Checker as masks over all the detections of a class at once.
+# Each function takes the detection arrays (centers [N, 2] and aspect ratios [N], see
+# detection_arrays) and returns the mask of the bad detections with the value that was
+# compared, computed with the same float operations as the per-detection checks (a distance
+# can differ in the last bit, x ** 2 of a Python float goes through pow).
+
+
+def detection_arrays(detections : list) -> tuple[np.ndarray, np.ndarray]:
+    # centers [N, 2] and aspect ratios [N] of a list of Detection
+    values = np.array(
+        [(d.middle_point.x, d.middle_point.y, d.aspect_ratio) for d in detections], dtype=np.float64
+    ).reshape(-1, 3)
+    return values[:, :2], values[:, 2]
+
+
+def center_is_near_of(
+        centers : np.ndarray, points : np.ndarray, radius : float, width : int, height : int
+    ) -> tuple[np.ndarray, np.ndarray]:
+    # distance in pixels to the expected point (one for all or one per detection), radius in % of the height
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    distances = np.sqrt(
+        (centers[:, 0] * width - points[:, 0] * width) ** 2
+        + (centers[:, 1] * height - points[:, 1] * height) ** 2
+    )
+    return ~(distances <= radius * height), distances
+
+
+def aspect_ratio(
+        aspect_ratios : np.ndarray, expected_ratio : float, tolerance : float
+    ) -> tuple[np.ndarray, np.ndarray]:
+    deviations = np.abs(aspect_ratios - expected_ratio) / expected_ratio
+    return ~(deviations <= tolerance), deviations
+
+
+def inside_box(centers : np.ndarray, x_min, y_min, x_max, y_max) -> np.ndarray:
+    x, y = centers[:, 0], centers[:, 1]
+    return ~((x_min <= x) & (x <= x_max) & (y_min <= y) & (y <= y_max))
+
+
+def alling(values : np.ndarray, tolerance : float) -> tuple[np.ndarray, np.ndarray]:
+    # distance of each value to the average, the built-in sum keeps the rounding of the per-detection check
+    deviations = np.abs(values - sum(values.tolist()) / len(values))
+    return deviations > tolerance, deviations
+
+
+def containing_boxes(boxes : np.ndarray, points : np.ndarray) -> np.ndarray:
+    # index of the box [x_min, y_min, x_max, y_max] containing each point [x, y], -1 for none
+    # (the first one by y_min when several do). The boxes are sorted by y_min and each point is
+    # looked up by binary search, then only the boxes starting above it that can still reach
+    # it are tried: as many as the boxes overlapping a box, one or two for the rows of a sheet
+    found = np.full(len(points), -1, dtype=np.int64)
+    if len(boxes) == 0 or len(points) == 0:
+        return found
+    order = np.argsort(boxes[:, 1], kind='stable')
+    sorted_boxes = boxes[order]
+    # boxes starting inside each box
+    depth = int((np.searchsorted(sorted_boxes[:, 1], sorted_boxes[:, 3], side='right') - 1 - np.arange(len(boxes))).max())
+    last = np.searchsorted(sorted_boxes[:, 1], points[:, 1], side='right') - 1
+    for candidate in range(-depth, 1):
+        candidate = last + candidate
+        index = np.maximum(candidate, 0)
+        box = sorted_boxes[index]
+        inside = (
+            (candidate >= 0) & (found < 0)
+            & (box[:, 0] <= points[:, 0]) & (points[:, 0] <= box[:, 2])
+            & (box[:, 1] <= points[:, 1]) & (points[:, 1] <= box[:, 3])
+        )
+        found[inside] = order[index[inside]]
+    return found
@@ -1,15 +1,272 @@
+from __future__ import annotations
+
 import argparse
+import json
+import multiprocessing
+import os
+import time
+import builder
 import checks
 
-from aux.filehandler import FileHandler
-from aux.object_detection import Model, Detection
-from aux.image import Image
+from dataclasses import dataclass, field
+from aux.filehandler import FileHandler, parse_shard
+from aux.object_detection import Model
+from aux.model_registry import ModelRegistry
+from aux.image import Image, REDUCTIONS
+from aux.pipeline import Pipeline
+from aux.data_classes import InterpreterOptions
+from aux.manifest import Manifest
+from aux.columnar import ColumnarWriter, CropDetections
+from aux.archive import ArchiveWriter, is_archive
+from checks.planner import CheckStats, default_stats_path
+from aux.results_store import ResultsStore
+from aux.report_writer import ReportWriter, read_report
+from aux.watcher import InputWatcher
 from aux import log
+from pathlib import Path
 
 logger = log.get_new_logger('exam scanner')
 
+# crops sent to the 2nd stage model in a single invoke
+BATCH_SIZE_2ND_STAGE = 8
+# the 1st stage model sees the sheet decoded at 1/DECODE_REDUCTION scale (and in grayscale),
+# the full resolution is only decoded for the crops
+DECODE_REDUCTION = 1
+DECODE_GRAYSCALE = False
+# record of the scanned sheets, RESUME skips the ones already done with the same settings
+MANIFEST : Manifest = None
+RESUME = False
+# tflite interpreter threads/delegates of each stage
+INTERPRETER_OPTIONS_1ST_STAGE = InterpreterOptions()
+INTERPRETER_OPTIONS_2ND_STAGE = InterpreterOptions()
+# fused scan and build: final_report.json is built from the detections in memory
+BUILD_REPORT = False
+BUILD_FALIED = False
+ERROR_CORRECTION : list[str] = []
+# 'json' (one file per sheet) or 'columnar' (.detcol files written by the main process)
+OUTPUT_FORMAT = 'json'
+COLUMNAR_WRITER : ColumnarWriter = None
+# optional sqlite database with the detections, failed checks and answers of every sheet
+RESULTS_STORE : ResultsStore = None
+# the per-sheet json and images in a single zip, written by the main process
+ARCHIVE_WRITER : ArchiveWriter = None
+# time and failures of each check, the --fast_reject order of the next runs
+CHECK_STATS : CheckStats = None
 
-def scan_exam(
+
+def _load_models(
+    model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage=None, label_map_2nd_stage=None
+) -> tuple[Model, Model]:
+    # the label maps come from models/<name>/annotations unless given by hand
+    return (
+        ModelRegistry.get_model(
+            model_name_1st_stage,
+            options=INTERPRETER_OPTIONS_1ST_STAGE,
+            label_map=label_map_1st_stage,
+        ),
+        ModelRegistry.get_model(
+            model_name_2nd_stage,
+            max_batch_size=BATCH_SIZE_2ND_STAGE,
+            options=INTERPRETER_OPTIONS_2ND_STAGE,
+            label_map=label_map_2nd_stage,
+        ),
+    )
+
+
+def load_interpreter_config(path) -> dict:
+    # written by autotune.py
+    with open(path) as f:
+        return json.load(f)
+
+
+def _interpreter_options(config : dict, stage : str, threads, xnnpack, delegate) -> InterpreterOptions:
+    options = InterpreterOptions.from_dict(config.get(stage, {}))
+    # command line values win over the config file
+    if threads is not None:
+        options.num_threads = threads
+    if xnnpack is not None:
+        options.use_xnnpack = xnnpack == 'on'
+    if delegate is not None:
+        options.delegate = delegate
+    return options
+
+
+@dataclass
+class ScanResult():
+    name: str = field(default='')
+    status: str = field(default='success')
+    content_hash: str = field(default=None)
+    skipped: bool = field(default=False)    # already in the manifest
+    answers: dict = field(default=None)     # built in the fused mode
+    columns: dict[str, CropDetections] = field(default=None)    # columnar output
+    files: dict[str, bytes] = field(default=None)   # archive output
+    # for the results store
+    detections: dict = field(default=None)
+    failed_checks: list[tuple] = field(default_factory=list)
+    # (checker, check, seconds, failed) for the check stats
+    check_timings: list[tuple] = field(default_factory=list)
+
+
+def _read_image(img_path) -> tuple[str, Image | None, str]:
+    name, data = FileHandler.read_input(img_path)
+    content_hash = Manifest.hash_bytes(data)
+    if RESUME and MANIFEST is not None and MANIFEST.is_done(content_hash):
+        logger.info(f'skipping {name}, already scanned with the same settings')
+        return name, None, content_hash
+    return name, Image.from_bytes(name, data, DECODE_REDUCTION, DECODE_GRAYSCALE), content_hash
+
+
+def scan_image(
+    img_path,
+    detection_model_1st_stage,
+    detection_model_2nd_stage,
+    score_threshold_1st_stage,
+    score_threshold_2nd_stage,
+) -> ScanResult:
+    status = 'success'
+    name, img, content_hash = _read_image(img_path)
+    if img is None:
+        return ScanResult(name[:-4], 'success', content_hash, skipped=True)
+
+    img.make_detections_with_model(
+        detection_model_1st_stage, score_threshold_1st_stage
+    )
+    if checks.perform(img, stage=1) == 'failed':
+        return _scan_result(img, 'failed', content_hash)
+
+
+    cropped_imgs : list[Image] = img.get_cropped()
+
+    if checks.FAST_REJECT:
+        status, cropped_imgs = _fast_reject_crops(
+            cropped_imgs, detection_model_2nd_stage, score_threshold_2nd_stage
+        )
+        answers, detection_data, files = _save_sheet(img, cropped_imgs, status)
+        return _scan_result(img, status, content_hash, cropped_imgs, answers, detection_data, files)
+
+    Image.make_detections_in_batch(
+        cropped_imgs, detection_model_2nd_stage, score_threshold_2nd_stage
+    )
+    for crop_img in cropped_imgs:
+        if checks.perform(crop_img, stage=2) == 'failed' and status == 'success':
+            status = 'failed'
+            continue
+
+    answers, detection_data, files = _save_sheet(img, cropped_imgs, status)
+    return _scan_result(img, status, content_hash, cropped_imgs, answers, detection_data, files)
+
+
+def _fast_reject_crops(
+    cropped_imgs : list[Image], detection_model_2nd_stage, score_threshold_2nd_stage
+) -> tuple[str, list[Image]]:
+    # one crop at a time, the ones after the first failed crop are not inferred nor saved
+    for i, crop_img in enumerate(cropped_imgs):
+        Image.make_detections_in_batch(
+            [crop_img], detection_model_2nd_stage, score_threshold_2nd_stage
+        )
+        if checks.perform(crop_img, stage=2) == 'failed':
+            return 'failed', cropped_imgs[:i + 1]
+    return 'success', cropped_imgs
+
+
+def _save_sheet(
+    img : Image, cropped_imgs : list[Image], status : str
+) -> tuple[dict | None, dict, dict[str, bytes]]:
+    # writes the sheet outputs, returns its answers in the fused mode, its
+    # detections (as arrays for the columnar writer) and the files for the archive
+    if OUTPUT_FORMAT == 'columnar':
+        detection_data = {crop_img.name: crop_img.to_columns() for crop_img in cropped_imgs}
+        files = FileHandler.save(main_img=img, cropped_imgs=cropped_imgs)
+    else:
+        detection_data = FileHandler.detection_data(cropped_imgs)
+        files = FileHandler.save(main_img=img, cropped_imgs=cropped_imgs, detection_data=detection_data)
+    if not BUILD_REPORT or (status != 'success' and not BUILD_FALIED):
+        return None, detection_data, files
+    # same rules as build_report.py
+    ec = ERROR_CORRECTION if status != 'success' else []
+    answers = builder.build_from_data(detection_data, img.name, status=status, ec=ec)
+    if ec:
+        answers['ec'] = ec
+    return answers, detection_data, files
+
+
+def _scan_result(
+    img : Image, status : str, content_hash : str, cropped_imgs : list[Image] = (),
+    answers : dict = None, detection_data : dict = None, files : dict[str, bytes] = None,
+) -> ScanResult:
+    result = ScanResult(img.name[:-4], status, content_hash, answers=answers, files=files)
+    if OUTPUT_FORMAT == 'columnar':
+        result.columns = detection_data
+    result.check_timings = img.check_timings + [
+        timing for crop_img in cropped_imgs for timing in crop_img.check_timings
+    ]
+    if RESULTS_STORE is not None:
+        result.detections = detection_data
+        # (crop, stage, checker, check, message)
+        result.failed_checks = [(None, 1, *failed) for failed in img.failed_checks] + [
+            (crop_img.name, 2, *failed) for crop_img in cropped_imgs for failed in crop_img.failed_checks
+        ]
+    return result
+
+
+def _scan_serial(
+    model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage, label_map_2nd_stage, *stage_args
+):
+    detection_model_1st_stage, detection_model_2nd_stage = _load_models(
+        model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage, label_map_2nd_stage
+    )
+
+    for img_path in FileHandler.INPUT_PATHS:
+        yield scan_image(
+            img_path, detection_model_1st_stage, detection_model_2nd_stage, *stage_args
+        )
+
+
+# each worker process keeps its own models loaded between images
+_worker_models : tuple[Model, Model] = None
+_worker_stage_args : tuple = None
+
+def _init_worker(model_args, stage_args):
+    global _worker_models, _worker_stage_args
+    # interpreters loaded before the fork are not reused, their thread pools do not survive it
+    ModelRegistry.clear()
+    _worker_models = _load_models(*model_args)
+    _worker_stage_args = stage_args
+
+def _scan_in_worker(img_path):
+    return scan_image(img_path, *_worker_models, *_worker_stage_args)
+
+
+def _scan_with_workers(
+    workers, model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage, label_map_2nd_stage, *stage_args
+):
+    # fork keeps the globals set in main() (checks config, FileHandler paths) in the workers
+    context = multiprocessing.get_context('fork')
+    with context.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(
+            (model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage, label_map_2nd_stage),
+            stage_args,
+        ),
+    ) as pool:
+        # imap yields in input order, so the report matches a serial run
+        yield from pool.imap(_scan_in_worker, FileHandler.INPUT_PATHS)
+
+
+class _ScanItem():
+    def __init__(self, img_path) -> None:
+        self.img_path = img_path
+        self.name : str = None
+        self.content_hash : str = None
+        self.img : Image = None
+        self.cropped_imgs : list[Image] = None
+        self.status = 'success'
+        self.checked = False
+
+
+def _scan_pipelined(
+    queue_size,
     model_name_1st_stage,
     model_name_2nd_stage,
     label_map_1st_stage,
@@ -17,51 +274,256 @@ def scan_exam(
     score_threshold_1st_stage,
     score_threshold_2nd_stage,
 ):
-    falied_imgs = ''
-    success_imgs = ''
-    detection_model_1st_stage = Model(model_name_1st_stage)
-    detection_model_2nd_stage = Model(model_name_2nd_stage)
+    detection_model_1st_stage, detection_model_2nd_stage = _load_models(
+        model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage, label_map_2nd_stage
+    )
 
-    
-    for img_path in FileHandler.INPUT_PATHS:
-        status = 'success'
-        try:
-            Detection.set_label_map(label_map_1st_stage)
-            img = Image.from_path(img_path)
+    def decode(item : _ScanItem) -> _ScanItem:
+        item.name, item.img, item.content_hash = _read_image(item.img_path)
+        return item
+
+    # the stage 1 checks run here because the crops depend on the filtered detections
+    def infer(item : _ScanItem) -> _ScanItem:
+        if item.img is None:
+            return item
+        item.img.make_detections_with_model(
+            detection_model_1st_stage, score_threshold_1st_stage
+        )
+        if checks.perform(item.img, stage=1) == 'failed':
+            item.status = 'failed'
+            return item
 
-            img.make_detections_with_model(
-                detection_model_1st_stage, score_threshold_1st_stage
+        item.cropped_imgs = item.img.get_cropped()
+        if checks.FAST_REJECT:
+            # the 2nd stage checks decide which crops are inferred
+            item.status, item.cropped_imgs = _fast_reject_crops(
+                item.cropped_imgs, detection_model_2nd_stage, score_threshold_2nd_stage
             )
-            if checks.perform(img, stage=1) == 'failed':
-                falied_imgs += f'{img.name[:-4]}\n'
-                status = 'failed'
-                continue
-            
-            
-            Detection.set_label_map(label_map_2nd_stage)
-            cropped_imgs : list[Image] = img.get_cropped()
-
-            for crop_img in cropped_imgs:
-                crop_img.make_detections_with_model(
-                    detection_model_2nd_stage, score_threshold_2nd_stage
-                )
-                if checks.perform(crop_img, stage=2) == 'failed' and status == 'success':
-                    falied_imgs += f'{img.name[:-4]}\n'
-                    status = 'failed'
-                    continue
-
-
-            if status == 'success':
-                success_imgs += f'{img.name[:-4]}\n'
-        except Exception as e:
-            logger.exception(e)
-            exit(1)
-        
-        FileHandler.save(main_img=img, cropped_imgs=cropped_imgs)
-
-    report = f'success:\n{success_imgs}\n\nfalied:\n{falied_imgs}'
+            item.checked = True
+            return item
+        Image.make_detections_in_batch(
+            item.cropped_imgs, detection_model_2nd_stage, score_threshold_2nd_stage
+        )
+        return item
+
+    def check(item : _ScanItem) -> _ScanItem:
+        if item.cropped_imgs is None or item.checked:
+            return item
+        for crop_img in item.cropped_imgs:
+            if checks.perform(crop_img, stage=2) == 'failed':
+                item.status = 'failed'
+        return item
+
+    def write(item : _ScanItem) -> ScanResult:
+        if item.img is None:
+            return ScanResult(item.name[:-4], 'success', item.content_hash, skipped=True)
+        if item.cropped_imgs is None:
+            return _scan_result(item.img, item.status, item.content_hash)
+        answers, detection_data, files = _save_sheet(item.img, item.cropped_imgs, item.status)
+        return _scan_result(
+            item.img, item.status, item.content_hash, item.cropped_imgs, answers, detection_data, files
+        )
+
+    pipeline = Pipeline(
+        [('decode', decode), ('infer', infer), ('check', check), ('write', write)],
+        queue_size=queue_size,
+    )
+    try:
+        yield from pipeline.run(_ScanItem(img_path) for img_path in FileHandler.INPUT_PATHS)
+    finally:
+        stats = pipeline.stats()
+        logger.info(f'pipeline stats:\n{stats}')
+        FileHandler.txt_out(stats, 'pipeline_stats.txt')
+
+
+def scan_results(scan_args : tuple, workers=1, pipeline_queue_size=None):
+    # yields a ScanResult per image, in input order
+    if workers > 1:
+        logger.info(f'scanning with {workers} worker processes')
+        return _scan_with_workers(workers, *scan_args)
+    elif pipeline_queue_size is not None:
+        logger.info(f'scanning with a staged pipeline, queue size {pipeline_queue_size}')
+        return _scan_pipelined(pipeline_queue_size, *scan_args)
+    return _scan_serial(*scan_args)
+
+
+def scan_exam(
+    model_name_1st_stage,
+    model_name_2nd_stage,
+    label_map_1st_stage,
+    label_map_2nd_stage,
+    score_threshold_1st_stage,
+    score_threshold_2nd_stage,
+    workers=1,
+    pipeline_queue_size=None,
+):
+    scan_args = (
+        model_name_1st_stage,
+        model_name_2nd_stage,
+        label_map_1st_stage,
+        label_map_2nd_stage,
+        score_threshold_1st_stage,
+        score_threshold_2nd_stage,
+    )
+
+    # name -> status and name -> answers, a resumed run starts from the previous reports
+    statuses = _previous_statuses() if RESUME else {}
+    answers = FileHandler.load_report() if RESUME and BUILD_REPORT else {}
+
+    try:
+        for result in scan_results(scan_args, workers, pipeline_queue_size):
+            _record(result, statuses, answers)
+    except Exception as e:
+        logger.exception(e)
+        exit(1)
+    finally:
+        if COLUMNAR_WRITER is not None:
+            COLUMNAR_WRITER.close()
+        if ARCHIVE_WRITER is not None:
+            ARCHIVE_WRITER.close()
+        if RESULTS_STORE is not None:
+            RESULTS_STORE.close()
+        if CHECK_STATS is not None:
+            CHECK_STATS.save()
+
+    _write_report(statuses, answers)
+
+
+def watch_exam(
+    model_name_1st_stage,
+    model_name_2nd_stage,
+    label_map_1st_stage,
+    label_map_2nd_stage,
+    score_threshold_1st_stage,
+    score_threshold_2nd_stage,
+    recursive=True,
+    poll_interval=5.0,
+    settle_time=2.0,
+    full_scan_interval=60.0,
+):
+    # keeps the models loaded and scans the images as they show up in the input dir
+    detection_model_1st_stage, detection_model_2nd_stage = _load_models(
+        model_name_1st_stage, model_name_2nd_stage, label_map_1st_stage, label_map_2nd_stage
+    )
+    statuses = _previous_statuses()
+    watcher = InputWatcher(
+        FileHandler.INPUT_DIR, recursive, FileHandler.SHARD, settle_time, full_scan_interval
+    )
+    # the answers are appended to final_report.jsonl one sheet at a time, the last line of a sheet wins
+    report_writer = None
+    answered = set()
+    if BUILD_REPORT:
+        report_path = FileHandler.OUTPUT_DIR / 'final_report.jsonl'
+        if report_path.exists():
+            answered = set(read_report(report_path))
+        report_writer = ReportWriter(report_path, 'jsonl', append=True)
+        report_writer.open()
+
+    logger.error(f'watching {FileHandler.INPUT_DIR.resolve()}, ctrl+c to stop')
+    try:
+        while True:
+            img_paths = watcher.poll()
+            for img_path in img_paths:
+                try:
+                    result = scan_image(
+                        img_path, detection_model_1st_stage, detection_model_2nd_stage,
+                        score_threshold_1st_stage, score_threshold_2nd_stage,
+                    )
+                except Exception as e:
+                    # a bad file must not stop the daemon
+                    logger.exception(e)
+                    result = ScanResult(str(img_path).split("/")[-1][:-4], 'failed')
+                _record(result, statuses)
+                if report_writer is not None:
+                    if result.answers is not None:
+                        report_writer.write(result.name, result.answers)
+                        answered.add(result.name)
+                    elif not result.skipped and result.name in answered:
+                        # answers of a previous scan are stale once the sheet is scanned again
+                        report_writer.write(result.name, None)
+                        answered.discard(result.name)
+            # the sheets of each poll go to disk together
+            if img_paths:
+                _write_report(statuses)
+            if COLUMNAR_WRITER is not None:
+                COLUMNAR_WRITER.flush()
+            if ARCHIVE_WRITER is not None:
+                ARCHIVE_WRITER.flush()
+            if RESULTS_STORE is not None:
+                RESULTS_STORE.commit()
+            if CHECK_STATS is not None:
+                CHECK_STATS.save()
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logger.error('stopping watch mode')
+    if COLUMNAR_WRITER is not None:
+        COLUMNAR_WRITER.close()
+    if ARCHIVE_WRITER is not None:
+        ARCHIVE_WRITER.close()
+    if RESULTS_STORE is not None:
+        RESULTS_STORE.close()
+    if CHECK_STATS is not None:
+        CHECK_STATS.save()
+    if report_writer is not None:
+        report_writer.close()
+    _write_report(statuses)
+
+
+def _previous_statuses() -> dict[str, str]:
+    statuses = {}
+    report_path = FileHandler.OUTPUT_DIR / 'report.txt'
+    if report_path.exists():
+        success, falied = FileHandler.parse_report(FileHandler.text_in(report_path))
+        statuses.update({name: 'success' for name in success})
+        statuses.update({name: 'failed' for name in falied})
+    return statuses
+
+
+def _record(result : ScanResult, statuses : dict[str, str], answers : dict[str, dict] = None) -> None:
+    record_manifest = lambda: _record_manifest(result)
+    if result.files and ARCHIVE_WRITER is not None:
+        # the sheet is done once its zip is closed (after its columnar file)
+        ARCHIVE_WRITER.add(result.files, on_written=record_manifest)
+        record_manifest = None
+    if result.columns is not None and COLUMNAR_WRITER is not None:
+        # a sheet is only done once its detections are in a .detcol file
+        COLUMNAR_WRITER.add_sheet(
+            result.name, result.status, result.columns, on_written=record_manifest
+        )
+    elif record_manifest is not None:
+        record_manifest()
+    if RESULTS_STORE is not None and not result.skipped:
+        RESULTS_STORE.add_sheet(
+            result.name, result.status, result.content_hash,
+            crops=result.detections, failed_checks=result.failed_checks, answers=result.answers,
+        )
+    if CHECK_STATS is not None:
+        CHECK_STATS.record(result.check_timings)
+    statuses[result.name] = result.status
+    if answers is None:
+        # the caller writes the answers itself
+        return
+    if result.answers is not None:
+        answers[result.name] = result.answers
+    elif not result.skipped:
+        # answers of a previous run are stale once the sheet is scanned again
+        answers.pop(result.name, None)
+
+
+def _record_manifest(result : ScanResult) -> None:
+    if not result.skipped and MANIFEST is not None and result.content_hash is not None:
+        MANIFEST.record(result.content_hash, result.name, result.status)
+
+
+def _write_report(statuses : dict[str, str], answers : dict[str, dict] = None) -> None:
+    success = [name for name, status in statuses.items() if status == 'success']
+    falied = [name for name, status in statuses.items() if status != 'success']
+    report = FileHandler.make_report(success, falied)
     logger.info(report)
     FileHandler.txt_out(report, 'report.txt')
+    if BUILD_REPORT and answers is not None:
+        # success sheets first, as in build_report.py
+        FileHandler.save_report({name: answers[name] for name in success + falied if name in answers})
 
 
 def main():
@@ -73,25 +535,52 @@ def main():
         "--label_map_1st_stage",
         type=str,
         nargs="+",
-        default=["cpf_block", "questions_block"],
+        default=None,
+        help="class names of the 1st stage model, read from its label_map.pbtxt by default",
     )
     parser.add_argument(
         "-ls",
         "--label_map_2nd_stage",
         type=str,
         nargs="+",
-        default=[
-            "cpf_column",
-            "question_line",
-            "selected_ball",
-            "unselected_ball",
-            "question_number",
-        ],
+        default=None,
+        help="class names of the 2nd stage model, read from its label_map.pbtxt by default",
     )
     parser.add_argument("-stf", "--score_threshold_1st_stage", type=float, default=0.5)
     parser.add_argument("-sts", "--score_threshold_2nd_stage", type=float, default=0.5)
     parser.add_argument(
-        "-i", "--input_directory", type=str, default='input_images', required=True
+        "-bs", "--batch_size_2nd_stage", type=int, default=8,
+        help="number of crops sent to the 2nd stage model in a single invoke",
+    )
+    parser.add_argument(
+        "--decode_reduction", type=int, default=1, choices=REDUCTIONS,
+        help="decode the sheets at 1/N scale for the 1st stage model, the crops keep the full resolution",
+    )
+    parser.add_argument(
+        "--grayscale_decode", action="store_true", default=False,
+        help="decode the sheets in grayscale for the 1st stage model",
+    )
+    # interpreter options, per stage
+    for stage in ('1st', '2nd'):
+        parser.add_argument(
+            f"--threads_{stage}_stage", type=int, default=None,
+            help=f"intra-op threads of the {stage} stage interpreter",
+        )
+        parser.add_argument(
+            f"--xnnpack_{stage}_stage", type=str, default=None, choices=['on', 'off'],
+            help=f"use the XNNPACK delegate in the {stage} stage interpreter",
+        )
+        parser.add_argument(
+            f"--delegate_{stage}_stage", type=str, default=None,
+            help=f"external delegate library loaded by the {stage} stage interpreter",
+        )
+    parser.add_argument(
+        "--interpreter_config", type=str, default="interpreter_config.json",
+        help="interpreter options written by autotune.py, loaded when the file exists",
+    )
+    parser.add_argument(
+        "-i", "--input_directory", type=str, default='input_images', required=True,
+        help="folder with the images, or a .zip/.tar(.gz) archive read without extracting it",
     )
     parser.add_argument("-o", "--output_directory", type=str, default="scanner_output")
     # make a log file
@@ -134,15 +623,155 @@ def main():
         "--continue_on_fail", action="store_true", default=False,
         help="continue the execution even if a check fails",
     )
+    # stop at the first failed check, in the order learned from the previous runs
+    parser.add_argument(
+        "--fast_reject", action="store_true", default=False,
+        help="fail a sheet at its first failed check (cheap and often failing checks first) "
+             "and skip the 2nd stage of its remaining blocks, only the checked blocks are saved",
+    )
+    parser.add_argument(
+        "--cluster_check", action="store_true", default=False,
+        help="check that every ball and question number of a question block is inside its question line",
+    )
+    parser.add_argument(
+        "--check_stats", type=str, default=None,
+        help="json file with the time and failures of each check, by default in src/checks/layouts/.cache",
+    )
+    # skip the sheets already scanned with the same settings (see manifest.jsonl in the output dir)
+    parser.add_argument(
+        "--resume", action="store_true", default=False,
+        help="only scan new, changed or previously failed images",
+    )
+    # split one input tree between several machines, merge the outputs with merge_shards.py
+    parser.add_argument(
+        "--shard", type=parse_shard, default=None,
+        help="i/N, only scan the i-th of N parts of the input directory (0 <= i < N)",
+    )
+    # daemon mode, the models stay loaded between images
+    parser.add_argument(
+        "--watch", action="store_true", default=False,
+        help="keep running and scan new images as they appear in the input directory",
+    )
+    parser.add_argument(
+        "--poll_interval", type=float, default=5.0,
+        help="seconds between two looks at the input directory in watch mode",
+    )
+    parser.add_argument(
+        "--settle_time", type=float, default=2.0,
+        help="seconds a file must stay unchanged before it is scanned in watch mode",
+    )
+    parser.add_argument(
+        "--full_scan_interval", type=float, default=60.0,
+        help="seconds between two stats of every input file in watch mode, to find the files rewritten in place",
+    )
+    # spread the images over a pool of processes, each one with its own models
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None,
+        help="number of worker processes used to scan the images",
+    )
+    # overlap decoding, inference, checks and writing in separate threads
+    parser.add_argument(
+        "--pipeline", action="store_true", default=False,
+        help="run decode, inference, checks and saving as concurrent stages",
+    )
+    parser.add_argument(
+        "--queue_size", type=int, default=8,
+        help="max number of images waiting between two pipeline stages",
+    )
+    # build final_report.json in the same run, without going through the json files
+    parser.add_argument(
+        "--output_format", type=str, default="json", choices=['json', 'columnar'],
+        help="detections saved as one json per sheet or as .detcol columnar files",
+    )
+    parser.add_argument(
+        "--columnar_batch", type=int, default=256,
+        help="sheets per .detcol file",
+    )
+    parser.add_argument(
+        "--output_archive", action="store_true", default=False,
+        help="save the per-sheet json and images in sheets_*.zip files instead of a folder per sheet",
+    )
+    parser.add_argument(
+        "--archive_batch", type=int, default=1024,
+        help="sheets per zip file with --output_archive",
+    )
+    parser.add_argument(
+        "--sqlite", type=str, default=None,
+        help="also save the sheets, detections, failed checks and answers in this sqlite database",
+    )
+    parser.add_argument(
+        "--build_report", action="store_true", default=False,
+        help="build final_report.json from the detections in memory (replaces build_report.py)",
+    )
+    parser.add_argument(
+        "--debug_json", action="store_true", default=False,
+        help="also save the per-sheet detections json files with --build_report",
+    )
+    parser.add_argument(
+        "-f", "--falied_to", action="store_true", default=False,
+        help="build the report of the falied scans too, with --build_report",
+    )
+    parser.add_argument(
+        "--error_correction",
+        nargs="+",
+        type=str,
+        default=[],
+        choices=['cpf', 'questions'],
+        help="try to correct the errors/missing detections in falied scans, with --build_report",
+    )
 
 
     args = parser.parse_args()
+
+    interpreter_config = {}
+    if Path(args.interpreter_config).exists():
+        logger.info(f'loading interpreter config: {args.interpreter_config}')
+        interpreter_config = load_interpreter_config(args.interpreter_config)
+    if args.workers is None:
+        args.workers = 1 if args.pipeline else interpreter_config.get('workers', 1)
+    if args.pipeline and args.workers > 1:
+        parser.error("--pipeline and --workers can not be used together")
+    if args.watch and (args.pipeline or args.workers > 1):
+        parser.error("--watch runs in a single process, without --pipeline or --workers")
+    if args.watch and is_archive(args.input_directory):
+        parser.error("--watch needs an input directory, not an archive")
+    if args.fast_reject and args.falied_to:
+        parser.error("--fast_reject does not infer all the blocks of the failed sheets, it can not be used with -f")
+    if 'questions' in args.error_correction:
+        raise NotImplementedError('question blocks error correction is not implemented yet')
     
 
     # SETTING GLOBALS
+    global BATCH_SIZE_2ND_STAGE, INTERPRETER_OPTIONS_1ST_STAGE, INTERPRETER_OPTIONS_2ND_STAGE
+    BATCH_SIZE_2ND_STAGE = args.batch_size_2nd_stage
+    global DECODE_REDUCTION, DECODE_GRAYSCALE
+    DECODE_REDUCTION = args.decode_reduction
+    DECODE_GRAYSCALE = args.grayscale_decode
+    INTERPRETER_OPTIONS_1ST_STAGE = _interpreter_options(
+        interpreter_config, '1st_stage',
+        args.threads_1st_stage, args.xnnpack_1st_stage, args.delegate_1st_stage,
+    )
+    INTERPRETER_OPTIONS_2ND_STAGE = _interpreter_options(
+        interpreter_config, '2nd_stage',
+        args.threads_2nd_stage, args.xnnpack_2nd_stage, args.delegate_2nd_stage,
+    )
     checks.FILTER_DETECTIONS = args.filter_detections
     checks.CONTINUE_ON_FAIL = args.continue_on_fail
+    checks.FAST_REJECT = args.fast_reject
+    checks.CLUSTER_CHECK = args.cluster_check
     checks.load_checker(args.prova[0])
+    global CHECK_STATS
+    CHECK_STATS = CheckStats(args.check_stats or default_stats_path(args.prova[0]))
+    checks.RULE_RANKS = CHECK_STATS.ranks()
+
+    global BUILD_REPORT, BUILD_FALIED, ERROR_CORRECTION
+    BUILD_REPORT = args.build_report
+    BUILD_FALIED = args.falied_to
+    ERROR_CORRECTION = args.error_correction
+    if BUILD_REPORT:
+        builder.PROVA = args.prova[0]
+        builder.CONTINUE_ON_FAIL = args.continue_on_fail
+        builder.load_builder()
 
     if args.logfile is not None:
         try:
@@ -155,11 +784,62 @@ def main():
     FileHandler.set_path( "MODELS_PATH", './models' )
     FileHandler.set_path("INPUT_DIR", args.input_directory)
     FileHandler.make_and_set_dir("OUTPUT_DIR", args.output_directory)
+    FileHandler.SHARD = args.shard
     FileHandler.get_input_paths_checker(recursive=args.recursive)
     FileHandler.SAVE_IMAGES = args.save_images
+    # the json files are only needed by build_report.py
+    FileHandler.SAVE_JSON = (
+        (args.output_format == 'json' and not args.build_report) or args.debug_json
+    )
+    global OUTPUT_FORMAT, COLUMNAR_WRITER
+    OUTPUT_FORMAT = args.output_format
+    if OUTPUT_FORMAT == 'columnar':
+        COLUMNAR_WRITER = ColumnarWriter(FileHandler.OUTPUT_DIR, max_sheets=args.columnar_batch)
+    global ARCHIVE_WRITER
+    FileHandler.SAVE_TO_ARCHIVE = args.output_archive
+    if args.output_archive:
+        ARCHIVE_WRITER = ArchiveWriter(FileHandler.OUTPUT_DIR, max_sheets=args.archive_batch)
+    global RESULTS_STORE
+    if args.sqlite is not None:
+        RESULTS_STORE = ResultsStore(args.sqlite)
 
+    global MANIFEST, RESUME
+    RESUME = args.resume
+    settings = {
+        'prova': args.prova[0],
+        'model_1st_stage': [args.model_name_1st_stage, ModelRegistry.get_spec(args.model_name_1st_stage).version],
+        'model_2nd_stage': [args.model_name_2nd_stage, ModelRegistry.get_spec(args.model_name_2nd_stage).version],
+        'label_map_1st_stage': args.label_map_1st_stage,
+        'label_map_2nd_stage': args.label_map_2nd_stage,
+        'score_threshold_1st_stage': args.score_threshold_1st_stage,
+        'score_threshold_2nd_stage': args.score_threshold_2nd_stage,
+        'filter_detections': args.filter_detections,
+    }
+    # only when set, the sheets of the runs made before these options are not scanned again
+    if args.decode_reduction != 1 or args.grayscale_decode:
+        settings['decode_1st_stage'] = [args.decode_reduction, args.grayscale_decode]
+    if args.fast_reject:
+        settings['fast_reject'] = True
+    if args.cluster_check:
+        settings['cluster_check'] = True
+    MANIFEST = Manifest(FileHandler.OUTPUT_DIR, settings)
 
 
+    if args.watch:
+        watch_exam(
+            args.model_name_1st_stage,
+            args.model_name_2nd_stage,
+            args.label_map_1st_stage,
+            args.label_map_2nd_stage,
+            args.score_threshold_1st_stage,
+            args.score_threshold_2nd_stage,
+            recursive=args.recursive,
+            poll_interval=args.poll_interval,
+            settle_time=args.settle_time,
+            full_scan_interval=args.full_scan_interval,
+        )
+        return
+
     scan_exam(
         args.model_name_1st_stage,
         args.model_name_2nd_stage,
@@ -167,6 +847,8 @@ def main():
         args.label_map_2nd_stage,
         args.score_threshold_1st_stage,
         args.score_threshold_2nd_stage,
+        workers=args.workers,
+        pipeline_queue_size=args.queue_size if args.pipeline else None,
     )
 
 
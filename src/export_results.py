@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import argparse
+import json
+
+from aux.filehandler import FileHandler
+from aux.results_store import ResultsStore
+from aux import log
+
+logger = log.get_new_logger('export results')
+
+
+def export(store : ResultsStore) -> None:
+    # same files as exam_scanner.py + build_report.py
+    statuses = store.statuses()
+    for name in statuses:
+        detection_data = store.detections(name)
+        if not detection_data:
+            continue
+        out_path = FileHandler.OUTPUT_DIR / name
+        out_path.mkdir(parents=True, exist_ok=True)
+        with open(out_path / f'{name}.json', 'w') as f:
+            json.dump(detection_data, f, indent=4)
+
+    FileHandler.txt_out(FileHandler.make_report(
+        [name for name, status in statuses.items() if status == 'success'],
+        [name for name, status in statuses.items() if status != 'success'],
+    ), 'report.txt')
+    report = dict(store.answers())
+    if report:
+        FileHandler.save_report(report)
+    logger.error(f'{len(statuses)} sheets exported to {FileHandler.OUTPUT_DIR}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='query the sqlite results database or export it to the scanner output layout'
+    )
+    parser.add_argument('--sqlite', type=str, required=True)
+    parser.add_argument('-o', '--output_directory', type=str, default=None)
+    parser.add_argument('--cpf', type=str, default=None, help='list the sheets with this cpf')
+    parser.add_argument(
+        '--failing', type=str, default=None,
+        help='list the sheets that failed a checker (e.g. QuestionsBlockChecker) or checker.check',
+    )
+    args = parser.parse_args()
+
+    log.remove_filehandler()
+    store = ResultsStore(args.sqlite)
+    try:
+        if args.cpf is not None:
+            print('\n'.join(store.find_by_cpf(args.cpf)))
+        if args.failing is not None:
+            checker, _, check_name = args.failing.partition('.')
+            print('\n'.join(store.failing(checker, check_name or None)))
+        if args.output_directory is not None:
+            FileHandler.make_and_set_dir('OUTPUT_DIR', args.output_directory)
+            export(store)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
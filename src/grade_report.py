@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import time
+
+import numpy as np
+import grading
+
+from aux.report_writer import read_report
+from pathlib import Path
+
+from aux import log
+
+logger = log.get_new_logger('grade report')
+
+
+def load_variants(path, sheets : grading.AnswerSheets, variant_names : list[str]) -> np.ndarray:
+    # {sheet name or cpf: variant}, -1 (best key) for the students not in the file
+    with open(path) as f:
+        data : dict = json.load(f)
+    lookup = {name: i for i, name in enumerate(variant_names)}
+    variants = np.full(len(sheets.names), -1, dtype=np.int64)
+    for i, (name, cpf) in enumerate(zip(sheets.names, sheets.cpfs)):
+        variant = data.get(name, data.get(cpf))
+        if variant is not None:
+            variants[i] = lookup[str(variant)]
+    return variants
+
+
+def save_grades(path : Path, sheets : grading.AnswerSheets, result : grading.GradingResult, variant_names : list[str]) -> None:
+    num_questions = sheets.answers.shape[1]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'cpf', 'variant', 'score', 'percentage'])
+        for name, cpf, variant, score in zip(
+                sheets.names, sheets.cpfs, result.variants.tolist(), result.scores.tolist()
+            ):
+            writer.writerow([name, cpf, variant_names[variant], score, round(100 * score / num_questions, 2)])
+
+
+def save_item_statistics(path : Path, result : grading.GradingResult) -> None:
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['question', 'difficulty', 'discrimination', 'blank', *grading.LETTERS])
+        for question, (difficulty, discrimination, counts) in enumerate(zip(
+                result.difficulty.tolist(), result.discrimination.tolist(), result.distractors.tolist()
+            ), start=1):
+            writer.writerow([question, round(difficulty, 4), round(discrimination, 4), *counts])
+
+
+def benchmark(num_students : int, num_questions : int = 60, num_keys : int = 4) -> None:
+    rng = np.random.default_rng(0)
+    keys = rng.integers(1, 6, (num_keys, num_questions), dtype=np.uint8)
+    # students that know a part of the test and guess (or leave blank) the rest
+    variants = rng.integers(0, num_keys, num_students)
+    knows = rng.random((num_students, num_questions)) < rng.random((num_students, 1))
+    guesses = rng.integers(0, 6, (num_students, num_questions), dtype=np.uint8)
+    answers = np.where(knows, keys[variants], guesses)
+
+    options = ['NAO DETECTADO', *grading.LETTERS]
+    report = {
+        f'sheet_{i:07}': {'cpf': f'{i:011}', **{str(q): options[a] for q, a in enumerate(row, start=1)}}
+        for i, row in enumerate(answers.tolist())
+    }
+
+    start = time.perf_counter()
+    sheets = grading.pack_report(report, num_questions)
+    packed = time.perf_counter()
+    result = grading.grade(sheets.answers, keys)
+    graded = time.perf_counter()
+
+    assert (sheets.answers == answers).all()
+    print(f'{num_students} students, {num_questions} questions, {num_keys} keys')
+    print(f'pack  : {packed - start:.3f} s')
+    print(f'grade : {graded - packed:.3f} s ({num_students / max(graded - packed, 1e-9):.0f} students/s)')
+    print(f'keys found : {(result.variants == variants).mean():.2%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='grade the final report against the answer keys and compute the item statistics'
+    )
+    parser.add_argument('-i', '--input', type=str, default='final_report.json', help='final_report.json or .jsonl')
+    parser.add_argument('-k', '--keys', type=str, default=None, help='json {variant: "ABCDE..."}')
+    parser.add_argument('--variants', type=str, default=None, help='json {sheet name or cpf: variant}, the best key is used for the others')
+    parser.add_argument('-o', '--output_directory', type=str, default='.')
+    parser.add_argument('--benchmark', type=int, default=None, help='grade N synthetic students and exit')
+    args = parser.parse_args()
+
+    log.remove_filehandler()
+    if args.benchmark is not None:
+        benchmark(args.benchmark)
+        return
+    if args.keys is None:
+        parser.error('the answer keys (-k) are required')
+
+    try:
+        variant_names, keys = grading.load_answer_keys(args.keys)
+    except ValueError as e:
+        parser.error(str(e))
+    sheets = grading.pack_report(read_report(args.input), keys.shape[1])
+    variants = None
+    if args.variants is not None:
+        variants = load_variants(args.variants, sheets, variant_names)
+    result = grading.grade(sheets.answers, keys, variants)
+
+    output_directory = Path(args.output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    save_grades(output_directory / 'grades.csv', sheets, result, variant_names)
+    save_item_statistics(output_directory / 'item_statistics.csv', result)
+    logger.error(f'{len(sheets.names)} students graded : {output_directory.resolve()}')
+
+
+if __name__ == '__main__':
+    main()
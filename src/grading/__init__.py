@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import json
+
+import numpy as np
+
+from dataclasses import dataclass, field
+
+# answers are packed as uint8: 0 blank / not detected, 1..5 the letters
+LETTERS = ['A', 'B', 'C', 'D', 'E']
+BLANK = 0
+# in an answer key, a question everyone gets right
+ANNULLED = 255
+# in an answer key being read, a question the key does not give
+_UNSET = 254
+
+_CODES = {letter: i + 1 for i, letter in enumerate(LETTERS)}
+_CODES.update({None: BLANK, 'NAO DETECTADO': BLANK})
+
+
+@dataclass
+class AnswerSheets():
+    # one row per student, one column per question (question i + 1 in column i)
+    names: list[str] = field(default_factory=list)
+    cpfs: list[str] = field(default_factory=list)
+    answers: np.ndarray = field(default=None)       # uint8 [students, questions]
+
+
+@dataclass
+class GradingResult():
+    variants: np.ndarray = field(default=None)          # int [students], key used for each student
+    correct: np.ndarray = field(default=None)           # bool [students, questions]
+    scores: np.ndarray = field(default=None)            # int [students]
+    scores_by_key: np.ndarray = field(default=None)     # int [students, keys]
+    # item statistics
+    difficulty: np.ndarray = field(default=None)        # [questions] share of right answers
+    discrimination: np.ndarray = field(default=None)    # [questions] item x rest of the test correlation
+    distractors: np.ndarray = field(default=None)       # int [questions, 6] blank, A..E counts
+
+
+def pack_report(report : dict[str, dict], num_questions : int = None) -> AnswerSheets:
+    '''
+    Packs the builder output ({name: {cpf, 1: 'A', 2: 'NAO DETECTADO', ...}}) in a uint8 matrix.
+    Sheets without answers (e.g. 'FILE NOT FOUND') are left out.
+    '''
+    sheets = {name: answers for name, answers in report.items() if isinstance(answers, dict)}
+    if num_questions is None:
+        num_questions = max(
+            (int(key) for answers in sheets.values() for key in answers if str(key).isdigit()),
+            default=0,
+        )
+    # json reports have string keys, the builder output has int keys
+    str_keys = [str(q) for q in range(1, num_questions + 1)]
+    int_keys = list(range(1, num_questions + 1))
+
+    # fromiter with a count fills the uint8 matrix in place, an answer the builder
+    # does not write is read as blank
+    codes = (
+        _CODES.get(answers.get(key), BLANK)
+        for answers in sheets.values() for key in (int_keys if 1 in answers else str_keys)
+    )
+    matrix = np.fromiter(codes, dtype=np.uint8, count=len(sheets) * num_questions)
+    return AnswerSheets(
+        names=list(sheets),
+        cpfs=[answers.get('cpf') for answers in sheets.values()],
+        answers=matrix.reshape(len(sheets), num_questions),
+    )
+
+
+def load_answer_keys(path, num_questions : int = None) -> tuple[list[str], np.ndarray]:
+    '''
+    Reads {variant: "ABCDE..."} or {variant: {"1": "A", ...}}, '*' annuls a question.
+    Returns the variant names and a uint8 [keys, questions] matrix.
+    ValueError if a key does not give every question.
+    '''
+    with open(path) as f:
+        data : dict = json.load(f)
+    keys = {}
+    for variant, key in data.items():
+        if isinstance(key, str):
+            key = {str(i + 1): letter for i, letter in enumerate(key)}
+        keys[variant] = {int(question): letter for question, letter in key.items()}
+    if num_questions is None:
+        num_questions = max(max(key) for key in keys.values())
+
+    matrix = np.full((len(keys), num_questions), _UNSET, dtype=np.uint8)
+    for i, key in enumerate(keys.values()):
+        for question, letter in key.items():
+            if 1 <= question <= num_questions:
+                matrix[i, question - 1] = ANNULLED if letter == '*' else LETTERS.index(letter.upper()) + 1
+
+    missing = {
+        variant: (np.flatnonzero(row == _UNSET) + 1).tolist()
+        for variant, row in zip(keys, matrix) if (row == _UNSET).any()
+    }
+    if missing:
+        raise ValueError('questions missing from the answer keys: ' + '; '.join(
+            f'{variant}: {questions}' for variant, questions in missing.items()
+        ))
+    return list(keys), matrix
+
+
+def grade(answers : np.ndarray, keys : np.ndarray, variants : np.ndarray = None) -> GradingResult:
+    '''
+    Scores every student against every key and computes the item statistics.
+    variants gives the key of each student (-1 when unknown), by default and for
+    the unknown ones the key with the highest score is used.
+    '''
+    answers = np.asarray(answers, dtype=np.uint8)
+    keys = np.asarray(keys, dtype=np.uint8)
+    num_students, num_questions = answers.shape
+    if keys.shape[1] != num_questions:
+        raise ValueError(f'{keys.shape[1]} questions in the keys, {num_questions} in the answers')
+
+    # [students, keys] number of right answers, one key at a time keeps the memory at [students, questions]
+    scores_by_key = np.empty((num_students, len(keys)), dtype=np.int32)
+    for k, key in enumerate(keys):
+        scores_by_key[:, k] = ((answers == key) | (key == ANNULLED)).sum(axis=1)
+
+    best = scores_by_key.argmax(axis=1)
+    if variants is None:
+        variants = best
+    else:
+        variants = np.where(np.asarray(variants) < 0, best, variants)
+
+    student_keys = keys[variants]
+    correct = (answers == student_keys) | (student_keys == ANNULLED)
+    scores = scores_by_key[np.arange(num_students), variants]
+
+    return GradingResult(
+        variants=variants,
+        correct=correct,
+        scores=scores,
+        scores_by_key=scores_by_key,
+        difficulty=correct.mean(axis=0) if num_students else np.zeros(num_questions),
+        discrimination=_discrimination(correct, scores),
+        distractors=_distractors(answers),
+    )
+
+
+def _discrimination(correct : np.ndarray, scores : np.ndarray) -> np.ndarray:
+    # point biserial correlation between the item and the score without the item
+    item = correct.astype(np.float64)
+    rest = scores[:, None] - item
+    item_centered = item - item.mean(axis=0)
+    rest_centered = rest - rest.mean(axis=0)
+    covariance = (item_centered * rest_centered).sum(axis=0)
+    norm = np.sqrt((item_centered ** 2).sum(axis=0) * (rest_centered ** 2).sum(axis=0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norm > 0, covariance / norm, 0.0)
+
+
+def _distractors(answers : np.ndarray) -> np.ndarray:
+    # [questions, 6] how many students marked each option (blank, A..E), in one bincount
+    num_questions = answers.shape[1]
+    options = len(LETTERS) + 1
+    flat = np.arange(num_questions) * options + np.minimum(answers, options - 1)
+    return np.bincount(flat.ravel(), minlength=num_questions * options).reshape(num_questions, options)
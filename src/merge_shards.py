@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import argparse
+import shutil
+
+from aux import columnar
+from aux.filehandler import FileHandler
+from aux.manifest import Manifest
+from aux.report_writer import ReportWriter, read_report
+from pathlib import Path
+
+from aux import log
+
+logger = log.get_new_logger('merge shards')
+
+REPORT_NAMES = ('final_report.json', 'final_report.jsonl')
+
+
+def merge_shards(shard_dirs : list[Path], output_format : str = 'json', move : bool = False) -> None:
+    '''
+    Combines the output directories of exam_scanner.py --shard i/N runs (and of
+    build_report.py run in them) in FileHandler.OUTPUT_DIR.
+    '''
+    transfer = shutil.move if move else _copy
+    statuses : dict[str, str] = {}
+    reports : dict[str, dict] = {}
+
+    for shard_dir in shard_dirs:
+        logger.info(f'merging {shard_dir}')
+        report_path = shard_dir / 'report.txt'
+        if not report_path.exists():
+            raise ValueError(f'{shard_dir} has no report.txt, is it an exam_scanner.py output directory?')
+        success, falied = FileHandler.parse_report(FileHandler.text_in(report_path))
+        shard_statuses = {name: 'success' for name in success}
+        shard_statuses.update({name: 'falied' for name in falied})
+        statuses.update(shard_statuses)
+
+        for report_name in REPORT_NAMES:
+            if (shard_dir / report_name).exists():
+                reports.update(read_report(shard_dir / report_name))
+
+        # per-sheet json files and images
+        for name in shard_statuses:
+            if (shard_dir / name).is_dir():
+                transfer(shard_dir / name, FileHandler.OUTPUT_DIR / name)
+        # the .detcol and zip files of two shards can have the same name
+        for path in sorted(shard_dir.glob(f'*{columnar.EXTENSION}')):
+            transfer(path, FileHandler.OUTPUT_DIR / f'{shard_dir.name}_{path.name}')
+        for path in sorted(shard_dir.glob('sheets_*.zip')):
+            transfer(path, FileHandler.OUTPUT_DIR / f'sheets_{shard_dir.name}_{path.name[len("sheets_"):]}')
+
+        manifest_path = shard_dir / Manifest.FILENAME
+        if manifest_path.exists():
+            with open(manifest_path) as src, open(FileHandler.OUTPUT_DIR / Manifest.FILENAME, 'a') as dst:
+                shutil.copyfileobj(src, dst)
+
+    # the sheets of the shards interleave in the input order, the merged lists are sorted by name
+    success = sorted(name for name, status in statuses.items() if status == 'success')
+    falied = sorted(name for name, status in statuses.items() if status != 'success')
+    FileHandler.txt_out(FileHandler.make_report(success, falied), 'report.txt')
+    if reports:
+        with ReportWriter(FileHandler.OUTPUT_DIR / f'final_report.{output_format}', output_format) as writer:
+            for name in success + falied:
+                if name in reports:
+                    writer.write(name, reports[name])
+    logger.error(
+        f'{len(shard_dirs)} shards, {len(success)} success and {len(falied)} falied sheets : {FileHandler.OUTPUT_DIR}'
+    )
+
+
+def _copy(src : Path, dst : Path) -> None:
+    if src.is_dir():
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='merge the output directories of exam_scanner.py runs made with --shard'
+    )
+    parser.add_argument('shard_directories', type=str, nargs='+')
+    parser.add_argument('-o', '--output_directory', type=str, required=True)
+    parser.add_argument(
+        '--output_format', type=str, default='json', choices=ReportWriter.FORMATS,
+        help='format of the merged final report, when the shards have one',
+    )
+    parser.add_argument(
+        '--move', action='store_true', default=False,
+        help='move the per-sheet files instead of copying them',
+    )
+    args = parser.parse_args()
+
+    log.remove_filehandler()
+    FileHandler.make_and_set_dir('OUTPUT_DIR', args.output_directory)
+    # an existing manifest would get the lines of the shards twice
+    if (FileHandler.OUTPUT_DIR / Manifest.FILENAME).exists():
+        parser.error(f'{FileHandler.OUTPUT_DIR} already has a {Manifest.FILENAME}, use an empty directory')
+    merge_shards([Path(path) for path in args.shard_directories], args.output_format, args.move)
+
+
+if __name__ == '__main__':
+    main()
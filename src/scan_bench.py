@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_images(input_path : Path) -> list[tuple[str, bytes]]:
+    if input_path.is_file():
+        paths = [input_path]
+    else:
+        paths = sorted(p for p in input_path.rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS)
+    return [(path.name, path.read_bytes()) for path in paths]
+
+
+def send(url : str, name : str, data : bytes) -> tuple[float, str]:
+    request = Request(
+        f'{url}?name={quote(name)}', data=data, method='POST',
+        headers={'Content-Type': 'application/octet-stream'},
+    )
+    start = time.perf_counter()
+    with urlopen(request) as response:
+        status = json.load(response)['status']
+    return time.perf_counter() - start, status
+
+
+def percentile(values : list[float], p : int) -> float:
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='latency and throughput of scan_server.py')
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000/scan")
+    parser.add_argument("-i", "--input", type=str, required=True, help="image or directory of images")
+    parser.add_argument("-n", "--requests", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="requests in flight")
+    args = parser.parse_args()
+
+    images = load_images(Path(args.input))
+    if not images:
+        raise ValueError(f'no images found in {args.input}')
+    jobs = [images[i % len(images)] for i in range(args.requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda job: send(args.url, *job), jobs))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000 for latency, _ in results]
+    failed = sum(1 for _, status in results if status != 'success')
+    print(f'requests    : {len(results)} ({failed} failed sheets), concurrency {args.concurrency}')
+    print(f'throughput  : {len(results) / elapsed:.2f} sheets/s')
+    print(
+        f'latency (ms): p50 {percentile(latencies, 50):.1f}  p90 {percentile(latencies, 90):.1f}'
+        f'  p99 {percentile(latencies, 99):.1f}  max {max(latencies):.1f}'
+    )
+    with urlopen(args.url.rsplit('/', 1)[0] + '/stats') as response:
+        print(f'server stats: {json.dumps(json.load(response)["batchers"])}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import time
+
+import builder
+import checks
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from aux.batching import MicroBatcher
+from aux.filehandler import FileHandler
+from aux.image import Image
+from aux.model_registry import ModelRegistry
+from aux import log
+
+logger = log.get_new_logger('scan server')
+
+
+class ScanService():
+    '''
+    Keeps both models loaded and scans one sheet per request.
+    The inferences of concurrent requests are grouped by a MicroBatcher per stage,
+    so each model is only invoked from its batcher thread.
+    '''
+
+    def __init__(
+            self, model_name_1st_stage, model_name_2nd_stage,
+            score_threshold_1st_stage, score_threshold_2nd_stage,
+            max_batch_size=8, max_wait=0.01,
+        ):
+        model_1st_stage = ModelRegistry.get_model(model_name_1st_stage, max_batch_size=max_batch_size)
+        model_2nd_stage = ModelRegistry.get_model(model_name_2nd_stage, max_batch_size=max_batch_size)
+        self.models = {'1st_stage': model_1st_stage, '2nd_stage': model_2nd_stage}
+        self.batchers = {
+            '1st_stage': MicroBatcher(
+                lambda imgs: self._detect(imgs, model_1st_stage, score_threshold_1st_stage),
+                max_batch_size, max_wait, name='1st stage batcher',
+            ),
+            '2nd_stage': MicroBatcher(
+                lambda imgs: self._detect(imgs, model_2nd_stage, score_threshold_2nd_stage),
+                max_batch_size, max_wait, name='2nd stage batcher',
+            ),
+        }
+        self.started = time.time()
+        # requests are scanned on the threads of the http server
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+
+    @staticmethod
+    def _detect(imgs : list, model, score_threshold) -> list:
+        Image.make_detections_in_batch(imgs, model, score_threshold)
+        return imgs
+
+    def scan(self, name : str, data : bytes) -> dict:
+        with self._requests_lock:
+            self.requests += 1
+        img = Image.from_bytes(name, data)
+        self.batchers['1st_stage'].submit(img).result()
+        if checks.perform(img, stage=1) == 'failed':
+            return {'name': img.name[:-4], 'status': 'failed', 'detections': {}, 'answers': None}
+
+        cropped_imgs : list[Image] = img.get_cropped()
+        for future in self.batchers['2nd_stage'].submit_many(cropped_imgs):
+            future.result()
+        status = 'success'
+        for crop_img in cropped_imgs:
+            if checks.perform(crop_img, stage=2) == 'failed':
+                status = 'failed'
+
+        # same content as the json file saved by exam_scanner.py
+        detection_data = FileHandler.detection_data(cropped_imgs)
+        return {
+            'name': img.name[:-4],
+            'status': status,
+            'detections': detection_data,
+            'answers': builder.build_from_data(detection_data, img.name, status=status, ec=[]),
+        }
+
+    def stats(self) -> dict:
+        return {
+            'uptime': time.time() - self.started,
+            'requests': self.requests,
+            'models': {stage: model.name for stage, model in self.models.items()},
+            'batchers': {
+                stage: {
+                    'batches': batcher.batches,
+                    'items': batcher.items,
+                    'average_batch_size': batcher.average_batch_size(),
+                }
+                for stage, batcher in self.batchers.items()
+            },
+        }
+
+    def close(self) -> None:
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /scan    image file as the body, name in ?name= or in the X-Filename header
+    GET  /health
+    GET  /stats   requests and average batch size of each stage
+    '''
+
+    service : ScanService = None
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif path == '/stats':
+            self._send_json(200, self.service.stats())
+        else:
+            self._send_json(404, {'error': f'not found: {path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/scan':
+            self._send_json(404, {'error': f'not found: {url.path}'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            self._send_json(400, {'error': 'empty body, send the image file'})
+            return
+        data = self.rfile.read(length)
+        name = parse_qs(url.query).get('name', [self.headers.get('X-Filename', 'upload.jpg')])[0]
+        # only the file name, it is used to name the crops
+        name = Path(name).name
+
+        try:
+            result = self.service.scan(name, data)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            logger.exception(e)
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, result)
+
+    def _send_json(self, code : int, body : dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='HTTP service that scans one sheet per request, with the models kept loaded'
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-mf", "--model_name_1st_stage", type=str, default="1st_stage_v0_0_0")
+    parser.add_argument("-ms", "--model_name_2nd_stage", type=str, default="2nd_stage_v0_0_1")
+    parser.add_argument("-stf", "--score_threshold_1st_stage", type=float, default=0.5)
+    parser.add_argument("-sts", "--score_threshold_2nd_stage", type=float, default=0.5)
+    parser.add_argument(
+        "--max_batch_size", type=int, default=8,
+        help="most images sent to a model in a single invoke",
+    )
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=10.0,
+        help="how long the first image of a batch waits for others before the invoke",
+    )
+    parser.add_argument(
+        "-fd", "--filter_detections", action="store_true",
+        help="remove invalid/out of place detections before performing the checks",
+    )
+    parser.add_argument(
+        "-p", "--prova", type=str, default="PS", choices=['PS', 'SIMUENEM', 'SIMUFSC'],
+    )
+    parser.add_argument(
+        "--logfile",
+        nargs="*",
+        type=str,
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+        help="make a log file with the specified level defined",
+    )
+    args = parser.parse_args()
+
+    if args.logfile is not None:
+        try:
+            log.set_log_level(args.logfile)
+        except ValueError:
+            log.set_log_level(['INFO'])
+    else: log.remove_filehandler()
+
+    # a failed sheet is an answer to the client, not a reason to stop the server
+    checks.FILTER_DETECTIONS = args.filter_detections
+    checks.CONTINUE_ON_FAIL = True
+    checks.load_checker(args.prova)
+    builder.PROVA = args.prova
+    builder.CONTINUE_ON_FAIL = True
+    builder.load_builder()
+
+    FileHandler.set_path("MODELS_PATH", './models')
+
+    service = ScanService(
+        args.model_name_1st_stage,
+        args.model_name_2nd_stage,
+        args.score_threshold_1st_stage,
+        args.score_threshold_2nd_stage,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+    )
+    ScanRequestHandler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), ScanRequestHandler)
+    logger.error(f'listening on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        logger.error(f'stopped: {service.stats()}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import sys
+
+from pathlib import Path
+
+# the scripts run from src/, the modules import each other from there
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from aux import log
+
+log.remove_filehandler()
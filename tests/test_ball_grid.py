@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+from aux.columnar import CropDetections
+from builder.ball_grid import BallGrid, COLUMN_THRESHOLD, LINE_THRESHOLD
+
+
+# the list based readers of the builder before BallGrid
+
+def old_get_balls(axis, distance_threshold, detections):
+    index = 3 if axis == 'y' else 2
+    sorted_detections = sorted(detections, key=lambda d: d['bounding_box'][index])
+    ball_lines = []
+    ball_line = [sorted_detections.pop(0)]
+    while len(sorted_detections) > 0:
+        if abs(sorted_detections[0]['bounding_box'][index] - ball_line[-1]['bounding_box'][index]) > distance_threshold:
+            ball_lines.append(ball_line)
+            ball_line = [sorted_detections.pop(0)]
+        else:
+            ball_line.append(sorted_detections.pop(0))
+    ball_lines.append(ball_line)
+    return ball_lines
+
+
+def old_selected_ball_position(type, num_elements, detections):
+    if len(detections) != num_elements:
+        return None
+    index = 3 if type == 'columns' else 2
+    sorted_detections = sorted(detections, key=lambda d: d['bounding_box'][index])
+    for position, detection in enumerate(sorted_detections):
+        if detection['class_id'] == 'selected_ball':
+            return position
+    return None
+
+
+def ball_block(lines, columns, seed, jitter=0.004):
+    # a block of lines x columns balls with one marked ball per line, the coordinates are
+    # float32 values as in the detection files
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(0.1 + 0.08 * np.arange(lines), 0.1 + 0.07 * np.arange(columns), indexing='ij')
+    xmax = (x + 0.03 + rng.uniform(-jitter, jitter, x.shape)).astype(np.float32)
+    ymax = (y + 0.03 + rng.uniform(-jitter, jitter, y.shape)).astype(np.float32)
+    selected = np.zeros((lines, columns), dtype=bool)
+    selected[np.arange(lines), rng.integers(0, columns, lines)] = True
+    detections = [
+        {
+            'class_id': 'selected_ball' if selected[i, j] else 'unselected_ball',
+            'score': 0.9,
+            'bounding_box': [float(xmax[i, j]) - 0.05, float(ymax[i, j]) - 0.05, float(xmax[i, j]), float(ymax[i, j])],
+        }
+        for i in range(lines) for j in range(columns)
+    ]
+    return [detections[i] for i in rng.permutation(len(detections))]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_questions_block(seed):
+    detections = ball_block(10, 5, seed)
+    grid = BallGrid.from_detections(detections)
+    index = {id(detection): i for i, detection in enumerate(detections)}
+
+    old_lines = old_get_balls('y', LINE_THRESHOLD, detections)
+    assert grid.num_lines == len(old_lines)
+    for label, line in enumerate(old_lines):
+        members = [index[id(detection)] for detection in line]
+        assert (grid.lines[members] == label).all()
+        # left to right inside the line, as the old sort of the line
+        old_sorted = sorted(line, key=lambda d: d['bounding_box'][2])
+        assert [index[id(d)] for d in old_sorted] == sorted(members, key=lambda i: grid.line_positions[i])
+
+    old_answers = [old_selected_ball_position('x', 5, line) for line in old_lines]
+    assert grid.read_lines(5).tolist() == [-1 if answer is None else answer for answer in old_answers]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_cpf_block(seed):
+    detections = ball_block(10, 11, seed)
+    grid = BallGrid.from_detections(detections)
+    index = {id(detection): i for i, detection in enumerate(detections)}
+
+    old_columns = old_get_balls('x', COLUMN_THRESHOLD, detections)
+    assert grid.num_columns == len(old_columns) == 11
+    for label, column in enumerate(old_columns):
+        members = [index[id(detection)] for detection in column]
+        assert (grid.columns[members] == label).all()
+        old_sorted = sorted(column, key=lambda d: d['bounding_box'][3])
+        assert [index[id(d)] for d in old_sorted] == sorted(members, key=lambda i: grid.column_positions[i])
+
+    old_answers = [old_selected_ball_position('columns', 10, column) for column in old_columns]
+    assert grid.read_columns(10).tolist() == [-1 if answer is None else answer for answer in old_answers]
+
+
+@pytest.mark.parametrize('selected_ymax, position', [(0.131, 3), (0.129, 2), (0.13, 2)])
+def test_ties(selected_ymax, position):
+    # two balls of a line with the same right edge: the old stable sorts kept them by bottom
+    # edge, then in input order
+    detections = ball_block(1, 5, 0, jitter=0.0)
+    detections.sort(key=lambda d: d['bounding_box'][2])
+    for detection in detections:
+        detection['class_id'] = 'unselected_ball'
+        detection['bounding_box'][3] = 0.13
+    twin = dict(detections[2], bounding_box=list(detections[2]['bounding_box']), class_id='selected_ball')
+    twin['bounding_box'][3] = selected_ymax
+    detections[3] = twin
+    detections = [detections[i] for i in (4, 3, 0, 2, 1)]
+
+    grid = BallGrid.from_detections(detections)
+    line, = old_get_balls('y', LINE_THRESHOLD, detections)
+    assert grid.read_lines(5).tolist() == [old_selected_ball_position('x', 5, line)] == [position]
+
+
+def test_columnar_detections():
+    # the arrays of a columnar file read the same as the json dicts
+    detections = ball_block(10, 5, 3)
+    class_names = ['selected_ball', 'unselected_ball']
+    crop = CropDetections(
+        np.array([d['bounding_box'] for d in detections], dtype=np.float32),
+        np.full(len(detections), 0.9, dtype=np.float32),
+        np.array([class_names.index(d['class_id']) for d in detections], dtype=np.uint8),
+        class_names,
+    )
+    from_json, from_arrays = BallGrid.from_detections(detections), BallGrid.from_detections(crop)
+    assert from_arrays.read_lines(5).tolist() == from_json.read_lines(5).tolist()
+    assert np.shares_memory(from_arrays.ymax, crop.boxes)
+
+
+def test_empty_block():
+    grid = BallGrid.from_detections([])
+    assert grid.num_lines == grid.num_columns == 0
+    assert grid.read_lines(5).tolist() == []
@@ -0,0 +1,100 @@
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from aux.columnar import ALIGNMENT, EXTENSION, MAGIC, ColumnarReader, ColumnarWriter, CropDetections, index_files
+
+
+def crop(count, class_names, seed):
+    rng = np.random.default_rng(seed)
+    xy = rng.random((count, 2)).astype(np.float32) * 0.8
+    return CropDetections(
+        np.concatenate([xy, xy + 0.1], axis=1),
+        rng.random(count).astype(np.float32),
+        rng.integers(0, len(class_names), count),
+        class_names,
+    )
+
+
+def sheets():
+    # the crops of each sheet use the label map of their own model
+    first_stage = ['cpf_block', 'questions_block']
+    second_stage = ['cpf_column', 'question_line', 'selected_ball', 'unselected_ball']
+    return {
+        f'sheet_{i}': {
+            'cpf_block_00': crop(12, second_stage, i),
+            # a crop without detections
+            'questions_block_00': crop(0, second_stage, i + 100),
+            'questions_block_01': crop(30, second_stage[::-1], i + 200),
+            'blocks': crop(3, first_stage, i + 300),
+        }
+        for i in range(5)
+    }
+
+
+def test_round_trip(tmp_path):
+    written = []
+    writer = ColumnarWriter(tmp_path, max_sheets=2)
+    data = sheets()
+    for name, crops in data.items():
+        writer.add_sheet(name, 'success', crops, on_written=lambda name=name: written.append(name))
+    # two full files, the last sheet is written on close
+    assert len(writer.paths) == 2 and written == list(data)[:4]
+    writer.close()
+    assert len(writer.paths) == 3 and written == list(data)
+    assert sorted(tmp_path.iterdir()) == sorted(writer.paths)
+    assert all(path.suffix == EXTENSION for path in writer.paths)
+
+    index = index_files(tmp_path)
+    assert list(index) == list(data)
+    for name, crops in data.items():
+        reader = ColumnarReader(index[name])
+        assert name in reader and reader.status(name) == 'success'
+        read = reader.sheet(name)
+        assert list(read) == list(crops)
+        for crop_name, expected in crops.items():
+            got = read[crop_name]
+            assert len(got) == len(expected)
+            np.testing.assert_array_equal(got.boxes, expected.boxes)
+            np.testing.assert_array_equal(got.scores, expected.scores)
+            assert [got.class_names[c] for c in got.classes.tolist()] == [
+                expected.class_names[c] for c in expected.classes.tolist()
+            ]
+            assert got.to_json() == expected.to_json()
+
+
+def test_layout(tmp_path):
+    writer = ColumnarWriter(tmp_path)
+    writer.add_sheet('sheet_0', 'failed', sheets()['sheet_0'])
+    writer.close()
+    path, = writer.paths
+
+    raw = path.read_bytes()
+    assert raw[:len(MAGIC)] == MAGIC
+    header_size, = struct.unpack('<Q', raw[len(MAGIC):len(MAGIC) + 8])
+    header = json.loads(raw[len(MAGIC) + 8:len(MAGIC) + 8 + header_size])
+    assert header['count'] == 45
+    assert header['sheets'] == [{
+        'name': 'sheet_0', 'status': 'failed', 'first_crop': 0,
+        'crops': ['cpf_block_00', 'questions_block_00', 'questions_block_01', 'blocks'],
+    }]
+    assert header['arrays']['crop_offsets']['shape'] == [5]
+
+    # every array starts on a 64 byte boundary of the file and is read from the memory map
+    reader = ColumnarReader(path)
+    for name in ('boxes', 'scores', 'classes', 'crop_offsets'):
+        array = getattr(reader, name)
+        assert np.shares_memory(array, reader._map)
+        start = array.__array_interface__['data'][0] - reader._map.__array_interface__['data'][0]
+        assert start % ALIGNMENT == 0
+    assert reader.crop_offsets.tolist() == [0, 12, 12, 42, 45]
+    assert reader.sheet('sheet_0')['questions_block_00'].to_json() == []
+
+
+def test_not_a_columnar_file(tmp_path):
+    path = tmp_path / f'other{EXTENSION}'
+    path.write_bytes(b'{"not": "detcol"}')
+    with pytest.raises(ValueError):
+        ColumnarReader(path)
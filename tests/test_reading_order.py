@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from aux.reading_order import gap_clusters, rank_in_groups, reading_order
+
+
+class OldOrder():
+    # the pairwise Detection.__lt__ that sorted the detections before the reading order engine
+    def __init__(self, index, box):
+        self.index = index
+        self.xmin, self.ymin, self.xmax, self.ymax = box
+        self.x = (self.xmin + self.xmax) / 2
+        self.y = (self.ymin + self.ymax) / 2
+
+    def __lt__(self, other):
+        vert_dist_from_other = self.y - other.y
+        if abs(vert_dist_from_other) > (self.ymax - self.ymin) * 0.9:
+            return vert_dist_from_other < 0
+        hor_dist_from_other = self.x - other.x
+        if abs(hor_dist_from_other) > (self.xmax - self.xmin) * 0.9:
+            return hor_dist_from_other < 0
+        if vert_dist_from_other >= hor_dist_from_other:
+            return self.y < other.y
+        return self.x < other.x
+
+
+def grid_boxes(rows, columns, jitter=0.0, seed=0):
+    # the blocks of a sheet: rows x columns boxes of 0.2 x 0.15 with some space between them
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(0.2 + 0.3 * np.arange(columns), 0.3 + 0.25 * np.arange(rows))
+    centers = np.stack([x.ravel(), y.ravel()], axis=1) + rng.uniform(-jitter, jitter, (rows * columns, 2))
+    size = np.array([0.2, 0.15]) * (1 + rng.uniform(-jitter, jitter, (rows * columns, 2)))
+    return np.concatenate([centers - size / 2, centers + size / 2], axis=1)
+
+
+def old_order(boxes):
+    return [item.index for item in sorted(OldOrder(i, box) for i, box in enumerate(boxes.tolist()))]
+
+
+def new_order(boxes):
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+    _, _, order = reading_order(centers, boxes[:, 3] - boxes[:, 1])
+    return order.tolist()
+
+
+def test_clean_grid():
+    boxes = grid_boxes(2, 3)
+    shuffled = np.random.default_rng(1).permutation(len(boxes))
+    centers = (boxes[shuffled, :2] + boxes[shuffled, 2:]) / 2
+    rows, columns, order = reading_order(centers, boxes[shuffled, 3] - boxes[shuffled, 1])
+
+    assert order.tolist() == old_order(boxes[shuffled])
+    assert shuffled[order].tolist() == list(range(6))
+    assert rows[order].tolist() == [0, 0, 0, 1, 1, 1]
+    assert columns[order].tolist() == [0, 1, 2, 0, 1, 2]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_jittered_grid(seed):
+    boxes = grid_boxes(2, 3, jitter=0.03, seed=seed)
+    shuffled = np.random.default_rng(seed + 100).permutation(len(boxes))
+    assert new_order(boxes[shuffled]) == old_order(boxes[shuffled])
+
+
+def test_gap_clusters():
+    values = np.array([0.52, 0.1, 0.5, 0.12, 0.9])
+    assert gap_clusters(values, 0.05).tolist() == [1, 0, 1, 0, 2]
+    assert gap_clusters(np.zeros(0), 0.05).tolist() == []
+
+
+def test_rank_in_groups():
+    groups = np.array([1, 0, 1, 0, 1])
+    values = np.array([0.3, 0.9, 0.1, 0.2, 0.2])
+    order = np.lexsort((values, groups))
+    assert rank_in_groups(groups, order).tolist() == [2, 1, 0, 0, 1]
+
+
+def test_empty():
+    rows, columns, order = reading_order(np.zeros((0, 2)), np.zeros(0))
+    assert len(rows) == len(columns) == len(order) == 0
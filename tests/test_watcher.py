@@ -0,0 +1,63 @@
+import os
+
+from aux.watcher import InputWatcher
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def poll(watcher, times=2):
+    # the first poll of a file only starts its settle time
+    ready = []
+    for _ in range(times):
+        ready += watcher.poll()
+    return sorted(os.path.relpath(path, watcher.root) for path in ready)
+
+
+def test_new_files(tmp_path):
+    watcher = InputWatcher(tmp_path, settle_time=0, full_scan_interval=1e9)
+    write(tmp_path / 'b.jpg', b'1')
+    write(tmp_path / 'a.PNG', b'1')
+    write(tmp_path / 'notes.txt', b'1')
+    assert poll(watcher) == ['a.PNG', 'b.jpg']
+    assert poll(watcher) == []
+
+    write(tmp_path / 'day2' / 'c.jpeg', b'1')
+    assert poll(watcher) == ['day2/c.jpeg']
+
+
+def test_files_dropped_again(tmp_path):
+    watcher = InputWatcher(tmp_path, settle_time=0, full_scan_interval=0)
+    write(tmp_path / 'a.jpg', b'1')
+    assert poll(watcher) == ['a.jpg']
+
+    # rewritten in place, the folder mtime does not change
+    write(tmp_path / 'a.jpg', b'22')
+    assert poll(watcher) == ['a.jpg']
+
+    # replaced by a rename
+    write(tmp_path / 'new.tmp', b'333')
+    os.replace(tmp_path / 'new.tmp', tmp_path / 'a.jpg')
+    assert poll(watcher) == ['a.jpg']
+
+    (tmp_path / 'a.jpg').unlink()
+    assert poll(watcher) == [] and watcher._done == {}
+
+
+def test_settle_time(tmp_path):
+    watcher = InputWatcher(tmp_path, settle_time=3600, full_scan_interval=1e9)
+    write(tmp_path / 'a.jpg', b'1')
+    assert poll(watcher, times=3) == []
+    watcher.settle_time = 0
+    assert poll(watcher, times=1) == ['a.jpg']
+
+
+def test_shard_and_recursive(tmp_path):
+    for name in ('a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'sub/e.jpg'):
+        write(tmp_path / name, b'1')
+    found = []
+    for index in range(2):
+        found += poll(InputWatcher(tmp_path, recursive=False, shard=(index, 2), settle_time=0))
+    assert sorted(found) == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']